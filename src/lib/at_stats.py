@@ -0,0 +1,203 @@
+"""
+Tracing of the AT commands sent to the modem.
+
+Every AT command sent with send_at_cmd() is recorded per command verb (e.g. "AT+CSIM",
+"AT+CFUN?") in fixed-size counters: number of commands, failed commands (no final "OK"),
+bytes sent and received, total and maximal duration and a histogram of the durations.
+The counters are kept in RAM and can be accumulated over cycles in a file on flash
+(there is no RTC memory on the pycom boards that survives deepsleep), dumped to the
+log or retrieved with summary() to be sent as telemetry.
+
+The full AT conversation (command, response and duration) can additionally be recorded
+into a transcript file with start_recording(), to be replayed on a development machine
+(see tools/at_replay.py). The transcript has one JSON object per line:
+{"cmd": "<AT command>", "response": "<raw response>", "ms": <duration>}
+"""
+import time
+import ujson as json
+
+# upper bounds of the duration histogram buckets in ms, the last bucket counts all longer commands
+LATENCY_BUCKETS_MS = (10, 50, 100, 200, 500, 1000, 2000, 5000)
+# maximal number of verbs that are recorded separately, further verbs are recorded as OTHER
+MAX_VERBS = 16
+OTHER = "other"
+
+# indices of the counters of a verb
+COUNT = 0
+FAILED = 1
+BYTES_SENT = 2
+BYTES_RECEIVED = 3
+TOTAL_MS = 4
+MAX_MS = 5
+HISTOGRAM = 6
+
+_stats = {}  # verb -> counters
+_cycles = 1  # number of cycles the counters were accumulated over
+_transcript = None  # file the AT conversation is recorded to
+
+
+def _verb(cmd: str) -> str:
+    """
+    Get the verb of an AT command, i.e. the command without parameters.
+    "AT+CSIM=10,..." -> "AT+CSIM", "AT+CFUN?" -> "AT+CFUN?"
+    """
+    idx = cmd.find('=')
+    if idx >= 0:
+        cmd = cmd[:idx]
+    return cmd[:16]
+
+
+def _counters(verb: str) -> list:
+    counters = _stats.get(verb)
+    if counters is None:
+        if len(_stats) >= MAX_VERBS - 1 and verb != OTHER:
+            return _counters(OTHER)
+        counters = [0] * (HISTOGRAM + len(LATENCY_BUCKETS_MS) + 1)
+        _stats[verb] = counters
+    return counters
+
+
+def record(cmd: str, response: str, duration_ms: int):
+    """
+    Record an AT command.
+    :param cmd: the AT command
+    :param response: the raw response of the modem
+    :param duration_ms: the time it took the modem to respond in ms
+    """
+    counters = _counters(_verb(cmd))
+    counters[COUNT] += 1
+    if not response.rstrip().endswith('OK'):
+        counters[FAILED] += 1
+    counters[BYTES_SENT] += len(cmd)
+    counters[BYTES_RECEIVED] += len(response)
+    counters[TOTAL_MS] += duration_ms
+    if duration_ms > counters[MAX_MS]:
+        counters[MAX_MS] = duration_ms
+
+    bucket = 0
+    while bucket < len(LATENCY_BUCKETS_MS) and duration_ms >= LATENCY_BUCKETS_MS[bucket]:
+        bucket += 1
+    counters[HISTOGRAM + bucket] += 1
+
+
+def send_at_cmd(lte, cmd: str) -> str:
+    """
+    Send an AT command to the modem and record it.
+    :param lte: the LTE instance
+    :param cmd: the AT command
+    :return: the raw response of the modem
+    """
+    start = time.ticks_ms()
+    response = lte.send_at_cmd(cmd)
+    duration_ms = time.ticks_diff(time.ticks_ms(), start)
+    record(cmd, response, duration_ms)
+    if _transcript is not None:
+        _transcript.write(json.dumps({'cmd': cmd, 'response': response, 'ms': duration_ms}) + "\n")
+        _transcript.flush()  # keep the transcript up to the last command, in case of a reset
+    return response
+
+
+def start_recording(file: str):
+    """
+    Record all following AT commands with their responses and durations into a transcript file.
+    An existing transcript in the file is overwritten.
+    :param file: the transcript file
+    """
+    global _transcript
+    stop_recording()
+    _transcript = open(file, "w")
+
+
+def stop_recording():
+    """
+    Stop recording AT commands and close the transcript file.
+    """
+    global _transcript
+    if _transcript is not None:
+        _transcript.close()
+        _transcript = None
+
+
+def recording() -> bool:
+    """
+    :return: if AT commands are currently recorded
+    """
+    return _transcript is not None
+
+
+def reset():
+    """
+    Reset all counters.
+    """
+    global _cycles
+    _stats.clear()
+    _cycles = 1
+
+
+def summary() -> dict:
+    """
+    Get the counters, e.g. to send them as telemetry.
+    :return: a dict with the number of cycles, the histogram buckets and a list of counters per verb,
+             in the order count, failed, bytes sent, bytes received, total ms, max ms, histogram
+    """
+    return {
+        'cycles': _cycles,
+        'buckets_ms': list(LATENCY_BUCKETS_MS),
+        'verbs': _stats
+    }
+
+
+def load(file: str):
+    """
+    Add the counters of previous cycles stored in a file to the current counters.
+    Does nothing if the file does not exist or is invalid.
+    :param file: the file the counters were saved to
+    """
+    global _cycles
+    try:
+        with open(file, "r") as f:
+            saved = json.load(f)
+        if saved['buckets_ms'] != list(LATENCY_BUCKETS_MS):
+            return
+        for verb, saved_counters in saved['verbs'].items():
+            counters = _counters(verb)
+            for i in range(len(counters)):
+                if i == MAX_MS:
+                    counters[i] = max(counters[i], saved_counters[i])
+                else:
+                    counters[i] += saved_counters[i]
+        _cycles += saved['cycles']
+    except (OSError, ValueError, KeyError, IndexError):
+        pass
+
+
+def save(file: str):
+    """
+    Save the counters to a file, so they can be accumulated with load() in the next cycle.
+    :param file: the file to save the counters to
+    """
+    with open(file, "w") as f:
+        json.dump(summary(), f)
+
+
+def dump() -> str:
+    """
+    Format the counters as a table for the log.
+    :return: the table
+    """
+    lines = ["AT command statistics ({} cycle(s)):".format(_cycles)]
+    header = "{:<16s} {:>6s} {:>5s} {:>8s} {:>8s} {:>9s} {:>7s} |".format(
+        "verb", "count", "fail", "sent", "recv", "total ms", "max ms")
+    for bound in LATENCY_BUCKETS_MS:
+        header += " {:>5s}".format("<" + str(bound))
+    header += " {:>5s}".format(">=" + str(LATENCY_BUCKETS_MS[-1]))
+    lines.append(header)
+
+    for verb in sorted(_stats):
+        c = _stats[verb]
+        line = "{:<16s} {:>6d} {:>5d} {:>8d} {:>8d} {:>9d} {:>7d} |".format(
+            verb, c[COUNT], c[FAILED], c[BYTES_SENT], c[BYTES_RECEIVED], c[TOTAL_MS], c[MAX_MS])
+        for n in c[HISTOGRAM:]:
+            line += " {:>5d}".format(n)
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,245 @@
+"""
+Durable store-and-forward queue for the messages that have to be sent to the backend.
+
+The messages are appended to a log file (on flash or SD card) and stay there until the backend
+accepted them, so they survive failed cycles and resets. Every record has a header with a
+sequence number, the kind of the message, its length and a CRC32 over header and message, so
+a record that was only partially written (reset while appending) is detected and dropped when
+the file is loaded.
+
+The sequence number of the last acknowledged (sent) record is stored in a separate file, which
+is replaced via a temporary file. Acknowledged records are removed by compaction, which copies
+the remaining records into a temporary file that replaces the log file. The size of the log is
+bounded, if it is full, the oldest records are dropped.
+"""
+import os
+import struct
+import ubinascii
+
+KIND_DATA = 1  # data message for the ubirch data service
+KIND_UPP = 2  # UPP for the ubirch authentication service
+KIND_MEASUREMENT = 3  # measurement that was not sealed yet (buffered reporting)
+KIND_DATA_PROOF = 4  # data message with its merkle inclusion proof in front, see merkle.encode_proof()
+KIND_MEASUREMENT_MSGPACK = 5  # measurement that was not sealed yet, msgpack encoded (data_format "msgpack")
+
+_HEADER = ">IBHI"  # sequence number, kind, length, CRC32
+_HEADER_SIZE = 11
+
+
+def _crc32_fallback(data, crc=0):
+    crc ^= 0xffffffff
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0xedb88320 & -(crc & 1))
+    return crc ^ 0xffffffff
+
+
+# ubinascii.crc32 is not enabled in every firmware
+_crc32 = getattr(ubinascii, "crc32", _crc32_fallback)
+
+
+def _exists(file: str) -> bool:
+    try:
+        os.stat(file)
+        return True
+    except OSError:
+        return False
+
+
+def _remove(file: str):
+    try:
+        os.remove(file)
+    except OSError:
+        pass
+
+
+def _recover(file: str, tmp: str):
+    """Finish an interrupted replacement of a file by a temporary file."""
+    if _exists(tmp):
+        if _exists(file):
+            _remove(tmp)  # interrupted before the file was removed, it is still complete
+        else:
+            os.rename(tmp, file)
+
+
+class Backlog:
+    """
+    Append-only queue of messages on flash, see module description.
+    """
+
+    def __init__(self, file: str, max_size: int = 32 * 1024):
+        """
+        Load the backlog from a file, records after a partially written record are dropped.
+        :param file: the log file, the files <file>.ack and <file>.tmp are used as well
+        :param max_size: the maximal size of the log file in bytes
+        """
+        self.file = file
+        self.max_size = max_size
+        self._ack_file = file + ".ack"
+        self._tmp_file = file + ".tmp"
+        self._records = []  # [sequence number, kind, offset, length] of the unacknowledged records
+        self._size = 0  # size of the log file
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def pending_size(self) -> int:
+        """
+        :return: the number of bytes of the unacknowledged records
+        """
+        return sum(_HEADER_SIZE + r[3] for r in self._records)
+
+    def free(self) -> int:
+        """
+        :return: the maximal size of a message that can be appended without dropping older ones
+        """
+        return max(0, self.max_size - self.pending_size() - _HEADER_SIZE)
+
+    ###############
+    #   loading   #
+    ###############
+
+    def _load(self):
+        _recover(self._ack_file, self._ack_file + ".tmp")
+        _recover(self.file, self._tmp_file)
+
+        self._acked = 0
+        try:
+            with open(self._ack_file, "r") as f:
+                self._acked = int(f.read())
+        except (OSError, ValueError):
+            pass
+
+        last = self._acked
+        try:
+            with open(self.file, "rb") as f:
+                while True:
+                    header = f.read(_HEADER_SIZE)
+                    if len(header) < _HEADER_SIZE:
+                        break
+                    seq, kind, length, crc = struct.unpack(_HEADER, header)
+                    data = f.read(length)
+                    if len(data) < length or _crc32(data, _crc32(header[:7])) != crc:
+                        break
+                    if seq > self._acked:
+                        self._records.append([seq, kind, self._size + _HEADER_SIZE, length])
+                    if seq > last:
+                        last = seq
+                    self._size += _HEADER_SIZE + length
+            file_size = os.stat(self.file)[6]
+        except OSError:
+            file_size = 0
+        self._next_seq = last + 1
+
+        if file_size != self._size:
+            # partially written record at the end of the file
+            print("** backlog: dropping {} bytes of an incomplete record".format(file_size - self._size))
+            self._compact()
+        elif not self._records and self._size:
+            self._compact()
+
+    ###############
+    #    queue    #
+    ###############
+
+    def append(self, kind: int, data: bytes) -> int:
+        """
+        Append a message to the backlog. If the backlog is full, the oldest messages are dropped.
+        :param kind: the kind of the message, e.g. KIND_DATA or KIND_UPP
+        :param data: the message
+        :return: the sequence number of the message
+        """
+        needed = _HEADER_SIZE + len(data)
+        if needed > self.max_size or len(data) > 0xffff:
+            raise ValueError("message too large for the backlog: {} bytes".format(len(data)))
+
+        if self._size + needed > self.max_size:
+            # drop the oldest records, if the acknowledged ones are not enough
+            pending = self.pending_size()
+            dropped = 0
+            while pending + needed > self.max_size:
+                record = self._records.pop(0)
+                pending -= _HEADER_SIZE + record[3]
+                dropped += 1
+            if dropped:
+                self._store_ack(record[0])
+                print("** backlog full, dropped {} oldest message(s)".format(dropped))
+            self._compact()
+
+        seq = self._next_seq
+        crc = _crc32(data, _crc32(struct.pack(">IBH", seq, kind, len(data))))
+        header = struct.pack(_HEADER, seq, kind, len(data), crc)
+        with open(self.file, "ab") as f:
+            f.write(header)
+            f.write(data)
+        self._records.append([seq, kind, self._size + _HEADER_SIZE, len(data)])
+        self._size += needed
+        self._next_seq += 1
+        return seq
+
+    def peek(self, count: int) -> [(int, int, bytes)]:
+        """
+        Get the oldest unacknowledged messages, without removing them.
+        :param count: the maximal number of messages
+        :return: a list of (sequence number, kind, message)
+        """
+        items = []
+        if not self._records:
+            return items
+        with open(self.file, "rb") as f:
+            for seq, kind, offset, length in self._records[:count]:
+                f.seek(offset)
+                items.append((seq, kind, f.read(length)))
+        return items
+
+    def ack(self, seq: int):
+        """
+        Acknowledge all messages up to a sequence number, e.g. after they were sent successfully.
+        :param seq: the sequence number of the last sent message
+        """
+        count = 0
+        while count < len(self._records) and self._records[count][0] <= seq:
+            count += 1
+        if not count:
+            return
+        del self._records[:count]
+        self._store_ack(seq)
+
+        if not self._records:
+            _remove(self.file)
+            self._size = 0
+        elif self.pending_size() < self._size // 2:
+            self._compact()
+
+    ###############
+    #   storage   #
+    ###############
+
+    def _store_ack(self, seq: int):
+        """Store the sequence number of the last acknowledged record, replacing the file via a temporary file."""
+        self._acked = seq
+        tmp = self._ack_file + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(seq))
+        _remove(self._ack_file)
+        os.rename(tmp, self._ack_file)
+
+    def _compact(self):
+        """Rewrite the log file with the unacknowledged records only."""
+        if not self._records:
+            _remove(self.file)
+            self._size = 0
+            return
+
+        size = 0
+        with open(self.file, "rb") as src, open(self._tmp_file, "wb") as dst:
+            for record in self._records:
+                src.seek(record[2] - _HEADER_SIZE)
+                dst.write(src.read(_HEADER_SIZE + record[3]))
+                record[2] = size + _HEADER_SIZE
+                size += _HEADER_SIZE + record[3]
+        _remove(self.file)
+        os.rename(self._tmp_file, self.file)
+        self._size = size
@@ -0,0 +1,127 @@
+"""
+Compact sorted (canonical) JSON rendering of the data messages.
+
+The micropython implementation of ujson.dumps does not support sorted keys, so the hash of
+a message would depend on the order of the dict. The rendering here is deterministic:
+  - no whitespace, the keys of objects have to be strings and are sorted
+  - strings are escaped as required by JSON (non-ASCII characters are kept as UTF-8)
+  - floats are rendered as strings with two decimals ("23.45"), like the former serializer of the testkit
+  - None, True and False are rendered as null, true and false, lists and tuples as arrays
+Other types raise an exception. The message is rendered into one preallocated buffer, which only
+grows for messages larger than any before, so a rendering allocates the encoded parts and the
+result, but no intermediate strings (which would take memory quadratic in the size of the message
+and fragment the heap).
+"""
+
+import ure as re
+
+_buf = bytearray(512)
+
+# characters that have to be escaped, except NUL, which the micropython re module does not support in patterns
+_ESCAPED = re.compile('[\x01-\x1f"\\\\]')
+
+_ESCAPES = {'"': b'\\"', '\\': b'\\\\', '\b': b'\\b', '\f': b'\\f', '\n': b'\\n', '\r': b'\\r', '\t': b'\\t'}
+
+
+def _put(idx: int, data: bytes) -> int:
+    """Write data into the buffer at idx, return the index after the data."""
+    global _buf
+    end = idx + len(data)
+    if end > len(_buf):
+        _buf = _buf + bytearray(end + len(_buf))
+    _buf[idx:end] = data
+    return end
+
+
+def _plain(value: str) -> bool:
+    """Check whether a string needs no escaping."""
+    return _ESCAPED.search(value) is None and "\x00" not in value
+
+
+def _put_str(idx: int, value: str) -> int:
+    """Write a string in quotes, with the characters escaped that JSON requires to be escaped."""
+    if _plain(value):
+        # the usual strings (keys, UUIDs) need no escaping
+        return _put(idx, ('"%s"' % value).encode())
+    idx = _put(idx, b'"')
+    start = 0
+    for i, c in enumerate(value):
+        if c < " " or c == '"' or c == '\\':
+            idx = _put(idx, value[start:i].encode())
+            escape = _ESCAPES.get(c)
+            idx = _put(idx, escape if escape is not None else b"\\u%04x" % ord(c))
+            start = i + 1
+    return _put(idx, value[start:].encode() + b'"')
+
+
+def _dump_dict(value: dict, idx: int) -> int:
+    separator = "{"
+    for key in sorted(value):
+        if type(key) is not str:
+            raise Exception("unsupported key type {} for serialization in json message".format(type(key)))
+        if _ESCAPED.search(key) is not None or "\x00" in key:  # not _plain(key), inlined in the loop
+            idx = _dump(value[key], _put(_put_str(_put(idx, separator.encode()), key), b":"))
+            separator = ","
+            continue
+        # the usual entries (a key without escapes and a number or string) are rendered in one piece
+        item = value[key]
+        item_type = type(item)
+        if item_type is int:
+            idx = _put(idx, ('%s"%s":%d' % (separator, key, item)).encode())
+        elif item_type is float:
+            idx = _put(idx, ('%s"%s":"%.2f"' % (separator, key, item)).encode())
+        elif item_type is str and _ESCAPED.search(item) is None and "\x00" not in item:
+            idx = _put(idx, ('%s"%s":"%s"' % (separator, key, item)).encode())
+        elif item is None:
+            idx = _put(idx, ('%s"%s":null' % (separator, key)).encode())
+        else:
+            idx = _dump(item, _put(idx, ('%s"%s":' % (separator, key)).encode()))
+        separator = ","
+    return _put(idx, b"}" if value else b"{}")
+
+
+def _dump(value, idx: int) -> int:
+    """Render a value into the buffer at idx, return the index after the rendering."""
+    value_type = type(value)
+    if value_type is dict:
+        return _dump_dict(value, idx)
+    if value_type is str:
+        return _put_str(idx, value)
+    if value_type is int:
+        return _put(idx, b"%d" % value)
+    if isinstance(value, float):
+        return _put(idx, b'"%.2f"' % value)
+    if value_type is list or value_type is tuple:
+        separator = b"["
+        for item in value:
+            idx = _dump(item, _put(idx, separator))
+            separator = b","
+        return _put(idx, b"]" if value else b"[]")
+    if value is None:
+        return _put(idx, b"null")
+    if value is True:
+        return _put(idx, b"true")
+    if value is False:
+        return _put(idx, b"false")
+    raise Exception("unsupported data type {} for serialization in json message".format(value_type))
+
+
+def dump(value, write):
+    """
+    Render a value canonically, see module description.
+    :param value: the value to render, e.g. the dict of a message
+    :param write: function the rendering is written to in one call, e.g. the write of a file or
+                  socket. It gets a memoryview of the buffer, which is only valid during the call.
+    """
+    end = _dump(value, 0)
+    write(memoryview(_buf)[:end])
+
+
+def dumps(value) -> bytes:
+    """
+    Render a value canonically, see module description.
+    :param value: the value to render, e.g. the dict of a message
+    :return: the compact sorted rendering
+    """
+    end = _dump(value, 0)
+    return bytes(memoryview(_buf)[:end])
@@ -0,0 +1,198 @@
+"""
+Deterministic (canonical) msgpack encoding of data messages.
+
+The same value is always encoded to the same bytes, so the hash of a message is reproducible:
+  - integers, strings, binaries, arrays and maps use the shortest msgpack format
+  - the keys of maps have to be strings and are sorted (like the keys of the JSON messages)
+  - floats are encoded as float 32 if that is exact (always on the Pycom boards, whose floats are
+    single precision), otherwise as float 64
+  - bool and None are encoded as true/false and nil, bytes and bytearray as bin, lists and tuples as array
+Other types raise a TypeError. unpackb() decodes the messages (and any other msgpack without ext types).
+"""
+import struct
+
+
+def packb(obj) -> bytes:
+    """
+    Encode an object canonically, see module description.
+    :param obj: the object to encode
+    :return: the msgpack encoded object
+    """
+    buf = bytearray()
+    _pack(obj, buf)
+    return bytes(buf)
+
+
+def _pack_length(buf: bytearray, length: int, fix: int, fix_max: int, formats: tuple):
+    """Append the type and length of a str, bin, array or map, formats are the (code, struct format) by size."""
+    if length <= fix_max:
+        buf.append(fix | length)
+        return
+    for code, fmt, limit in formats:
+        if length <= limit:
+            buf.append(code)
+            buf.extend(struct.pack(fmt, length))
+            return
+    raise ValueError("object too large for msgpack: {}".format(length))
+
+
+_STR = ((0xd9, ">B", 0xff), (0xda, ">H", 0xffff), (0xdb, ">I", 0xffffffff))
+_BIN = ((0xc4, ">B", 0xff), (0xc5, ">H", 0xffff), (0xc6, ">I", 0xffffffff))
+_ARRAY = ((0xdc, ">H", 0xffff), (0xdd, ">I", 0xffffffff))
+_MAP = ((0xde, ">H", 0xffff), (0xdf, ">I", 0xffffffff))
+
+
+def _pack(obj, buf: bytearray):
+    t = type(obj)
+    if obj is None:
+        buf.append(0xc0)
+    elif obj is True:
+        buf.append(0xc3)
+    elif obj is False:
+        buf.append(0xc2)
+    elif t is int:
+        if 0 <= obj <= 0x7f:
+            buf.append(obj)
+        elif -32 <= obj < 0:
+            buf.append(obj & 0xff)
+        elif obj > 0:
+            if obj <= 0xff:
+                buf.append(0xcc)
+                buf.append(obj)
+            elif obj <= 0xffff:
+                buf.append(0xcd)
+                buf.extend(struct.pack(">H", obj))
+            elif obj <= 0xffffffff:
+                buf.append(0xce)
+                buf.extend(struct.pack(">I", obj))
+            elif obj <= 0xffffffffffffffff:
+                buf.append(0xcf)
+                buf.extend(struct.pack(">Q", obj))
+            else:
+                raise ValueError("integer too large for msgpack: {}".format(obj))
+        elif obj >= -0x80:
+            buf.append(0xd0)
+            buf.extend(struct.pack(">b", obj))
+        elif obj >= -0x8000:
+            buf.append(0xd1)
+            buf.extend(struct.pack(">h", obj))
+        elif obj >= -0x80000000:
+            buf.append(0xd2)
+            buf.extend(struct.pack(">i", obj))
+        elif obj >= -0x8000000000000000:
+            buf.append(0xd3)
+            buf.extend(struct.pack(">q", obj))
+        else:
+            raise ValueError("integer too large for msgpack: {}".format(obj))
+    elif t is float:
+        single = struct.pack(">f", obj)
+        if struct.unpack(">f", single)[0] == obj:
+            buf.append(0xca)
+            buf.extend(single)
+        else:
+            buf.append(0xcb)
+            buf.extend(struct.pack(">d", obj))
+    elif t is str:
+        data = obj.encode()
+        _pack_length(buf, len(data), 0xa0, 31, _STR)
+        buf.extend(data)
+    elif t is bytes or t is bytearray:
+        _pack_length(buf, len(obj), 0, -1, _BIN)
+        buf.extend(obj)
+    elif t is list or t is tuple:
+        _pack_length(buf, len(obj), 0x90, 15, _ARRAY)
+        for item in obj:
+            _pack(item, buf)
+    elif t is dict:
+        _pack_length(buf, len(obj), 0x80, 15, _MAP)
+        for key in sorted(obj):
+            if type(key) is not str:
+                raise TypeError("unsupported key type {} in msgpack map".format(type(key)))
+            _pack(key, buf)
+            _pack(obj[key], buf)
+    else:
+        raise TypeError("unsupported data type {} for msgpack".format(t))
+
+
+def unpackb(data: bytes):
+    """
+    Decode a msgpack encoded object, str is decoded to str and bin to bytes.
+    :param data: the msgpack encoded object
+    :return: the object
+    """
+    obj, end = _unpack(memoryview(data), 0)
+    if end != len(data):
+        raise ValueError("extra data after msgpack object")
+    return obj
+
+
+def _unpack_length(data, pos: int, size: int) -> (int, int):
+    return struct.unpack(">" + "BHI"[size >> 1], data[pos:pos + size])[0], pos + size
+
+
+def _unpack(data, pos: int):
+    """Decode the object at pos, returns the object and the position after it."""
+    if pos >= len(data):
+        raise ValueError("truncated msgpack object")
+    b = data[pos]
+    pos += 1
+    if b <= 0x7f:
+        return b, pos
+    if b >= 0xe0:
+        return b - 0x100, pos
+    if 0xa0 <= b <= 0xbf:
+        return _str(data, pos, b & 0x1f)
+    if 0x90 <= b <= 0x9f:
+        return _array(data, pos, b & 0x0f)
+    if 0x80 <= b <= 0x8f:
+        return _map(data, pos, b & 0x0f)
+    if b == 0xc0:
+        return None, pos
+    if b == 0xc2:
+        return False, pos
+    if b == 0xc3:
+        return True, pos
+    if 0xc4 <= b <= 0xc6:
+        length, pos = _unpack_length(data, pos, 1 << (b - 0xc4))
+        if pos + length > len(data):
+            raise ValueError("truncated msgpack object")
+        return bytes(data[pos:pos + length]), pos + length
+    if 0xd9 <= b <= 0xdb:
+        length, pos = _unpack_length(data, pos, 1 << (b - 0xd9))
+        return _str(data, pos, length)
+    if b == 0xdc or b == 0xdd:
+        length, pos = _unpack_length(data, pos, 2 if b == 0xdc else 4)
+        return _array(data, pos, length)
+    if b == 0xde or b == 0xdf:
+        length, pos = _unpack_length(data, pos, 2 if b == 0xde else 4)
+        return _map(data, pos, length)
+    fmt = {0xca: ">f", 0xcb: ">d", 0xcc: ">B", 0xcd: ">H", 0xce: ">I", 0xcf: ">Q",
+           0xd0: ">b", 0xd1: ">h", 0xd2: ">i", 0xd3: ">q"}.get(b)
+    if fmt is None:
+        raise ValueError("unsupported msgpack type 0x{:02x}".format(b))
+    size = struct.calcsize(fmt)
+    if pos + size > len(data):
+        raise ValueError("truncated msgpack object")
+    return struct.unpack(fmt, data[pos:pos + size])[0], pos + size
+
+
+def _str(data, pos: int, length: int):
+    if pos + length > len(data):
+        raise ValueError("truncated msgpack object")
+    return str(bytes(data[pos:pos + length]), "utf-8"), pos + length
+
+
+def _array(data, pos: int, length: int):
+    items = []
+    for _ in range(length):
+        item, pos = _unpack(data, pos)
+        items.append(item)
+    return items, pos
+
+
+def _map(data, pos: int, length: int):
+    obj = {}
+    for _ in range(length):
+        key, pos = _unpack(data, pos)
+        obj[key], pos = _unpack(data, pos)
+    return obj, pos
@@ -35,6 +35,17 @@ def load_config(sd_card_mounted: bool = False) -> dict:
         "CSR_country": "DE",
         "CSR_organization": "ubirch GmbH",
         "interval": <measure interval in seconds>,
+        "sim_keep_channel": <true or false, keep the SIM channel open during deepsleep and resume it after wake-up>,
+        "at_stats": <true or false, accumulate AT command statistics over cycles in a file and log them>,
+        "at_record": <true or false, record the AT commands of each cycle in a transcript file>,
+        "dns_cache_ttl": <seconds the resolved addresses of the backend hosts are cached on flash, 0 to disable>,
+        "http_timeout": <timeout of every phase (DNS, connect, TLS handshake, first byte, body) of the backend requests in seconds>,
+        "http_async": <true or false, send the data message and the UPP at the same time (requires uasyncio)>,
+        "http_batch": <maximal number of messages sent with one batch request, 0 to send every message on its own>,
+        "backlog_size_kb": <maximal size of the backlog of messages that could not be sent yet in kB>,
+        "transmit_every": <number of cycles the measurements are stored before they are sealed and sent>,
+        "data_format": <'json' or 'msgpack', format of the data messages for the ubirch data service>,
+        "merkle_batch": <true or false, seal the data messages of a cycle with one UPP over the root of a merkle tree>,
         "debug": <true or false>
     }
     :param user_config: the user config file
@@ -69,7 +80,9 @@ def load_config(sd_card_mounted: bool = False) -> dict:
         cfg['niomon'] = NIOMON_SERVICE.format(cfg['env'])
 
     # now make sure the env key has the actual environment value that is used in the URL
-    cfg['env'] = cfg['niomon'].split(".")[1]
+    # (unless the service is not a ubirch backend, e.g. tools/backend_server.py)
+    if ".ubirch.com" in cfg['niomon']:
+        cfg['env'] = cfg['niomon'].split(".")[1]
     if cfg['env'] not in ["dev", "demo", "prod"]:
         raise Exception("invalid ubirch backend environment \"{}\"".format(cfg['env']))
 
@@ -77,7 +90,10 @@ def load_config(sd_card_mounted: bool = False) -> dict:
     if 'data' not in cfg:
         cfg['data'] = DATA_SERVICE.format(cfg['env'])
     else:
-        cfg['data'] = cfg['data'].rstrip("/msgPack")
+        # the endpoint (json or msgPack) is appended depending on the data format
+        for suffix in ("/msgPack", "/json"):
+            if cfg['data'].endswith(suffix):
+                cfg['data'] = cfg['data'][:-len(suffix)]
 
     if 'bootstrap' not in cfg:
         cfg['bootstrap'] = BOOTSTRAP_SERVICE.format(cfg['env'])
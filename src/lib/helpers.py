@@ -1,7 +1,11 @@
 import machine
 import os
+import pycom
 import time
 
+import canonical_json
+import urequests
+from backlog import Backlog, KIND_DATA, KIND_UPP, KIND_MEASUREMENT, KIND_DATA_PROOF, KIND_MEASUREMENT_MSGPACK
 from connection import Connection
 from modem import reset_modem
 from network import LTE
@@ -43,6 +47,27 @@ def get_pin_from_flash(pin_file: str, imsi: str) -> str or None:
         return None
 
 
+def nvs_get(key: str, default=None):
+    """
+    Get a value from the non-volatile storage, returns default if the key does not exist
+    """
+    try:
+        value = pycom.nvs_get(key)
+    except ValueError:  # depending on the firmware version, a missing key raises an error or returns None
+        return default
+    return default if value is None else value
+
+
+def nvs_set(key: str, value: int or None):
+    """
+    Store a value in the non-volatile storage, erases the key if value is None
+    """
+    if value is not None:
+        pycom.nvs_set(key, value)
+    elif nvs_get(key) is not None:
+        pycom.nvs_erase(key)
+
+
 def send_backend_data(sim: ubirch.SimProtocol, lte: LTE, conn: Connection, api_function, uuid, data) -> (int, bytes):
     MAX_MODEM_RESETS = 1  # number of retries with modem reset before giving up
     MAX_RECONNECTS = 1  # number of retries with reconnect before trying a modem reset
@@ -52,6 +77,7 @@ def send_backend_data(sim: ubirch.SimProtocol, lte: LTE, conn: Connection, api_f
         if reset_attempts > 0:
             print("\tretrying with modem reset")
             sim.deinit()
+            urequests.close_all()  # the pooled keep-alive connections don't survive the modem reset
             reset_modem(lte)  # TODO: should probably be connection.reset_hardware()
             conn.connect()
 
@@ -61,6 +87,7 @@ def send_backend_data(sim: ubirch.SimProtocol, lte: LTE, conn: Connection, api_f
                 # check if this is a retry for send_attempts
                 if send_attempts > 0:
                     print("\tretrying with disconnect/reconnect")
+                    urequests.close_all()  # the pooled keep-alive connections don't survive the reconnect
                     conn.disconnect()
                     conn.connect()
                 try:
@@ -81,6 +108,203 @@ def send_backend_data(sim: ubirch.SimProtocol, lte: LTE, conn: Connection, api_f
         raise Exception("could not establish connection to backend")
 
 
+def send_backend_data_concurrently(sim: ubirch.SimProtocol, lte: LTE, conn: Connection, wdt, sends: list) -> list:
+    """
+    Send several messages to the backend at the same time (e.g. the data message and the UPP),
+    so their round trips overlap. The watchdog is fed while the requests are in flight, so the
+    requests need a timeout. Messages that could not be sent are sent again one after the other
+    with send_backend_data(), with reconnects and modem resets if necessary.
+    Requires uasyncio.
+    :param wdt: the watchdog
+    :param sends: a list of (async API function, API function, uuid, data), e.g.
+                  (async_api.send_upp, api.send_upp, uuid, upp)
+    :return: a list with the response status code and content of every message
+    """
+    import urequests_async
+
+    print("\tsending {} messages...".format(len(sends)))
+    results = urequests_async.run_all([async_function(uuid, data) for async_function, _, uuid, data in sends], wdt)
+    for i, (_, api_function, uuid, data) in enumerate(sends):
+        if isinstance(results[i], Exception):
+            print("\tsending failed: {}".format(results[i]))
+            results[i] = send_backend_data(sim, lte, conn, api_function, uuid, data)
+    return results
+
+
+def send_backend_batch(sim: ubirch.SimProtocol, lte: LTE, conn: Connection, wdt, api: ubirch.API, uuid: UUID,
+                       items: list, async_api: ubirch.API = None) -> list:
+    """
+    Send messages from the backlog with one batch request for the data messages and one for the UPPs,
+    with reconnects/modem resets if necessary (see API.send_data_batch() and API.send_upp_batch()).
+    :param items: a list of (sequence number, kind, message) from the backlog
+    :param async_api: an AsyncAPI to send both batch requests at the same time, None to send them
+                      one after the other
+    :return: a list with the response status code and content of every message
+    """
+    from merkle import decode_proof
+
+    data, messages, proofs, upps = [], [], [], []
+    for i, (_, kind, record) in enumerate(items):
+        if kind == KIND_UPP:
+            upps.append(i)
+            continue
+        data.append(i)
+        if kind == KIND_DATA_PROOF:
+            end = decode_proof(record)[3]
+            proofs.append(record[:end])
+            messages.append(record[end:])
+        else:
+            proofs.append(None)
+            messages.append(record)
+
+    def send_data_batch(uuid, batch):
+        return api.send_data_batch(uuid, batch, proofs)
+
+    def send_data_batch_async(uuid, batch):
+        return async_api.send_data_batch(uuid, batch, proofs)
+
+    # (indices of the items, async API function, API function, messages) of the batch requests
+    batches = []
+    if data:
+        batches.append((data, send_data_batch_async, send_data_batch, messages))
+    if upps:
+        batches.append((upps, None if async_api is None else async_api.send_upp_batch, api.send_upp_batch,
+                        [items[i][2] for i in upps]))
+
+    print("\tsending {} data messages and {} UPPs...".format(len(data), len(upps)))
+    if async_api is not None:
+        results = send_backend_data_concurrently(sim, lte, conn, wdt, [(async_function, api_function, uuid, batch)
+                                                                       for _, async_function, api_function, batch in batches])
+    else:
+        results = [send_backend_data(sim, lte, conn, api_function, uuid, batch) for _, _, api_function, batch in batches]
+
+    responses = [None] * len(items)
+    for (indices, _, _, _), batch_results in zip(batches, results):
+        for i, result in zip(indices, batch_results):
+            responses[i] = result
+    return responses
+
+
+def _accepted(status_code: int) -> bool:
+    # 409: the backend already received the message (e.g. the UPP was sent before a reset)
+    return 200 <= status_code < 300 or status_code == 409
+
+
+def send_backlog(sim: ubirch.SimProtocol, lte: LTE, conn: Connection, wdt, backlog: Backlog, uuid: UUID,
+                 api: ubirch.API, async_api: ubirch.API = None, batch_size: int = 4, batch: bool = False) -> str or None:
+    """
+    Send the messages in the backlog to the backend in batches, oldest first, with reconnects/modem
+    resets if necessary. The messages the backend accepted are removed from the backlog. Sending stops
+    at the first message the backend did not accept, it stays in the backlog for the next cycle.
+    :param async_api: an AsyncAPI to send the data messages of a batch at the same time (and at the same
+                      time as the UPPs, which are still sent one after the other to keep the order of
+                      the UPP chain), None to send all messages one after the other
+    :param batch_size: the number of messages read from the backlog at once
+    :param batch: send the data messages and the UPPs of a batch with one request each (batch endpoints
+                  of the backend), instead of one request per message (with an AsyncAPI, the two
+                  requests are sent at the same time)
+    :return: None if all messages were sent, otherwise the error returned by the backend
+    """
+    names = {KIND_DATA: "data", KIND_UPP: "UPP", KIND_DATA_PROOF: "data"}
+    functions = {KIND_DATA: api.send_data, KIND_UPP: api.send_upp, KIND_DATA_PROOF: api.send_data_with_proof}
+
+    def send_upps(uuid, upps):
+        # one after the other, up to the first UPP the backend does not accept, to keep the chain in order
+        results = []
+        for upp in upps:
+            results.append(api.send_upp(uuid, upp))
+            if not _accepted(results[-1][0]):
+                break
+        return results
+
+    async def send_upps_async(uuid, upps):
+        results = []
+        for upp in upps:
+            results.append(await async_api.send_upp(uuid, upp))
+            if not _accepted(results[-1][0]):
+                break
+        return results
+
+    print("\t{} message(s) in backlog".format(len(backlog)))
+    while len(backlog):
+        items = backlog.peek(batch_size)
+
+        responses = None
+        if batch:
+            responses = send_backend_batch(sim, lte, conn, wdt, api, uuid, items, async_api)
+        elif async_api is not None:
+            # the data messages are sent at the same time, the UPPs together in one coroutine
+            async_functions = {KIND_DATA: async_api.send_data, KIND_DATA_PROOF: async_api.send_data_with_proof}
+            data = [i for i, (_, kind, _) in enumerate(items) if kind != KIND_UPP]
+            upps = [i for i, (_, kind, _) in enumerate(items) if kind == KIND_UPP]
+            sends = [(async_functions[items[i][1]], functions[items[i][1]], uuid, items[i][2]) for i in data]
+            if upps:
+                sends.append((send_upps_async, send_upps, uuid, [items[i][2] for i in upps]))
+            results = send_backend_data_concurrently(sim, lte, conn, wdt, sends)
+
+            # the UPPs after a UPP the backend did not accept were not sent (the loop below stops before them)
+            responses = [None] * len(items)
+            for i, result in zip(data, results):
+                responses[i] = result
+            if upps:
+                for i, result in zip(upps, results[-1]):
+                    responses[i] = result
+
+        sent = None
+        try:
+            for i, (seq, kind, data) in enumerate(items):
+                if responses is not None:
+                    status_code, content = responses[i]
+                else:
+                    status_code, content = send_backend_data(sim, lte, conn, functions[kind], uuid, data)
+                if not _accepted(status_code):
+                    return "backend ({}) returned error: ({}) {}".format(names[kind], status_code, str(content))
+                sent = seq
+        finally:
+            if sent is not None:
+                backlog.ack(sent)
+    return None
+
+
+def store_measurement(measurements: Backlog, data: dict, data_format: str = "json") -> int:
+    """
+    Store a measurement with the current time, to be sealed and sent in a later cycle.
+    :param measurements: the store of the measurements
+    :param data: the measured data
+    :param data_format: the format of the data messages, "json" or "msgpack" (keeps the type of floats)
+    :return: the size of the stored record
+    """
+    measurement = {'data': data, 'timestamp': int(time.time())}
+    if data_format == "msgpack":
+        from canonical_msgpack import packb
+        record = packb(measurement)
+        measurements.append(KIND_MEASUREMENT_MSGPACK, record)
+    else:
+        record = serialize_json(measurement)
+        measurements.append(KIND_MEASUREMENT, record)
+    return len(record)
+
+
+def pack_measurements(uuid: UUID, measurements: Backlog, data_format: str = "json") -> (int, [bytes]):
+    """
+    Pack the stored measurements into data messages, with the time of the measurement.
+    :param uuid: the device UUID
+    :param measurements: the store of the measurements
+    :param data_format: the format of the data messages, "json" or "msgpack"
+    :return: the sequence number of the last measurement (to acknowledge it when the messages are sealed),
+             the data messages in the order of the measurements
+    """
+    from json import loads
+    from canonical_msgpack import unpackb
+    pack = pack_data_msgpack if data_format == "msgpack" else pack_data_json
+    items = measurements.peek(len(measurements))
+    messages = []
+    for _, kind, record in items:
+        measurement = unpackb(record) if kind == KIND_MEASUREMENT_MSGPACK else loads(record)
+        messages.append(pack(uuid, measurement['data'], measurement['timestamp']))
+    return items[-1][0], messages
+
+
 def bootstrap(imsi: str, api: ubirch.API) -> str:
     """
     Load bootstrap PIN, returns PIN
@@ -117,12 +341,13 @@ def submit_csr(key_name: str, csr_country: str, csr_organization: str, sim: ubir
     return csr
 
 
-def pack_data_json(uuid: UUID, data: dict) -> bytes:
+def pack_data_json(uuid: UUID, data: dict, timestamp: int = None) -> bytes:
     """
     Generate a JSON formatted message for the ubirch data service.
     The message contains the device UUID, timestamp and data to ensure unique hash.
     :param uuid: the device UUID
     :param data: the mapped data to be sent to the ubirch data service
+    :param timestamp: the time of the measurement, defaults to now
     :return: the msgpack formatted message
     """
     # hint for the message format (version)
@@ -132,7 +357,7 @@ def pack_data_json(uuid: UUID, data: dict) -> bytes:
     msg_map = {
         'uuid': str(uuid),
         'msg_type': MSG_TYPE,
-        'timestamp': int(time.time()),
+        'timestamp': int(time.time()) if timestamp is None else timestamp,
         'data': data
     }
 
@@ -141,33 +366,32 @@ def pack_data_json(uuid: UUID, data: dict) -> bytes:
     return serialize_json(msg_map)
 
 
+def pack_data_msgpack(uuid: UUID, data: dict, timestamp: int = None) -> bytes:
+    """
+    Generate a msgpack formatted message for the ubirch data service (msgPack endpoint).
+    The message contains the device UUID, timestamp and data to ensure unique hash, it is
+    encoded canonically (see canonical_msgpack) to ensure determinism when creating the hash.
+    :param uuid: the device UUID
+    :param data: the mapped data to be sent to the ubirch data service
+    :param timestamp: the time of the measurement, defaults to now
+    :return: the msgpack formatted message: [uuid (bin), message type, timestamp, data (map)]
+    """
+    from canonical_msgpack import packb
+
+    # hint for the message format (version)
+    MSG_TYPE = 1
+
+    return packb([uuid.bytes, MSG_TYPE, int(time.time()) if timestamp is None else timestamp, data])
+
+
 def serialize_json(msg: dict) -> bytes:
     """
     create a compact sorted rendering of a json object since micropython
-    implementation of ujson.dumps does not support sorted keys
+    implementation of ujson.dumps does not support sorted keys (see canonical_json)
     :param msg: the json object (dict) to serialize
     :return: the compact sorted rendering
     """
-    serialized = "{"
-    for key in sorted(msg):
-        serialized += "\"{}\":".format(key)
-        value = msg[key]
-        value_type = type(value)
-        if value_type is str:
-            serialized += "\"{:s}\"".format(value)
-        elif value_type is int:
-            serialized += "{:d}".format(value)
-        elif isinstance(value, float):
-            serialized += "\"{:.2f}\"".format(value)
-        elif value_type is dict:
-            serialized += serialize_json(value).decode()
-        elif value is None:
-            serialized += "null"
-        else:
-            raise Exception("unsupported data type {} for serialization in json message".format(value_type))
-        serialized += ","
-    serialized = serialized.rstrip(",") + "}"  # replace last comma with closing braces
-    return serialized.encode()
+    return canonical_json.dumps(msg)
 
 
 def get_upp_payload(upp: bytes) -> bytes:
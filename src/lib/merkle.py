@@ -0,0 +1,132 @@
+"""
+Merkle tree over a batch of data messages, to seal the whole batch with a single UPP.
+
+The tree is built as in RFC 6962 (Certificate Transparency): the hash of a leaf is
+SHA256(0x00 || message), the hash of an inner node is SHA256(0x01 || left || right), and a
+tree of n > 1 leaves is split into a left subtree with the largest power of two < n leaves
+and a right subtree with the rest. The root is sealed in a UPP instead of the hashes of the
+messages. Every message gets an inclusion proof (audit path): the hashes of the siblings on
+the path from its leaf to the root, with which the root can be recomputed from the message.
+
+A proof is encoded as
+    index (2 bytes, big endian) | tree size (2 bytes) | number of hashes (1 byte) | hashes (32 bytes each)
+so it can be stored in front of the message and sent to the data service together with it.
+"""
+import struct
+import uhashlib as hashlib
+
+HASH_SIZE = 32
+_PROOF_HEADER = ">HHB"  # index, tree size, number of hashes
+_PROOF_HEADER_SIZE = 5
+
+
+def leaf_hash(message: bytes) -> bytes:
+    """
+    :return: the hash of a leaf of the tree
+    """
+    h = hashlib.sha256(b"\x00")
+    h.update(message)
+    return h.digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    """
+    :return: the hash of an inner node of the tree
+    """
+    h = hashlib.sha256(b"\x01")
+    h.update(left)
+    h.update(right)
+    return h.digest()
+
+
+def _build(hashes: [bytes]) -> (bytes, [[bytes]]):
+    """Get the root of the subtree over the leaf hashes and the audit paths of its leaves."""
+    if len(hashes) == 1:
+        return hashes[0], [[]]
+    k = 1
+    while k * 2 < len(hashes):
+        k *= 2
+    left, left_paths = _build(hashes[:k])
+    right, right_paths = _build(hashes[k:])
+    for path in left_paths:
+        path.append(right)
+    for path in right_paths:
+        path.append(left)
+    return node_hash(left, right), left_paths + right_paths
+
+
+def build(messages: [bytes]) -> (bytes, [[bytes]]):
+    """
+    Build the tree over a batch of messages.
+    :param messages: the messages (leaves) in the order of the tree
+    :return: the root hash, the audit path (list of hashes, leaf to root) of every message
+    """
+    if not messages:
+        raise ValueError("no messages for the merkle tree")
+    if len(messages) > 0xffff:
+        raise ValueError("too many messages for the merkle tree: {}".format(len(messages)))
+    return _build([leaf_hash(message) for message in messages])
+
+
+def root_from_path(message: bytes, index: int, size: int, path: [bytes]) -> bytes or None:
+    """
+    Recompute the root hash from a message and its audit path (RFC 9162, 2.1.3.2).
+    :param message: the message
+    :param index: the index of the message in the tree
+    :param size: the number of messages in the tree
+    :param path: the audit path of the message
+    :return: the root hash, None if the path does not fit the index and size
+    """
+    if index >= size:
+        return None
+    fn = index
+    sn = size - 1
+    r = leaf_hash(message)
+    for p in path:
+        if sn == 0:
+            return None
+        if fn & 1 or fn == sn:
+            r = node_hash(p, r)
+            while not fn & 1 and fn != 0:
+                fn >>= 1
+                sn >>= 1
+        else:
+            r = node_hash(r, p)
+        fn >>= 1
+        sn >>= 1
+    return r if sn == 0 else None
+
+
+def verify(message: bytes, index: int, size: int, path: [bytes], root: bytes) -> bool:
+    """
+    Check the inclusion of a message in a tree.
+    :return: True if the audit path leads from the message to the root
+    """
+    return root_from_path(message, index, size, path) == root
+
+
+def encode_proof(index: int, size: int, path: [bytes]) -> bytes:
+    """
+    Encode an inclusion proof, see module description.
+    :param index: the index of the message in the tree
+    :param size: the number of messages in the tree
+    :param path: the audit path of the message
+    :return: the encoded proof
+    """
+    return struct.pack(_PROOF_HEADER, index, size, len(path)) + b"".join(path)
+
+
+def decode_proof(data: bytes) -> (int, int, [bytes], int):
+    """
+    Decode an inclusion proof at the start of data, e.g. a proof stored in front of a message.
+    :param data: the encoded proof, optionally followed by other data
+    :return: the index, tree size and audit path, the length of the encoded proof
+    """
+    if len(data) < _PROOF_HEADER_SIZE:
+        raise ValueError("merkle proof too short")
+    index, size, count = struct.unpack(_PROOF_HEADER, data[:_PROOF_HEADER_SIZE])
+    end = _PROOF_HEADER_SIZE + count * HASH_SIZE
+    if len(data) < end:
+        raise ValueError("merkle proof too short")
+    path = [data[i:i + HASH_SIZE] for i in range(_PROOF_HEADER_SIZE, end, HASH_SIZE)]
+    return index, size, path, end
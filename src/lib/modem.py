@@ -1,3 +1,4 @@
+import at_stats
 import time
 from network import LTE
 
@@ -6,7 +7,7 @@ def _send_at_cmd(lte: LTE, cmd: str, debug_print=True) -> []:
     result = []
     for _ in range(3):
         if debug_print: print("++ " + cmd)
-        result = [k for k in lte.send_at_cmd(cmd).split('\r\n') if len(k.strip()) > 0]
+        result = [k for k in at_stats.send_at_cmd(lte, cmd).split('\r\n') if len(k.strip()) > 0]
         if debug_print: print('-- ' + '\r\n-- '.join([r for r in result]))
 
         if result[-1] == 'OK':
@@ -1,18 +1,16 @@
+import ujson as json
 import urequests as requests
-from ubinascii import b2a_base64
+from ubinascii import a2b_base64, b2a_base64
 from uuid import UUID
 
 
-def _send_request(url: str, data: bytes, headers: dict) -> (int, bytes):
-    """
-    Send a http post request to the backend.
-    :param url: the backend service URL
-    :param data: the data to send to the backend
-    :param headers: the headers for the request
-    :return: the backend response status code, the backend response content (body)
-    """
-    r = requests.post(url=url, data=data, headers=headers)
-    return r.status_code, r.content
+# indices of the timing counters of an endpoint, followed by the total ms of the phases in requests.TIMING_PHASES
+REQUESTS = 0
+FAILED = 1
+REUSED = 2
+BYTES_SENT = 3
+BYTES_RECEIVED = 4
+PHASES = 5
 
 
 class API:
@@ -23,8 +21,13 @@ class API:
         self.env = cfg['env']
         self.identity_service_url = cfg['identity']
         self.data_service_url = cfg['data']
+        self.data_format = cfg['data_format']  # "json" or "msgpack"
+        self._data_path = "/msgPack" if self.data_format == "msgpack" else "/json"
         self.auth_service_url = cfg['niomon']
         self.bootstrap_service_url = cfg['bootstrap']
+        self.timeout = cfg['http_timeout']
+        self.timing = {}  # endpoint -> timing counters of the requests, see timing_summary()
+        self._no_batch = set()  # batch endpoints the backend does not support
         self._ubirch_headers = {
             'X-Ubirch-Credential': b2a_base64(cfg['password']).decode().rstrip('\n'),
             'X-Ubirch-Auth-Type': 'ubirch'
@@ -41,24 +44,96 @@ class API:
         if self.debug:
             print("** sending UPP to " + self.auth_service_url)
         self._ubirch_headers['X-Ubirch-Hardware-Id'] = str(uuid)
-        return _send_request(url=self.auth_service_url,
-                             data=upp,
-                             headers=self._ubirch_headers)
+        return self._send_request("upp", url=self.auth_service_url, data=upp, headers=self._ubirch_headers)
 
-    def send_data(self, uuid: UUID, message: bytes) -> (int, bytes):
+    def send_data(self, uuid: UUID, message: bytes, proof: bytes = None) -> (int, bytes):
         """
-        Send a JSON data message to the ubirch data service. Requires encoding before sending.
+        Send a data message to the ubirch data service (to the json or msgPack endpoint, depending
+        on the data format). Requires encoding before sending.
         :param uuid: the sender's UUID
         :param auth: the ubirch backend auth token (password)
-        :param message: the encoded JSON message to send to the data service
+        :param message: the encoded JSON or msgpack message to send to the data service
+        :param proof: the encoded merkle inclusion proof of the message, if it was sealed in a
+                      batch (see merkle.encode_proof()), it is sent base64 encoded in a header
         :return: the server response status code, the server response content (body)
         """
         if self.debug:
-            print("** sending data message to " + self.data_service_url + "/json")
+            print("** sending data message to " + self.data_service_url + self._data_path)
         self._ubirch_headers['X-Ubirch-Hardware-Id'] = str(uuid)
-        return _send_request(url=self.data_service_url + "/json",
-                             data=message,
-                             headers=self._ubirch_headers)
+        if proof is not None:
+            self._ubirch_headers['X-Ubirch-Merkle-Proof'] = b2a_base64(proof).decode().rstrip('\n')
+        try:
+            return self._send_request("data", url=self.data_service_url + self._data_path, data=message,
+                                      headers=self._ubirch_headers)
+        finally:
+            self._ubirch_headers.pop('X-Ubirch-Merkle-Proof', None)
+
+    def send_data_with_proof(self, uuid: UUID, record: bytes) -> (int, bytes):
+        """
+        Send a data message, which is stored with its merkle inclusion proof in front (see
+        merkle.encode_proof()), to the ubirch data service.
+        :param uuid: the sender's UUID
+        :param record: the encoded proof followed by the encoded JSON message
+        :return: the server response status code, the server response content (body)
+        """
+        from merkle import decode_proof
+        end = decode_proof(record)[3]
+        return self.send_data(uuid, record[end:], proof=record[:end])
+
+    def send_upp_batch(self, uuid: UUID, upps: [bytes]) -> [(int, bytes)]:
+        """
+        Send several UPPs to the authentication service in one request. The UPPs are concatenated
+        (msgpack framing) and posted to <niomon>/batch, the backend responds with a JSON array with
+        the {"status": <status code>, "body": <base64 encoded content>} of every UPP. If the backend
+        does not support batch requests, the UPPs are sent one by one.
+        :param uuid: the sender's UUID
+        :param upps: the msgpack encoded UPPs, in the order of the chain
+        :return: the server response status code and content (body) of every UPP
+        """
+        if "upp_batch" in self._no_batch:
+            return self._send_each(len(upps), lambda i: self.send_upp(uuid, upps[i]))
+        url = self.auth_service_url.rstrip("/") + "/batch"
+        if self.debug:
+            print("** sending {} UPPs to {}".format(len(upps), url))
+        self._ubirch_headers['X-Ubirch-Hardware-Id'] = str(uuid)
+        headers = self._ubirch_headers.copy()
+        headers['Content-Type'] = 'application/octet-stream'
+        return self._send_batch("upp_batch", url, headers, b"".join(upps), len(upps),
+                                lambda i: self.send_upp(uuid, upps[i]))
+
+    def send_data_batch(self, uuid: UUID, messages: [bytes], proofs: [bytes] = None) -> [(int, bytes)]:
+        """
+        Send several data messages to the ubirch data service in one request. The messages are
+        posted to <data>/json/batch (or <data>/msgPack/batch) as a JSON array of {"message": <the
+        message as string (base64 encoded for msgpack)>} objects (with the base64 encoded "proof",
+        if there is one), the backend responds like for send_upp_batch(). If the backend does not
+        support batch requests, the messages are sent one by one.
+        :param uuid: the sender's UUID
+        :param messages: the encoded JSON or msgpack messages
+        :param proofs: the encoded merkle inclusion proofs of the messages (None for a message without proof)
+        :return: the server response status code and content (body) of every message
+        """
+        if proofs is None:
+            proofs = [None] * len(messages)
+        if "data_batch" in self._no_batch:
+            return self._send_each(len(messages), lambda i: self.send_data(uuid, messages[i], proofs[i]))
+        url = self.data_service_url + self._data_path + "/batch"
+        if self.debug:
+            print("** sending {} data messages to {}".format(len(messages), url))
+        items = []
+        for message, proof in zip(messages, proofs):
+            if self.data_format == "msgpack":
+                item = {'message': b2a_base64(message).decode().rstrip('\n')}
+            else:
+                item = {'message': message.decode()}
+            if proof is not None:
+                item['proof'] = b2a_base64(proof).decode().rstrip('\n')
+            items.append(item)
+        self._ubirch_headers['X-Ubirch-Hardware-Id'] = str(uuid)
+        headers = self._ubirch_headers.copy()
+        headers['Content-Type'] = 'application/json'
+        return self._send_batch("data_batch", url, headers, json.dumps(items).encode(), len(messages),
+                                lambda i: self.send_data(uuid, messages[i], proofs[i]))
 
     def bootstrap_sim_identity(self, imsi: str) -> (int, bytes):
         """
@@ -71,9 +146,11 @@ class API:
         if self.debug:
             print("** bootstrapping identity {} at {}".format(imsi, self.bootstrap_service_url))
         self._ubirch_headers['X-Ubirch-IMSI'] = imsi
-        r = requests.get(url=self.bootstrap_service_url, headers=self._ubirch_headers)
-        del self._ubirch_headers['X-Ubirch-IMSI']
-        return r.status_code, r.content
+        try:
+            return self._send_request("bootstrap", url=self.bootstrap_service_url, headers=self._ubirch_headers,
+                                      method="GET")
+        finally:
+            del self._ubirch_headers['X-Ubirch-IMSI']
 
     def send_csr(self, csr: bytes) -> (int, bytes):
         """
@@ -82,6 +159,128 @@ class API:
         :return: the server response status code, the server response content (body)
         """
         if self.debug: print("** sending CSR to " + self.identity_service_url)
-        return _send_request(url=self.identity_service_url,
-                             data=csr,
-                             headers={'Content-Type': 'application/octet-stream'})
+        return self._send_request("csr", url=self.identity_service_url, data=csr,
+                                  headers={'Content-Type': 'application/octet-stream'})
+
+    def _send_request(self, endpoint: str, url: str, headers: dict, data: bytes = None,
+                      method: str = "POST") -> (int, bytes):
+        """
+        Send a http request to the backend and add its timing to the counters of the endpoint.
+        The connection is kept open for further requests to the same host. A response body larger
+        than urequests.MAX_BODY_SIZE (e.g. the error page of a proxy) is truncated, so the status
+        code is returned as a backend error instead of failing like a broken connection.
+        :param endpoint: the name of the endpoint the timing is recorded for
+        :param url: the backend service URL
+        :param headers: the headers for the request
+        :param data: the data to send to the backend
+        :param method: the http method
+        :return: the backend response status code, the backend response content (body)
+        """
+        counters = self._counters(endpoint)
+        try:
+            r = requests.request(method, url, data=data, headers=headers, keep_alive=True, timeout=self.timeout,
+                                 truncate=True)
+            content = r.content
+        except Exception:
+            counters[FAILED] += 1
+            raise
+        self._record_timing(endpoint, counters, r.timing)
+        if r.truncated and self.debug: print("** {} response body truncated".format(endpoint))
+        return r.status_code, content
+
+    def _send_batch(self, endpoint: str, url: str, headers: dict, data: bytes, count: int, send) -> [(int, bytes)]:
+        """
+        Send a batch request and split the response into the results of the items.
+        :param endpoint: the name of the batch endpoint
+        :param count: the number of items in the batch
+        :param send: function to send the item with the given index on its own, used if the backend
+                     does not support the batch endpoint (404, 405 or 501)
+        :return: the status code and content of every item, the ones of the response if it failed
+        """
+        status_code, content = self._send_request(endpoint, url=url, data=data, headers=headers)
+        if self._batch_unsupported(endpoint, status_code):
+            return self._send_each(count, send)
+        return self._batch_results(endpoint, status_code, content, count)
+
+    def _send_each(self, count: int, send) -> [(int, bytes)]:
+        """Send the items of a batch one by one, see _send_batch()."""
+        return [send(i) for i in range(count)]
+
+    def _batch_unsupported(self, endpoint: str, status_code: int) -> bool:
+        """Check if the backend does not support a batch endpoint and remember it."""
+        if status_code not in (404, 405, 501):
+            return False
+        if self.debug:
+            print("** backend does not support {} requests ({}), sending one by one".format(endpoint, status_code))
+        self._no_batch.add(endpoint)
+        return True
+
+    def _batch_results(self, endpoint: str, status_code: int, content: bytes, count: int) -> [(int, bytes)]:
+        """Split the response of a batch request into the status code and content of every item."""
+        if not 200 <= status_code < 300:
+            return [(status_code, content)] * count
+        results = json.loads(content)
+        if len(results) != count:
+            raise Exception("{} response contains {} results for {} items".format(endpoint, len(results), count))
+        return [(r['status'], a2b_base64(r['body']) if r.get('body') else b"") for r in results]
+
+    def _counters(self, endpoint: str) -> list:
+        """Get the timing counters of an endpoint and count a request."""
+        counters = self.timing.get(endpoint)
+        if counters is None:
+            counters = [0] * (PHASES + len(requests.TIMING_PHASES))
+            self.timing[endpoint] = counters
+        counters[REQUESTS] += 1
+        return counters
+
+    def _record_timing(self, endpoint: str, counters: list, timing: dict):
+        """Add the timing of a finished request to the counters of the endpoint."""
+        if timing['reused']:
+            counters[REUSED] += 1
+        counters[BYTES_SENT] += timing['bytes_sent']
+        counters[BYTES_RECEIVED] += timing['bytes_received']
+        for i, phase in enumerate(requests.TIMING_PHASES):
+            counters[PHASES + i] += timing[phase]
+        if self.debug:
+            print("** {} {} ms (".format(endpoint, sum(timing[phase] for phase in requests.TIMING_PHASES))
+                  + ", ".join("{} {}".format(phase, timing[phase]) for phase in requests.TIMING_PHASES)
+                  + "), {} B sent, {} B received".format(timing['bytes_sent'], timing['bytes_received']))
+
+    def timing_summary(self) -> dict:
+        """
+        Get the timing of the requests per endpoint ("data", "upp", "bootstrap", "csr"), e.g. to send it
+        as telemetry. The timing of failed requests is not included.
+        :return: a dict with the phases and a list of counters per endpoint, in the order requests,
+                 failed requests, requests on a reused connection, bytes sent, bytes received and
+                 the total ms of every phase
+        """
+        return {
+            'phases': list(requests.TIMING_PHASES),
+            'endpoints': self.timing
+        }
+
+    def dump_timing(self) -> str:
+        """
+        Format the timing of the requests as a table for the log.
+        :return: the table
+        """
+        lines = ["backend request timing [ms]:"]
+        header = "{:<10s} {:>4s} {:>4s} {:>6s} {:>7s} {:>7s}".format("endpoint", "reqs", "fail", "reused", "sent", "recv")
+        for phase in requests.TIMING_PHASES:
+            header += " {:>10s}".format(phase)
+        lines.append(header)
+        for endpoint in sorted(self.timing):
+            c = self.timing[endpoint]
+            line = "{:<10s} {:>4d} {:>4d} {:>6d} {:>7d} {:>7d}".format(
+                endpoint, c[REQUESTS], c[FAILED], c[REUSED], c[BYTES_SENT], c[BYTES_RECEIVED])
+            for ms in c[PHASES:]:
+                line += " {:>10d}".format(ms)
+            lines.append(line)
+        return "\n".join(lines)
+
+    def close(self):
+        """
+        Close the connections that were kept open for further requests to the backend.
+        Call this before the network connection is closed.
+        """
+        requests.close_all()
@@ -0,0 +1,66 @@
+import urequests_async
+from .ubirch_api import API, FAILED
+
+
+class AsyncAPI(API):
+    """
+    ubirch API accessor methods on uasyncio: the methods return awaitables, so several
+    requests can be in flight at the same time (see urequests_async.run_all()).
+    Requires uasyncio, which is not part of every firmware.
+    """
+
+    def __init__(self, cfg: dict, timing: dict = None):
+        """
+        :param cfg: the configuration
+        :param timing: timing counters to add the timing of the requests to, e.g. API.timing,
+                       to get the timing of all requests in one table
+        """
+        super().__init__(cfg)
+        if timing is not None:
+            self.timing = timing
+
+    def _send_request(self, endpoint: str, url: str, headers: dict, data: bytes = None, method: str = "POST"):
+        """
+        Prepare a http request to the backend. The request is assembled right away, as the
+        headers are changed for the next request.
+        :return: an awaitable, which returns the backend response status code and content (body)
+        """
+        request = urequests_async.request(method, url, data=data, headers=headers, keep_alive=True,
+                                          timeout=self.timeout, truncate=True)
+        return self._await_request(endpoint, request)
+
+    async def _await_request(self, endpoint: str, request) -> (int, bytes):
+        counters = self._counters(endpoint)
+        try:
+            r = await request
+        except Exception:
+            counters[FAILED] += 1
+            raise
+        self._record_timing(endpoint, counters, r.timing)
+        if r.truncated and self.debug: print("** {} response body truncated".format(endpoint))
+        return r.status_code, r.content
+
+    def _send_batch(self, endpoint: str, url: str, headers: dict, data: bytes, count: int, send):
+        """
+        Prepare a batch request, see API._send_batch().
+        :return: an awaitable, which returns the status code and content of every item
+        """
+        request = urequests_async.request("POST", url, data=data, headers=headers, keep_alive=True,
+                                          timeout=self.timeout, truncate=True)
+        return self._await_batch(endpoint, request, count, send)
+
+    async def _await_batch(self, endpoint: str, request, count: int, send) -> [(int, bytes)]:
+        status_code, content = await self._await_request(endpoint, request)
+        if self._batch_unsupported(endpoint, status_code):
+            return await self._await_each(count, send)
+        return self._batch_results(endpoint, status_code, content, count)
+
+    def _send_each(self, count: int, send):
+        return self._await_each(count, send)
+
+    async def _await_each(self, count: int, send) -> [(int, bytes)]:
+        # one after the other, to keep the order of the UPP chain
+        results = []
+        for i in range(count):
+            results.append(await send(i))
+        return results
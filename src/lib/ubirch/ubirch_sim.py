@@ -24,106 +24,232 @@
 | limitations under the License.
 """
 
+import at_stats
 import time
 import ubinascii as binascii
+import uhashlib as hashlib
+import ujson as json
 from network import LTE
 from uuid import UUID
 
 supported_channels = [0, 1, 2, 3]
 
 # AT+CSIM=LENGTH,COMMAND
+AT_CSIM = b'AT+CSIM='
 
 # Application Identifier
-APP_DF = 'D2760001180002FF34108389C0028B02'
+APP_DF = binascii.unhexlify('D2760001180002FF34108389C0028B02')
 
 STK_OK = '9000'  # successful command execution
 STK_MD = '6310'  # more data, repeat finishing
 STK_NF = '6A88'  # not found
 
+# APDU commands are given as header (CLA, INS, P1, P2), P1/P2 parameters and Lc/Le are added when executed
+
 # SIM toolkit commands
-STK_GET_RESPONSE = '00C00000{:02X}'  # get a pending response
-STK_AUTH_PIN = '00200000{:02X}{}'  # authenticate with pin ([1], 2.1.2)
-STK_OPEN_CHANNEL = "0070000001"  # open new logical channel to SIM (ISO 7816 part 4 sect. 6.16)
-STK_CLOSE_CHANNEL = "007080{:02X}00"  # close a logical channel (ISO 7816 part 4 sect. 6.16)
+STK_GET_RESPONSE = b'\x00\xC0\x00\x00'  # get a pending response (Le: length of the response)
+STK_AUTH_PIN = b'\x00\x20\x00\x00'  # authenticate with pin ([1], 2.1.2)
+STK_OPEN_CHANNEL = b'\x00\x70\x00\x00'  # open new logical channel to SIM (ISO 7816 part 4 sect. 6.16)
+STK_CLOSE_CHANNEL = b'\x00\x70\x80\x00'  # close a logical channel, P2: channel (ISO 7816 part 4 sect. 6.16)
 
 # generic app commands
-STK_APP_SELECT = '00A4040010{}'  # APDU Select Application ([1], 2.1.1)
-STK_APP_RANDOM = '80B900{:02X}00'  # APDU Generate Secure Random ([1], 2.1.3)
-STK_APP_SS_SELECT = '80A50000{:02X}{}'  # APDU Select SS Entry ([1], 2.1.4)
-STK_APP_DELETE_ALL = '80E50000'  # APDU Delete All SS Entries ([1], 2.1.5)
-STK_APP_SS_ENTRY_ID_GET = '80B10000{:02X}{}'  # APDU Get SS Entry ID
+STK_APP_SELECT = b'\x00\xA4\x04\x00'  # APDU Select Application ([1], 2.1.1)
+STK_APP_RANDOM = b'\x80\xB9\x00\x00'  # APDU Generate Secure Random, P2: length ([1], 2.1.3)
+STK_APP_SS_SELECT = b'\x80\xA5\x00\x00'  # APDU Select SS Entry ([1], 2.1.4)
+STK_APP_DELETE_ALL = b'\x80\xE5\x00\x00'  # APDU Delete All SS Entries ([1], 2.1.5)
+STK_APP_SS_ENTRY_ID_GET = b'\x80\xB1\x00\x00'  # APDU Get SS Entry ID
 
 # ubirch specific commands
-STK_APP_SIGN_INIT = '80B5{:02X}00{:02X}{}'  # APDU Sign Init command ([1], 2.2.1)
-STK_APP_SIGN_FINAL = '80B6{:02X}00{:02X}{}'  # APDU Sign Update/Final command ([1], 2.2.2)
-STK_APP_VERIFY_INIT = '80B7{:02X}00{:02X}{}'  # APDU Verify Signature Init ([1], 2.2.3)
-STK_APP_VERIFY_FINAL = '80B8{:02X}00{:02X}{}'  # APDU Verify Signature Update/Final ([1], 2.2.4)
+STK_APP_SIGN_INIT = b'\x80\xB5\x00\x00'  # APDU Sign Init command, P1: protocol ([1], 2.2.1)
+STK_APP_SIGN_FINAL = b'\x80\xB6\x00\x00'  # APDU Sign Update/Final command ([1], 2.2.2)
+STK_APP_VERIFY_INIT = b'\x80\xB7\x00\x00'  # APDU Verify Signature Init, P1: protocol ([1], 2.2.3)
+STK_APP_VERIFY_FINAL = b'\x80\xB8\x00\x00'  # APDU Verify Signature Update/Final ([1], 2.2.4)
 
 # key management
-STK_APP_KEY_GENERATE = '80B28000{:02X}{}'  # APDU Generate Key Pair ([1], 2.1.7)
-STK_APP_KEY_STORE = '80D8{:02X}00{:02X}{}'  # store an ECC public key
-STK_APP_KEY_GET = '80CB0000{:02X}{}'  # APDU Get Key ([1], 2.1.8)
+STK_APP_KEY_GENERATE = b'\x80\xB2\x80\x00'  # APDU Generate Key Pair ([1], 2.1.7)
+STK_APP_KEY_STORE = b'\x80\xD8\x00\x00'  # store an ECC public key
+STK_APP_KEY_GET = b'\x80\xCB\x00\x00'  # APDU Get Key ([1], 2.1.8)
 
 # certificate management
-STK_APP_CSR_GENERATE_FIRST = '80BA{:02X}00{:02X}{}'  # Generate Certificate Sign Request command ([1], 2.1.7)
-STK_APP_CSR_GENERATE_NEXT = '80BA810000'  # Get Certificate Sign Request response ([1], 2.1.7)
-STK_APP_CERT_STORE = '80E3{:02X}00{:02X}{}'  # Store Certificate ([1], 2.1.9)
-STK_APP_CERT_UPDATE = '80E7{:02X}00{:02X}{}'  # Update Certificate ([1], 2.1.10)
-STK_APP_CERT_GET = '80CC{:02X}0000'  # Get Certificate ([1], 2.1.11)
+STK_APP_CSR_GENERATE_FIRST = b'\x80\xBA\x00\x00'  # Generate Certificate Sign Request command ([1], 2.1.7)
+STK_APP_CSR_GENERATE_NEXT = b'\x80\xBA\x81\x00'  # Get Certificate Sign Request response ([1], 2.1.7)
+STK_APP_CERT_STORE = b'\x80\xE3\x00\x00'  # Store Certificate ([1], 2.1.9)
+STK_APP_CERT_UPDATE = b'\x80\xE7\x00\x00'  # Update Certificate ([1], 2.1.10)
+STK_APP_CERT_GET = b'\x80\xCC\x00\x00'  # Get Certificate, P1: 0 = first part, 1 = next part ([1], 2.1.11)
 
 APP_UBIRCH_SIGNED = 0x22
 APP_UBIRCH_CHAINED = 0x23
 
 
-def _encode_tag(tags: [(int, bytes or str)]) -> str:
+def _encode_tag(tags: [(int, bytes)], buf: bytearray = None) -> memoryview:
     """
     Encode taged arguments for APDU commands.
-    :param tags: a list of tuples of the format (tag, data) where data may be bytes or a pre-encoded str
-    :return: a hex encoded string, for use with the APDU
+    :param tags: a list of tuples of the format (tag, data)
+    :param buf: the buffer to encode the tags into, a new buffer is allocated if not given or too small
+    :return: a memoryview of the encoded tags, for use with the APDU
     """
-    r = ""
+    length = 0
+    for (_, data) in tags:
+        length += (4 if len(data) > 0xff else 2) + len(data)
+    if buf is None or len(buf) < length:
+        buf = bytearray(length)
+
+    idx = 0
     for (tag, data) in tags:
-        if isinstance(data, bytes):
-            # convert bytes into hex encoded string
-            data = binascii.hexlify(data).decode()
+        data_len = len(data)
+        buf[idx] = tag
+        if data_len > 0xff:  # 0x82 indicates the length of the tag data being 2 bytes long
+            buf[idx + 1] = 0x82
+            buf[idx + 2] = data_len >> 8
+            buf[idx + 3] = data_len & 0xff
+            idx += 4
+        else:
+            buf[idx + 1] = data_len
+            idx += 2
+        buf[idx:idx + data_len] = data
+        idx += data_len
+    return memoryview(buf)[:length]
 
-        data_len = int(len(data) / 2)
-        if data_len > 0xff:
-            data_len = (0x82 << 16) | data_len
 
-        r += "{0:02X}{1:02X}{2}".format(tag, data_len, data)
-    return r
+def _next_tag(encoded: memoryview, idx: int) -> (int, int, int):
+    """
+    Get the position of the next tag in APDU response data.
+    Throws exception if tag decoding fails.
+    :param encoded: the response data with tags to decode
+    :param idx: the index of the tag
+    :return: (tag, index of the tag data, index after the tag data)
+    """
+    tag = encoded[idx]
+    data_len = encoded[idx + 1]
+    idx += 2
+    if data_len == 0x82:  # 0x82 indicates the length of the tag data being 2 bytes long
+        data_len = encoded[idx] << 8 | encoded[idx + 1]
+        idx += 2
+    if len(encoded) - idx < data_len:
+        raise Exception("tag {:02x} has not enough data {} < {}".format(tag, len(encoded) - idx, data_len))
+    return tag, idx, idx + data_len
 
 
-def _decode_tag(encoded: bytes) -> [(int, bytes)]:
+def _decode_tag(encoded: bytes) -> [(int, memoryview)]:
     """
     Decode APDU response data that contains tags.
     Throws exception if tag decoding fails.
     :param encoded: the response data with tags to decode
-    :return: (tag, data)
+    :return: (tag, data), data is a memoryview of the response data
     """
+    encoded = memoryview(encoded)
     decoded = []
     idx = 0
     while idx < len(encoded):
-        tag = encoded[idx]
-        data_len = int(encoded[idx + 1])
-        idx += 2
-        if data_len == 0x82:  # 0x82 indicates the length of the tag data being 2 bytes long
-            data_len = int(encoded[idx]) << 8 | int(encoded[idx + 1])
-            idx += 2
-        if len(encoded[idx:]) < data_len:
-            raise Exception("tag %02x has not enough data %d < %d".format(tag, len(encoded[idx:]), data_len))
-        endIdx = idx + data_len
-        data = encoded[idx:endIdx]
-        decoded.append(tuple((tag, data)))
-        idx = endIdx
+        tag, start, idx = _next_tag(encoded, idx)
+        decoded.append((tag, encoded[start:idx]))
     return decoded
 
 
+def _find_tag(encoded: bytes, tag: int) -> memoryview:
+    """
+    Find the data of a tag in APDU response data without copying it.
+    Throws exception if the tag is not found or tag decoding fails.
+    :param encoded: the response data with tags
+    :param tag: the tag to look for
+    :return: a memoryview of the data of the first occurrence of the tag
+    """
+    encoded = memoryview(encoded)
+    idx = 0
+    while idx < len(encoded):
+        found, start, idx = _next_tag(encoded, idx)
+        if found == tag:
+            return encoded[start:idx]
+    raise Exception("tag {:02x} not found".format(tag))
+
+
+class _LengthCounter:
+    """
+    Writable stream that passes data on to the sink and counts the written bytes.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.written = 0
+
+    def write(self, data: bytes) -> int:
+        self.sink.write(data)
+        self.written += len(data)
+        return len(data)
+
+
+class _TagFilter:
+    """
+    Writable stream that decodes tagged APDU response data incrementally and writes only
+    the data of the first occurrence of the given tag to the sink, so the tag data never
+    has to be held in memory. close() throws exception if the tag was not found or the
+    stream ended before the tag data was complete.
+    """
+
+    def __init__(self, tag: int, sink):
+        """
+        :param tag: the tag to filter
+        :param sink: the destination with a write(data) method, e.g. a file
+        """
+        self.tag = tag
+        self.sink = sink
+        self.written = 0  # number of bytes written to the sink
+        self._header = bytearray(4)
+        self._header_len = 0
+        self._remaining = 0  # remaining data bytes of the current tag
+        self._current = None  # the current tag, None while decoding a tag header
+        self._found = False  # if the data of the tag was written completely
+
+    def write(self, data: bytes) -> int:
+        data = memoryview(data)
+        idx = 0
+        while idx < len(data):
+            if self._current is None:
+                # collect the tag header: tag, length (1 byte or 0x82 and 2 bytes)
+                self._header[self._header_len] = data[idx]
+                self._header_len += 1
+                idx += 1
+                if self._header_len == 2 and self._header[1] != 0x82:
+                    self._start_tag(self._header[1])
+                elif self._header_len == 4:
+                    self._start_tag(self._header[2] << 8 | self._header[3])
+            else:
+                end = min(len(data), idx + self._remaining)
+                if self._current == self.tag and not self._found:
+                    self.sink.write(data[idx:end])
+                    self.written += end - idx
+                self._remaining -= end - idx
+                idx = end
+                if self._remaining == 0:
+                    self._end_tag()
+        return len(data)
+
+    def _start_tag(self, data_len: int):
+        self._current = self._header[0]
+        self._remaining = data_len
+        self._header_len = 0
+        if data_len == 0:
+            self._end_tag()
+
+    def _end_tag(self):
+        if self._current == self.tag:
+            self._found = True
+        self._current = None
+
+    def close(self):
+        if self._current is not None or self._header_len > 0:
+            raise Exception("tag {:02x} has not enough data".format(self._header[0]))
+        if not self._found:
+            raise Exception("tag {:02x} not found".format(self.tag))
+
+
 class SimProtocol:
-    MAX_AT_LENGTH = 110
+    MAX_AT_LENGTH = 110  # default maximal APDU length (hex encoded) of AT+CSIM commands, works with all modem FWs
+    MAX_APDU_LENGTH = 520  # ISO 7816 short APDU limit (5 header bytes + 255 data bytes, hex encoded)
+    AT_LENGTH_CANDIDATES = [MAX_APDU_LENGTH, 400, 300, 200]  # command lengths to probe, in descending order
 
-    def __init__(self, lte: LTE, at_debug: bool = False, channel: int = None):
+    def __init__(self, lte: LTE, at_debug: bool = False, channel: int = None, at_length_file: str = None,
+                 identity_cache_file: str = None, sim_id: str = None):
         """
         Initialize the SIM interface. This executes a command to initialize the modem,
         and waits for the modem to be ready, then selects the SIM application.
@@ -132,45 +258,98 @@ class SimProtocol:
 
         If there is already a channel to the SIM it can be specified with channel=X. Supported
         channel values are 0-3. If not specified a new channel will be requested from the SIM
-        and set automatically.
+        and set automatically. If the SIM application is still selected on the specified channel
+        (e.g. after deepsleep with deinit(close_channel=False)), the session is resumed without
+        further initialization. If the channel is not usable anymore, a new channel is requested.
+
+        If at_length_file is specified, the maximal AT+CSIM command length the modem accepts is
+        probed once and stored in this file. Subsequent initializations load the value from the file.
+        Delete the file after a modem firmware update to probe again.
+
+        If identity_cache_file is specified, UUIDs, public keys and certificates read from the SIM
+        are cached in this file, so they only have to be retrieved from the SIM once. The cache is
+        bound to the SIM identity sim_id (e.g. the IMSI) and invalidated when the SIM changes. If
+        sim_id is not specified, the IMSI is requested from the SIM when the cache is loaded.
         """
         if channel is not None and channel not in supported_channels:
             raise Exception("unsupported channel: 0x{:X}".format(self._channel))
         self._channel = channel
         self.lte = lte
+        self.max_at_length = self.MAX_AT_LENGTH
+        # preallocated buffers for the APDUs, the AT commands and the encoded tags of frequent commands
+        self._apdu = bytearray(self.MAX_APDU_LENGTH // 2)
+        self._at_cmd = bytearray(len(AT_CSIM) + len('520,""') + self.MAX_APDU_LENGTH)
+        self._at_cmd[0:len(AT_CSIM)] = AT_CSIM
+        self._tags = bytearray(32)
+        self._at_length_file = at_length_file
+        self._identity_cache_file = identity_cache_file
+        self._identity_cache = None  # loaded on first access
+        self._sim_id = sim_id
         self._AT_session_active = False  # wether or not the lib currently opened an AT commands session
         self._AT_session_modem_suspended = False  # wether the modem was suspended for an AT session
+        self._sign_init_reusable = None  # wether the applet keeps the sign init state, None until probed by sign_many()
+        self._keep_channel = False  # wether the channel is kept open for a resumption after deepsleep
         self.DEBUG = at_debug
         self.init()
 
     def __del__(self):
-        self.deinit()
+        self.deinit(close_channel=not self._keep_channel)
 
     def init(self):
         if self.DEBUG: print("\n>> init SIM")
         self._prepare_AT_session()
         try:
-            # make sure we can access the SIM
-            if not self._check_sim_access():
-                raise Exception("couldn't access SIM")
-
-            # if no channel set: open a new communication channel to SIM and save it
-            if self._channel is None:
-                self._channel = self._open_channel()
-
-            # select the SIGNiT application
-            if not self._select_app():
-                raise Exception("selecting SIM application failed")
+            # if a channel is set, check if the application session on it is still alive and resume it
+            if self._channel is not None and self._session_alive():
+                if self.DEBUG: print(">> resuming SIM session on channel {}".format(self._channel))
+            else:
+                # make sure we can access the SIM
+                if not self._check_sim_access():
+                    raise Exception("couldn't access SIM")
+
+                # if a channel is set, but the SIGNiT application can't be selected on it, discard it
+                if self._channel is not None:
+                    try:
+                        selected = self._select_app()
+                    except Exception:
+                        selected = False
+                    if not selected:
+                        if self.DEBUG: print(">> channel {} not usable".format(self._channel))
+                        self._channel = None
+
+                # if no channel set: open a new communication channel to SIM and save it
+                if self._channel is None:
+                    self._channel = self._open_channel()
+
+                    # select the SIGNiT application
+                    if not self._select_app():
+                        raise Exception("selecting SIM application failed")
+
+            # get the maximal command length the modem accepts (probe once, then load it from flash)
+            if self._at_length_file is not None:
+                self._negotiate_at_length()
         finally:
             self._finish_AT_session()
 
-    def deinit(self):
+    @property
+    def channel(self) -> int or None:
+        """The logical channel used to communicate with the SIM application."""
+        return self._channel
+
+    def deinit(self, close_channel: bool = True):
         """
         Deintializes the SIM interface by closing the APDU communication channel. Used
         in preparation for events like low-power sleep or a board reset without a SIM/modem
         reset. Does not deinitialize/disconnect the LTE.
+        :param close_channel: if False, the channel is kept open, so the session can be resumed
+                              after deepsleep by passing the channel to the constructor
         """
         if self.DEBUG: print("\n>> deinit SIM")
+        self._keep_channel = not close_channel
+        if not close_channel:
+            if self.DEBUG: print(">> keeping channel {} open".format(self._channel))
+            return
+
         self._prepare_AT_session()
         try:
             # Close logical channel to SIM if open
@@ -211,10 +390,139 @@ class SimProtocol:
 
     def _send_at_cmd(self, cmd):
         if self.DEBUG: print("++ " + cmd)
-        result = [k for k in self.lte.send_at_cmd(cmd).split('\r\n') if len(k.strip()) > 0]
+        result = [k for k in at_stats.send_at_cmd(self.lte, cmd).split('\r\n') if len(k.strip()) > 0]
         if self.DEBUG: print('-- ' + '\r\n-- '.join([r for r in result]))
         return result
 
+    def _negotiate_at_length(self):
+        """
+        Set the maximal AT+CSIM command length from the AT length file. If there is no valid
+        value in the file, probe the modem for the longest command it accepts and store the
+        result in the file.
+        """
+        try:
+            with open(self._at_length_file, "r") as f:
+                at_length = int(f.read())
+            if self.MAX_AT_LENGTH <= at_length <= self.MAX_APDU_LENGTH:
+                self.max_at_length = at_length
+                return
+        except (OSError, ValueError):
+            pass
+
+        if self.DEBUG: print("\n>> probing maximal AT+CSIM command length")
+        for at_length in self.AT_LENGTH_CANDIDATES:
+            if self._at_length_accepted(at_length):
+                self.max_at_length = at_length
+                break
+        else:
+            self.max_at_length = self.MAX_AT_LENGTH
+
+        if self.DEBUG: print("\tmaximal AT+CSIM command length: {}".format(self.max_at_length))
+        with open(self._at_length_file, "w") as f:
+            f.write(str(self.max_at_length))
+
+    def _at_length_accepted(self, at_length: int) -> bool:
+        """
+        Check if the modem passes an APDU of the given (hex encoded) length on to the SIM.
+        Sends a select command for a non-existent SS entry with an ID of the required length,
+        which does not change any state on the SIM.
+        :param at_length: the APDU length to check
+        :return: whether the APDU was forwarded to the SIM and not rejected as being too long
+        """
+        entry_id = bytes([0xFF]) * ((at_length - 10) // 2)  # APDU header and Lc take 10 hex characters
+        try:
+            _, code = self._execute(STK_APP_SS_SELECT, entry_id)
+        except Exception:
+            return False  # modem rejected the AT command
+
+        # wrong length (67XX) indicates that the APDU might have been truncated
+        return code[0:2] != '67'
+
+    def _get_sim_id(self) -> str:
+        """
+        Get the identity of the SIM the identity cache is bound to. Requests the IMSI
+        from the SIM if no SIM identity was specified.
+        :return: the SIM identity
+        """
+        if self._sim_id is None:
+            self._prepare_AT_session()
+            try:
+                result = self._send_at_cmd("AT+CIMI")
+            finally:
+                self._finish_AT_session()
+
+            if result[-1] != 'OK':
+                raise Exception("getting IMSI failed: {}".format(repr(result)))
+            self._sim_id = result[0]
+
+        return self._sim_id
+
+    def _load_identity_cache(self) -> dict:
+        """
+        Load the identity cache from flash. If the cache belongs to a different SIM, it is discarded.
+        :return: the identity cache
+        """
+        if self._identity_cache is None:
+            cache = {}
+            try:
+                with open(self._identity_cache_file, "r") as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+            sim_id = self._get_sim_id()
+            if cache.get("sim") != sim_id:
+                if self.DEBUG: print(">> identity cache invalid for SIM {}, discarding".format(sim_id))
+                cache = {"sim": sim_id}
+            self._identity_cache = cache
+
+        return self._identity_cache
+
+    def _save_identity_cache(self):
+        with open(self._identity_cache_file, "w") as f:
+            json.dump(self._identity_cache, f)
+
+    def _cache_get(self, key: str) -> bytes or None:
+        """
+        Get a value from the identity cache.
+        :param key: the cache key
+        :return: the cached value or None if the value is not cached or caching is disabled
+        """
+        if self._identity_cache_file is None:
+            return None
+
+        value = self._load_identity_cache().get(key)
+        if value is None:
+            return None
+        if self.DEBUG: print(">> using cached value for \"{}\"".format(key))
+        return binascii.unhexlify(value)
+
+    def _cache_put(self, key: str, value: bytes):
+        """
+        Store a value in the identity cache (if caching is enabled).
+        :param key: the cache key
+        :param value: the value to store
+        """
+        if self._identity_cache_file is None:
+            return
+
+        self._load_identity_cache()[key] = binascii.hexlify(value).decode()
+        self._save_identity_cache()
+
+    def _cache_invalidate(self, entry_ids: [str] = None):
+        """
+        Remove cached values of SS entries from the identity cache.
+        :param entry_ids: the entry IDs to remove the cached values for, all values are removed if not specified
+        """
+        if self._identity_cache_file is None:
+            return
+
+        cache = self._load_identity_cache()
+        for key in list(cache):
+            if key != "sim" and (entry_ids is None or key.split(":", 1)[1] in entry_ids):
+                del cache[key]
+        self._save_identity_cache()
+
     def _open_channel(self) -> int:
         """
         Open a new logical channel to communicate with the SIM (see ISO 7816 part 4 sect. 6.16)
@@ -224,7 +532,7 @@ class SimProtocol:
         """
         old_channel = self._channel  # save lib channel
         self._channel = 0  # send on basic channel
-        data, code = self._execute(STK_OPEN_CHANNEL)  # send
+        data, code = self._execute(STK_OPEN_CHANNEL, le=1)  # send
         self._channel = old_channel  # restore lib channel
 
         if code != STK_OK or len(data) != 1:
@@ -245,60 +553,109 @@ class SimProtocol:
         """
         old_channel = self._channel  # save lib channel
         self._channel = 0  # send on basic channel
-        _, code = self._execute(STK_CLOSE_CHANNEL.format(channel_to_close))  # send
+        _, code = self._execute(STK_CLOSE_CHANNEL, p2=channel_to_close, le=0)  # send
         self._channel = old_channel  # restore lib channel
 
         if code != STK_OK:
             raise Exception("couldn't close channel: {}".format(code))
 
-    def _execute(self, cmd: str) -> (bytes, str):
+    def _execute(self, cmd: bytes, data: bytes = None, p1: int = None, p2: int = None,
+                 le: int = None) -> (bytes, str):
         """
         Execute an APDU command on the SIM card itself.
         If the APDU contains channel information, encode the channel info into the CLA byte.
-        :param cmd: the command to execute
+        The APDU is assembled in a preallocated buffer and hex encoded into the AT command once. This
+        is not allocation free: the hex encoding, the AT command string and the decoded response are
+        still allocated per command (half the transient memory of the former hex string commands, at
+        about 1.5 times their CPU time, see tools/bench_apdu.py).
+        :param cmd: the header (CLA, INS, P1, P2) of the command to execute
+        :param data: the command data (bytes, bytearray or memoryview), Lc is set accordingly
+        :param p1: the P1 parameter, if it is not given by the header
+        :param p2: the P2 parameter, if it is not given by the header
+        :param le: the expected response length, for commands without data
         :return: a tuple of data, code
         """
+        apdu = self._apdu
+        apdu[0:4] = cmd
+        if p1 is not None:
+            apdu[2] = p1
+        if p2 is not None:
+            apdu[3] = p2
 
         # check if this is a command where the CLA byte contains channel info (see ISO 7816 part 4 sect. 5.4.1)
-        if cmd[0] in ["0", "8", "A", "9"]:
+        if cmd[0] & 0xf0 in (0x00, 0x80, 0xA0, 0x90):
             # check if valid channel is set
             if self._channel not in supported_channels:
                 raise Exception("invalid channel for sending APDU command: {}".format(self._channel))
             # check if APDU command definition indicates non-basic channel or secure messaging
-            if cmd[1] != "0":
+            if cmd[0] & 0x0f:
                 raise Exception(
-                    "CLA byte (0x{}) of command invalid: indicates specific channel or secure messaging (not supported)".format(
-                        cmd[0:2]))
+                    "CLA byte (0x{:02X}) of command invalid: indicates specific channel or secure messaging (not supported)".format(
+                        cmd[0]))
             # encode channel into command
-            channel_char = "{!s:.1}".format(self._channel)
-            cmd = cmd[0] + channel_char + cmd[2:]
-
-        at_cmd = 'AT+CSIM={},"{}"'.format(len(cmd), cmd.upper())
-        result = self._send_at_cmd(at_cmd)
+            apdu[0] = cmd[0] | self._channel
+
+        apdu_len = 4
+        if data is not None:
+            data_len = len(data)
+            if data_len > 0xff:
+                raise Exception("APDU command data too long: {} bytes".format(data_len))
+            apdu[4] = data_len
+            apdu[5:5 + data_len] = data
+            apdu_len = 5 + data_len
+        elif le is not None:
+            apdu[4] = le
+            apdu_len = 5
+
+        # AT+CSIM=<length>,"<command>"
+        at_cmd = self._at_cmd
+        idx = len(AT_CSIM)
+        at_len = 2 * apdu_len
+        if at_len >= 100:
+            at_cmd[idx] = 0x30 + at_len // 100
+            idx += 1
+        if at_len >= 10:
+            at_cmd[idx] = 0x30 + at_len // 10 % 10
+            idx += 1
+        at_cmd[idx] = 0x30 + at_len % 10
+        at_cmd[idx + 1] = 0x2C  # ,
+        at_cmd[idx + 2] = 0x22  # "
+        idx += 3
+        at_cmd[idx:idx + at_len] = binascii.hexlify(memoryview(apdu)[:apdu_len]).upper()
+        idx += at_len
+        at_cmd[idx] = 0x22  # "
+        result = self._send_at_cmd(str(memoryview(at_cmd)[:idx + 1], 'ascii'))
 
         if result[-1] == 'OK':
-            response = result[0][7:].split(',')[1]
+            # +CSIM: <length>,<response>
+            response = result[0]
+            data_start = response.find(',') + 1
             data = b''
             code = response[-4:]
-            if len(response) > 4:
-                data = binascii.unhexlify(response[0:-4])
+            if len(response) - data_start > 4:
+                data = binascii.unhexlify(response[data_start:-4])
             return data, code
 
         raise Exception(result[-1])
 
-    def _send_cmd_in_chunks(self, cmd, args) -> (bytes, str):
+    def _send_cmd_in_chunks(self, cmd: bytes, args: bytes) -> (bytes, str):
         """
         Split command into smaller chunks and handle the last chunk differently
+        :param cmd: the header of the command, P1 is set to 0x80 for the last chunk
+        :param args: the command data
         :return: the data and code response from the last operation
         """
-        chunk_size = self.MAX_AT_LENGTH - len(cmd[:-2].format(0, 0))
-        chunks = [args[i:i + chunk_size] for i in range(0, len(args), chunk_size)]
-        for chunk in chunks[:-1]:
-            data, code = self._execute(cmd.format(0, int(len(chunk) / 2), chunk))
+        # APDU header and Lc take 10 of the hex encoded characters
+        chunk_size = (min(self.max_at_length, self.MAX_APDU_LENGTH) - 10) // 2
+        args = memoryview(args)
+        idx = 0
+        while len(args) - idx > chunk_size:
+            data, code = self._execute(cmd, args[idx:idx + chunk_size], p1=0x00)
             if code != STK_OK:
                 return data, code
-        else:
-            return self._execute(cmd.format(0x80, int(len(chunks[-1]) / 2), chunks[-1]))
+            idx += chunk_size
+
+        return self._execute(cmd, args[idx:], p1=0x80)
 
     def _get_response(self, code: str) -> (bytes, str):
         """
@@ -307,22 +664,50 @@ class SimProtocol:
         :return: a data, code tuple as a result of APDU GET RESPONSE
         """
         if code[0:2] == '61':
-            return self._execute(STK_GET_RESPONSE.format(int(code[2:4], 16)))
+            return self._execute(STK_GET_RESPONSE, le=int(code[2:4], 16))
         else:
             raise Exception("no response data ({})".format(code))
 
-    def _get_more_data(self, code: str, data: bytes, cmd: str) -> (bytes, str):
+    def _get_more_data(self, code: str, data: bytes, cmd: bytes, p1: int = None, sink=None) -> (bytes, str):
         """
         Append pending data to already retrieved data
         :param code: the code response from the previous operation
         :param data: the data to append more data to
-        :param cmd: the command to get the pending data
-        :return: a tuple of data, code
+        :param cmd: the header of the command to get the pending data
+        :param p1: the P1 parameter of the command, if it is not given by the header
+        :param sink: if given, the data and all pending parts are written to sink.write() as they
+                     arrive, instead of being collected in memory
+        :return: a tuple of data (empty if a sink is given), code
         """
+        if sink is not None:
+            sink.write(data)
+            while code == STK_MD:
+                data, code = self._execute(cmd, p1=p1, le=0)
+                sink.write(data)
+            return b'', code
+
+        if code != STK_MD:
+            return data, code
+
+        # collect the parts in a single growing buffer instead of concatenating copies
+        buf = bytearray(data)
         while code == STK_MD:
-            more_data, code = self._execute(cmd)
-            data += more_data
-        return data, code
+            more_data, code = self._execute(cmd, p1=p1, le=0)
+            buf.extend(more_data)
+        return buf, code
+
+    def _session_alive(self) -> bool:
+        """
+        Checks with a single command if the SIM application is selected on the current channel.
+        :return: if the session can be used
+        """
+        try:
+            _, code = self._execute(STK_APP_RANDOM, p2=1, le=0)
+        except Exception:
+            return False
+
+        # the application may require authentication for the command, which still means it is selected
+        return code == STK_OK or code == '6982'
 
     def _check_sim_access(self) -> bool:
         """
@@ -344,7 +729,7 @@ class SimProtocol:
         if self.DEBUG: print("\n>> selecting SIM application")
         for _ in range(2):
             time.sleep(0.2)
-            data, code = self._execute(STK_APP_SELECT.format(APP_DF))
+            data, code = self._execute(STK_APP_SELECT, APP_DF)
             if code == STK_OK:
                 return True
 
@@ -357,13 +742,13 @@ class SimProtocol:
         :param entry_id: the entry ID
         :return: the data and code response from the operation
         """
-        data, code = self._execute(STK_APP_SS_SELECT.format(len(entry_id), binascii.hexlify(entry_id).decode()))
+        data, code = self._execute(STK_APP_SS_SELECT, entry_id.encode())
         if code == STK_NF:
             raise Exception("entry \"{}\" not found".format(entry_id))
 
         data, code = self._get_response(code)
         if code == STK_OK and self.DEBUG:
-            print('found entry: ' + repr(_decode_tag(data)))
+            print('found entry: ' + repr([(tag, bytes(value)) for tag, value in _decode_tag(data)]))
         return data, code
 
     def sim_auth(self, pin: str):
@@ -375,7 +760,7 @@ class SimProtocol:
         if self.DEBUG: print("\n>> unlocking SIM")
         self._prepare_AT_session()
         try:
-            data, code = self._execute(STK_AUTH_PIN.format(len(pin), binascii.hexlify(pin).decode()))
+            data, code = self._execute(STK_AUTH_PIN, pin.encode())
         finally:
             self._finish_AT_session()
 
@@ -391,7 +776,7 @@ class SimProtocol:
         if self.DEBUG: print("\n>> generating random data with length " + str(length))
         self._prepare_AT_session()
         try:
-            data, code = self._execute(STK_APP_RANDOM.format(length))
+            data, code = self._execute(STK_APP_RANDOM, p2=length, le=0)
         finally:
             self._finish_AT_session()
 
@@ -411,13 +796,15 @@ class SimProtocol:
         finally:
             self._finish_AT_session()
 
+        self._cache_invalidate()
+
         return data, code
 
     def entry_exists(self, entry_id: str):
         if self.DEBUG: print("\n>> looking for entry ID \"{}\"".format(entry_id))
         self._prepare_AT_session()
         try:
-            _, code = self._execute(STK_APP_SS_SELECT.format(len(entry_id), binascii.hexlify(entry_id).decode()))
+            _, code = self._execute(STK_APP_SS_SELECT, entry_id.encode())
         finally:
             self._finish_AT_session()
 
@@ -444,7 +831,7 @@ class SimProtocol:
                 "invalid ECC public key length: {}, expected {} bytes".format(len(pub_key), expected_key_len))
 
         args = _encode_tag([(0xC4, entry_id.encode()),  # Entry ID for public key
-                            (0xC0, uuid.hex),  # Entry title (UUID)
+                            (0xC0, uuid.bytes),  # Entry title (UUID)
                             (0xC1, bytes([0x03])),  # Permission: Read & Write Allowed
                             (0xC2, bytes([0x0B, 0x01, 0x00])),  # TYPE_EC_FP_PUBLIC, LENGTH_EC_FP_256
                             (0xC3, bytes([0x04]) + pub_key)  # Public key to be stored (SEC format)
@@ -455,6 +842,8 @@ class SimProtocol:
         finally:
             self._finish_AT_session()
 
+        self._cache_invalidate([entry_id])
+
         if code != STK_OK:
             raise Exception("storing key failed: {}".format(code))
 
@@ -465,18 +854,25 @@ class SimProtocol:
         :return: the public key bytes
         """
         if self.DEBUG: print("\n>> getting public key with entry ID \"{}\"".format(entry_id))
+        cache_key = "key:" + entry_id
+        key = self._cache_get(cache_key)
+        if key is not None:
+            return key
+
         self._prepare_AT_session()
         try:
             # select SS public key entry
             data, code = self._select_ss_entry(entry_id)
             if code == STK_OK:
                 # get the key
-                args = _encode_tag([(0xD0, bytes([0x00]))])
-                data, code = self._execute(STK_APP_KEY_GET.format(int(len(args) / 2), args))
+                args = _encode_tag([(0xD0, bytes([0x00]))], self._tags)
+                data, code = self._execute(STK_APP_KEY_GET, args)
                 data, code = self._get_response(code)
                 if code == STK_OK:
                     # remove the fixed 0x04 prefix from the key entry_id
-                    return [tag[1][1:] for tag in _decode_tag(data) if tag[0] == 0xc3][0]
+                    key = bytes(_find_tag(data, 0xc3)[1:])
+                    self._cache_put(cache_key, key)
+                    return key
 
             raise Exception(code)
         finally:
@@ -497,18 +893,20 @@ class SimProtocol:
         # prefix private key entry id with a '_'
         # SS entries must have unique entry IDs
         args = _encode_tag([(0xC4, entry_id.encode()),
-                            (0xC0, uuid.hex),
+                            (0xC0, uuid.bytes),
                             (0xC1, bytes([0x03])),
                             (0xC4, ("_" + entry_id).encode()),
-                            (0xC0, uuid.hex),
+                            (0xC0, uuid.bytes),
                             (0xC1, bytes([0x03]))
                             ])
         self._prepare_AT_session()
         try:
-            data, code = self._execute(STK_APP_KEY_GENERATE.format(int(len(args) / 2), args))
+            data, code = self._execute(STK_APP_KEY_GENERATE, args)
         finally:
             self._finish_AT_session()
 
+        self._cache_invalidate([entry_id, "_" + entry_id])
+
         if code != STK_OK:
             raise Exception(code)
 
@@ -528,7 +926,7 @@ class SimProtocol:
 
         if code == STK_OK:
             # get the entry title
-            return [tag[1] for tag in _decode_tag(data) if tag[0] == 0xc0][0]
+            return bytes(_find_tag(data, 0xc0))
 
         raise Exception(code)
 
@@ -538,13 +936,20 @@ class SimProtocol:
         :param entry_id: the entry ID of the SS key entry associated with the UUID
         :return: the UUID
         """
-        return UUID(self.get_entry_title(entry_id))
-
-    def generate_csr(self, entry_id: str, csr_country: str, csr_organization: str) -> bytes:
+        cache_key = "uuid:" + entry_id
+        uuid = self._cache_get(cache_key)
+        if uuid is None:
+            uuid = self.get_entry_title(entry_id)
+            self._cache_put(cache_key, uuid)
+        return UUID(uuid)
+
+    def generate_csr(self, entry_id: str, csr_country: str, csr_organization: str, sink=None) -> bytes or int:
         """
         Request a CSR for the selected key.
         :param entry_id: the entry ID of the SS key entry
-        :return: the CSR (bytes)
+        :param sink: if given, the CSR is written part by part to sink.write() (e.g. a file)
+                     instead of being returned
+        :return: the CSR (bytes), or the number of bytes written to the sink
         """
         if self.DEBUG: print("\n>> generating CSR for key with entry ID \"{}\"".format(entry_id))
         uuid = self.get_uuid(entry_id)
@@ -570,38 +975,100 @@ class SimProtocol:
         try:
             _, code = self._send_cmd_in_chunks(STK_APP_CSR_GENERATE_FIRST, args)
             data, code = self._get_response(code)  # get first part of CSR
-            data, code = self._get_more_data(code, data, STK_APP_CSR_GENERATE_NEXT)  # get next part of CSR
+            if sink is not None:
+                sink = _LengthCounter(sink)
+            data, code = self._get_more_data(code, data, STK_APP_CSR_GENERATE_NEXT, sink=sink)  # get next part of CSR
         finally:
             self._finish_AT_session()
 
         if code == STK_OK:
-            return data
+            return bytes(data) if sink is None else sink.written
 
         raise Exception("getting CSR failed: {}".format(code))
 
-    def get_certificate(self, certificate_entry_id: str) -> bytes:
+    def get_certificate(self, certificate_entry_id: str, sink=None) -> bytes or int:
         """
         Retrieve the X.509 certificate with the given entry ID
         :param certificate_entry_id: the entry ID of the SS certificate entry
-        :return: the certificate (bytes)
+        :param sink: if given, the certificate is written part by part to sink.write() (e.g. a file)
+                     while it is read from the SIM, instead of being returned. Certificates streamed
+                     to a sink are not added to the identity cache.
+        :return: the certificate (bytes), or the number of bytes written to the sink
         """
         if self.DEBUG: print("\n>> getting X.509 certificate with entry ID \"{}\"".format(certificate_entry_id))
+        cache_key = "cert:" + certificate_entry_id
+        certificate = self._cache_get(cache_key)
+        if certificate is not None:
+            if sink is not None:
+                sink.write(certificate)
+                return len(certificate)
+            return certificate
+
         self._prepare_AT_session()
         try:
             # select SS certificate entry
             data, code = self._select_ss_entry(certificate_entry_id)
             if code == STK_OK:
                 # get the certificate
-                data, code = self._execute(STK_APP_CERT_GET.format(0))
-                data, code = self._get_more_data(code, data, STK_APP_CERT_GET.format(1))
+                data, code = self._execute(STK_APP_CERT_GET, p1=0, le=0)
+                if sink is not None:
+                    # only pass the certificate tag data on to the sink
+                    tag_filter = _TagFilter(0xc3, sink)
+                    _, code = self._get_more_data(code, data, STK_APP_CERT_GET, p1=1, sink=tag_filter)
+                    if code == STK_OK:
+                        tag_filter.close()
+                        return tag_filter.written
+                    raise Exception(code)
+
+                data, code = self._get_more_data(code, data, STK_APP_CERT_GET, p1=1)
                 if code == STK_OK:
-                    return [tag[1] for tag in _decode_tag(data) if tag[0] == 0xc3][0]
+                    certificate = bytes(_find_tag(data, 0xc3))
+                    self._cache_put(cache_key, certificate)
+                    return certificate
 
             raise Exception(code)
         finally:
             self._finish_AT_session()
 
-    def sign(self, entry_id: str, value: bytes, protocol_version: int, hash_before_sign: bool = False) -> bytes:
+    def _sign_init(self, entry_id: str, protocol_version: int) -> str:
+        """
+        Initialize a signing operation with the given entry_id key.
+        Requires an active AT session.
+        :param entry_id: the key to use for signing
+        :param protocol_version: the protocol version (including flags) to use
+        :return: the code response from the operation
+        """
+        args = _encode_tag([(0xC4, ('_' + entry_id).encode()), (0xD0, bytes([0x21]))], self._tags)
+        _, code = self._execute(STK_APP_SIGN_INIT, args, p1=protocol_version)
+        return code
+
+    def _sign_final(self, value: bytes) -> (bytes, str):
+        """
+        Send the message to sign after a successful sign init and get the signed message.
+        Requires an active AT session.
+        :param value: the message to sign
+        :return: the data and code response from the operation
+        """
+        _, code = self._send_cmd_in_chunks(STK_APP_SIGN_FINAL, value)
+        if code[0:2] != '61':
+            return b'', code
+        return self._get_response(code)
+
+    def _hash_mode(self, protocol_version: int, hash_before_sign: bool, hash_on_host: bool) -> int:
+        """
+        Get the protocol version to use for the sign init command according to the hashing mode.
+        :return: the protocol version, with the flag for automatic hashing by the SIM set if required
+        """
+        if hash_before_sign:
+            if hash_on_host:
+                if self.DEBUG: print(">> data will be hashed before signing (SHA256 digest is sent to SIM)")
+            else:
+                if self.DEBUG: print(">> data will be hashed by SIM before singing")
+                protocol_version |= 0x40  # set flag for automatic hashing
+        return protocol_version
+
+    def sign(self, entry_id: str, value: bytes, protocol_version: int, hash_before_sign: bool = False,
+             hash_on_host: bool = False) -> bytes:
         """
         Sign a message using the given entry_id key.
         :param entry_id: the key to use for signing
@@ -610,19 +1077,18 @@ class SimProtocol:
                                  0x22 = Ubirch Proto v2 signed message
                                  0x23 = Ubirch Proto v2 chained message
         :param hash_before_sign: the message will be hashed before it is used to build the UPP
+        :param hash_on_host: the message is hashed (SHA256) here and only the digest is sent to the SIM,
+                             instead of letting the SIM hash the whole message (only with hash_before_sign)
         :return: the signed message or throws an exceptions if failed
         """
-        if hash_before_sign:
-            if self.DEBUG: print(">> data will be hashed by SIM before singing")
-            protocol_version |= 0x40  # set flag for automatic hashing
-        args = _encode_tag([(0xC4, ('_' + entry_id).encode()), (0xD0, bytes([0x21]))])
+        protocol_version = self._hash_mode(protocol_version, hash_before_sign, hash_on_host)
+        if hash_before_sign and hash_on_host:
+            value = hashlib.sha256(value).digest()
         self._prepare_AT_session()
         try:
-            _, code = self._execute(STK_APP_SIGN_INIT.format(protocol_version, int(len(args) / 2), args))
+            code = self._sign_init(entry_id, protocol_version)
             if code == STK_OK:
-                args = binascii.hexlify(value).decode()
-                _, code = self._send_cmd_in_chunks(STK_APP_SIGN_FINAL, args)
-                data, code = self._get_response(code)
+                data, code = self._sign_final(value)
                 if code == STK_OK:
                     return data
 
@@ -630,6 +1096,60 @@ class SimProtocol:
         finally:
             self._finish_AT_session()
 
+    def sign_many(self, entry_id: str, values: [bytes], protocol_version: int,
+                  hash_before_sign: bool = False, hash_on_host: bool = False) -> [bytes]:
+        """
+        Sign a list of messages using the given entry_id key within a single AT session.
+        The sign init command is only sent once for the whole batch if the SIM application
+        accepts further messages after a finished signing operation, otherwise the
+        initialization is repeated for every message. This is probed with the first batch,
+        later batches use the result.
+        :param entry_id: the key to use for signing
+        :param values: the messages to sign
+        :param protocol_version: 0x00 = regular signing
+                                 0x22 = Ubirch Proto v2 signed message
+                                 0x23 = Ubirch Proto v2 chained message
+        :param hash_before_sign: the messages will be hashed before they are used to build the UPPs
+        :param hash_on_host: the messages are hashed (SHA256) here and only the digests are sent to the SIM
+        :return: the list of signed messages (in the order of values) or throws an exception if failed
+        """
+        protocol_version = self._hash_mode(protocol_version, hash_before_sign, hash_on_host)
+        signed = []
+        self._prepare_AT_session()
+        try:
+            initialized = False
+            reuse_init = self._sign_init_reusable is not False
+            for value in values:
+                if hash_before_sign and hash_on_host:
+                    value = hashlib.sha256(value).digest()
+
+                if not initialized:
+                    code = self._sign_init(entry_id, protocol_version)
+                    if code != STK_OK:
+                        raise Exception(code)
+
+                data, code = self._sign_final(value)
+                if code == STK_OK and initialized:
+                    self._sign_init_reusable = True
+                elif code != STK_OK and initialized:
+                    # the applet does not accept another message without a new sign init
+                    if self.DEBUG: print(">> sign init not reusable ({}), initializing every message".format(code))
+                    reuse_init = self._sign_init_reusable = False
+                    code = self._sign_init(entry_id, protocol_version)
+                    if code != STK_OK:
+                        raise Exception(code)
+                    data, code = self._sign_final(value)
+
+                if code != STK_OK:
+                    raise Exception(code)
+
+                signed.append(data)
+                initialized = reuse_init
+
+            return signed
+        finally:
+            self._finish_AT_session()
+
     def verify(self, entry_id: str, value: bytes, protocol_version: int) -> bool:
         """
         Verify a signed message using the given entry_id key.
@@ -639,13 +1159,12 @@ class SimProtocol:
                                  0x23 = Ubirch Proto v2 chained message
         :return: the verification response or throws an exceptions if failed
         """
-        args = _encode_tag([(0xC4, entry_id.encode()), (0xD0, bytes([0x21]))])
+        args = _encode_tag([(0xC4, entry_id.encode()), (0xD0, bytes([0x21]))], self._tags)
         self._prepare_AT_session()
         try:
-            _, code = self._execute(STK_APP_VERIFY_INIT.format(protocol_version, int(len(args) / 2), args))
+            _, code = self._execute(STK_APP_VERIFY_INIT, args, p1=protocol_version)
             if code == STK_OK:
-                args = binascii.hexlify(value).decode()
-                _, code = self._send_cmd_in_chunks(STK_APP_VERIFY_FINAL, args)
+                _, code = self._send_cmd_in_chunks(STK_APP_VERIFY_FINAL, value)
                 if code == STK_OK:
                     return True
                 if code == '6988':
@@ -655,27 +1174,47 @@ class SimProtocol:
         finally:
             self._finish_AT_session()
 
-    def message_signed(self, name: str, payload: bytes, hash_before_sign: bool = False) -> bytes:
+    def message_signed(self, name: str, payload: bytes, hash_before_sign: bool = False,
+                       hash_on_host: bool = False) -> bytes:
         """
         Create a signed ubirch message (UPP)
         :param name: the key entry_id to use for signing
         :param payload: the data to be included in the message
         :param hash_before_sign: payload will be hashed before it is used to build the UPP
+        :param hash_on_host: payload is hashed here instead of on the SIM (only with hash_before_sign)
         :return: the signed message or throws an exceptions if failed
         """
         if self.DEBUG: print("\n>> creating signed UPP using key \"_{}\"".format(name))
-        return self.sign(name, payload, APP_UBIRCH_SIGNED, hash_before_sign=hash_before_sign)
+        return self.sign(name, payload, APP_UBIRCH_SIGNED, hash_before_sign=hash_before_sign,
+                         hash_on_host=hash_on_host)
 
-    def message_chained(self, name: str, payload: bytes, hash_before_sign: bool = False) -> bytes:
+    def message_chained(self, name: str, payload: bytes, hash_before_sign: bool = False,
+                        hash_on_host: bool = False) -> bytes:
         """
         Create a chained ubirch message (UPP)
         :param name: the key entry_id to use for signing
         :param payload: the data to be included in the message
         :param hash_before_sign: payload will be hashed before it is used to build the UPP
+        :param hash_on_host: payload is hashed here instead of on the SIM (only with hash_before_sign)
         :return: the chained message or throws an exceptions if failed
         """
         if self.DEBUG: print("\n>> creating chained UPP using key \"_{}\"".format(name))
-        return self.sign(name, payload, APP_UBIRCH_CHAINED, hash_before_sign=hash_before_sign)
+        return self.sign(name, payload, APP_UBIRCH_CHAINED, hash_before_sign=hash_before_sign,
+                         hash_on_host=hash_on_host)
+
+    def message_chained_batch(self, name: str, payloads: [bytes], hash_before_sign: bool = False,
+                              hash_on_host: bool = False) -> [bytes]:
+        """
+        Create chained ubirch messages (UPPs) for a list of payloads within a single AT session.
+        :param name: the key entry_id to use for signing
+        :param payloads: the data to be included in the messages, in chain order
+        :param hash_before_sign: payloads will be hashed before they are used to build the UPPs
+        :param hash_on_host: payloads are hashed here instead of on the SIM (only with hash_before_sign)
+        :return: the list of chained messages or throws an exceptions if failed
+        """
+        if self.DEBUG: print("\n>> creating {} chained UPPs using key \"_{}\"".format(len(payloads), name))
+        return self.sign_many(name, payloads, APP_UBIRCH_CHAINED, hash_before_sign=hash_before_sign,
+                              hash_on_host=hash_on_host)
 
     def message_verify(self, name: str, upp: bytes) -> bool:
         """
@@ -1,12 +1,340 @@
+import time
 import usocket
 
+try:
+    import uerrno as errno
+except ImportError:
+    import errno
+
+# idle keep-alive connections: (proto, host, port) -> socket
+_pool = {}
+MAX_POOL_SIZE = 2
+
+# TLS sessions of the last connections: (host, port) -> session (pycom ussl.save_session), used to
+# resume the session with an abbreviated handshake on the next connection to the same host
+_sessions = {}
+
+# DNS cache: host -> [IP address, time of the lookup], optionally persisted in a file
+_dns_cache = None  # loaded on first use
+_dns_cache_file = None
+_dns_cache_ttl = 0
+
+
+class Timeout(OSError):
+    """A phase of the request took longer than its timeout."""
+    pass
+
+
+class DNSTimeout(Timeout):
+    pass
+
+
+class ConnectTimeout(Timeout):
+    pass
+
+
+class HandshakeTimeout(Timeout):
+    pass
+
+
+class FirstByteTimeout(Timeout):
+    pass
+
+
+class BodyTimeout(Timeout):
+    pass
+
+
+# phases of a request, timed in ms in Response.timing
+TIMING_PHASES = ("dns", "connect", "handshake", "first_byte", "body")
+
+
+def _new_timing():
+    timing = {"bytes_sent": 0, "bytes_received": 0, "reused": False}
+    for phase in TIMING_PHASES:
+        timing[phase] = 0
+    return timing
+
+
+def _add_time(timing, phase, start):
+    """Add the time since start (time.ticks_ms()) to a phase."""
+    if timing is not None:
+        timing[phase] += time.ticks_diff(time.ticks_ms(), start)
+
+
+def _timeout(timeout, phase):
+    """Get the timeout of a phase ("dns", "connect", "handshake", "first_byte" or "body")."""
+    if isinstance(timeout, dict):
+        return timeout.get(phase)
+    return timeout
+
+
+def _is_timeout(e):
+    return e.args and e.args[0] in (errno.ETIMEDOUT, errno.EAGAIN)
+
+
+def _phase_error(e, timeout, cls, what):
+    """Convert a socket timeout into the exception of the phase."""
+    if timeout is not None and _is_timeout(e):
+        return cls(errno.ETIMEDOUT, what + " timed out")
+    return e
+
+
+def enable_dns_cache(file=None, ttl=3600):
+    """
+    Cache the addresses of resolved hosts for ttl seconds (getaddrinfo does not return the TTL of
+    the DNS records, so a fixed TTL is used). If a file is given, the cache is stored in the file,
+    so it persists across deepsleep. If a lookup fails, an expired entry is used instead.
+    """
+    global _dns_cache, _dns_cache_file, _dns_cache_ttl
+    _dns_cache = None
+    _dns_cache_file = file
+    _dns_cache_ttl = ttl
+
+
+def _dns_cache_load():
+    global _dns_cache
+    _dns_cache = {}
+    if _dns_cache_file is not None:
+        import ujson
+        try:
+            with open(_dns_cache_file, "r") as f:
+                _dns_cache = ujson.load(f)
+        except (OSError, ValueError):
+            pass
+
+
+def _dns_cache_update(host, entry):
+    if entry is None:
+        if _dns_cache.pop(host, None) is None:
+            return
+    else:
+        _dns_cache[host] = entry
+    if _dns_cache_file is not None:
+        import ujson
+        try:
+            with open(_dns_cache_file, "w") as f:
+                ujson.dump(_dns_cache, f)
+        except OSError:
+            pass
+
+
+def _resolve(host, port, timeout=None):
+    """
+    Get the address of a host, from the DNS cache if it is enabled.
+    :return: the address, if the address is from the cache
+    """
+    if _dns_cache_ttl <= 0:
+        return _lookup(host, port, timeout), False
+    if _dns_cache is None:
+        _dns_cache_load()
+
+    entry = _dns_cache.get(host)
+    # the entry is expired if the board time changed (e.g. was not set when the entry was stored)
+    if entry is not None and 0 <= time.time() - entry[1] < _dns_cache_ttl:
+        return (entry[0], port), True
+
+    try:
+        addr = _lookup(host, port, timeout)
+    except OSError:
+        if entry is None:
+            raise
+        return (entry[0], port), True  # lookup failed, use the expired entry
+
+    _dns_cache_update(host, [addr[0], int(time.time())])
+    return addr, False
+
+
+def _lookup(host, port, timeout=None):
+    usocket.dnsserver(1, '8.8.4.4')
+    usocket.dnsserver(0, '8.8.8.8')
+    # print(usocket.dnsserver())
+
+    # getaddrinfo blocks and can't be interrupted, a failed lookup that took
+    # longer than the timeout is reported as DNSTimeout
+    start = time.ticks_ms()
+    try:
+        ai = usocket.getaddrinfo(host, port)
+    except OSError:
+        if timeout is not None and time.ticks_diff(time.ticks_ms(), start) >= timeout * 1000:
+            raise DNSTimeout(errno.ETIMEDOUT, "DNS lookup of {} timed out".format(host))
+        raise
+    # print(ai[0][-1])
+    return ai[0][-1]
+
+
+def _release(key, s):
+    """Put the socket of a finished keep-alive request back into the pool."""
+    old = _pool.pop(key, None)
+    if old is not None:
+        old.close()
+    if len(_pool) >= MAX_POOL_SIZE:
+        _pool.pop(next(iter(_pool))).close()
+    _pool[key] = s
+
+
+# reused buffer for the request line and headers, grown if a request needs more
+_header_buf = bytearray(512)
+_RECV_SIZE = 512  # maximal bytes per receive of the buffered response reader
+MAX_BODY_SIZE = 16 * 1024  # default maximal size of response bodies, 0 for unlimited
+
+# reused buffer for streamed request bodies: room for a chunk size line, a block of data and CRLF
+_BLOCK_SIZE = 512
+_CHUNK_HEADER = 6  # "200\r\n" at most, for blocks up to 0xFFF bytes
+_block_buf = bytearray(_CHUNK_HEADER + _BLOCK_SIZE + 2)
+
+
+def _put(idx, data):
+    """Write data into the header buffer at idx, return the index after the data."""
+    global _header_buf
+    if isinstance(data, str):
+        data = data.encode()
+    end = idx + len(data)
+    if end > len(_header_buf):
+        _header_buf = _header_buf + bytearray(end - len(_header_buf) + 256)
+    _header_buf[idx:end] = data
+    return end
+
+
+class _Reader:
+    """
+    Buffered reader on a socket. The status line and headers are parsed from blocks received
+    at once, instead of reading them byte by byte with socket.readline().
+    """
+
+    def __init__(self, s):
+        self.sock = s
+        self._buf = b""  # received data that was not consumed yet
+        self.received = 0  # bytes received from the socket
+
+    def _recv(self):
+        data = self.sock.recv(_RECV_SIZE)
+        if data:
+            self.received += len(data)
+            self._buf = self._buf + data if self._buf else data
+        return len(data) if data else 0
+
+    def pending(self):
+        return len(self._buf)
+
+    def readline(self):
+        while True:
+            idx = self._buf.find(b"\n")
+            if idx >= 0:
+                line = self._buf[:idx + 1]
+                self._buf = self._buf[idx + 1:]
+                return line
+            if not self._recv():
+                line = self._buf
+                self._buf = b""
+                return line
+
+    def readinto(self, buf, size):
+        """Read at most size bytes into buf (a memoryview), 0 if the connection was closed."""
+        if self._buf:
+            n = min(size, len(self._buf))
+            buf[:n] = self._buf[:n]
+            self._buf = self._buf[n:]
+            return n
+        n = self.sock.readinto(buf, size) or 0
+        self.received += n
+        return n
+
+    def close(self):
+        self.sock.close()
+
+
+def _stream_length(data):
+    """Get the remaining length of a file-like body with seek() and tell(), None if it is not known."""
+    try:
+        pos = data.tell()
+        end = data.seek(0, 2)
+        data.seek(pos)
+        return end - pos
+    except (AttributeError, OSError):
+        return None
+
+
+def _write_block(s, n, chunked):
+    """Send the n bytes in the block buffer, as a chunk if chunked, return the bytes written."""
+    mv = memoryview(_block_buf)
+    if not chunked:
+        s.write(mv[_CHUNK_HEADER:_CHUNK_HEADER + n])
+        return n
+    size = ("%x\r\n" % n).encode()
+    start = _CHUNK_HEADER - len(size)
+    mv[start:_CHUNK_HEADER] = size
+    mv[_CHUNK_HEADER + n:_CHUNK_HEADER + n + 2] = b"\r\n"
+    s.write(mv[start:_CHUNK_HEADER + n + 2])
+    return _CHUNK_HEADER + n + 2 - start
+
+
+def _write_stream(s, data, length):
+    """
+    Send a file-like or iterable body in blocks of _BLOCK_SIZE bytes,
+    with chunked transfer-encoding if the length is None.
+    Return the number of bytes written, including the chunk framing.
+    """
+    mv = memoryview(_block_buf)
+    block = mv[_CHUNK_HEADER:_CHUNK_HEADER + _BLOCK_SIZE]
+    sent = 0
+    written = 0
+    if hasattr(data, "read"):
+        while True:
+            if hasattr(data, "readinto"):
+                n = data.readinto(block)
+            else:
+                part = data.read(_BLOCK_SIZE)
+                n = len(part)
+                block[:n] = part
+            if not n:
+                break
+            written += _write_block(s, n, length is None)
+            sent += n
+    else:
+        for part in data:
+            if isinstance(part, str):
+                part = part.encode()
+            part = memoryview(part)
+            for i in range(0, len(part), _BLOCK_SIZE):
+                n = min(_BLOCK_SIZE, len(part) - i)
+                block[:n] = part[i:i + n]
+                written += _write_block(s, n, length is None)
+            sent += len(part)
+
+    if length is None:
+        s.write(b"0\r\n\r\n")
+        written += 5
+    elif sent != length:
+        raise ValueError("body has {} bytes, expected {}".format(sent, length))
+    return written
+
+
+def close_all():
+    """Close all idle keep-alive connections, e.g. before the network connection is closed."""
+    while _pool:
+        _pool.popitem()[1].close()
+
 
 class Response:
-    def __init__(self, f):
+    def __init__(self, f, pool_key=None, length=None, chunked=False, max_size=None, truncate=False):
         self.raw = f
         self.encoding = "utf-8"
         self._cached = None
         self.status_code = None
+        # keep-alive connections are put back into the pool after the body was read
+        self._pool_key = pool_key
+        self._length = length
+        self._chunked = chunked
+        # bytes left of the body or the current chunk, None: until the connection is closed
+        self._remaining = 0 if chunked else length
+        self._received = 0
+        self._max_size = MAX_BODY_SIZE if max_size is None else max_size
+        self._truncate = truncate
+        self.truncated = False  # the body was cut at the maximal body size (truncate=True)
+        self.timeout = None  # timeout of the socket operations reading the body
+        # durations of the phases of the request in ms and the transferred bytes, see request()
+        self.timing = _new_timing()
 
     def close(self):
         if self.raw:
@@ -14,14 +342,119 @@ class Response:
             self.raw = None
         self._cached = None
 
+    def _finish(self):
+        if self._pool_key is not None and not self.raw.pending():
+            _release(self._pool_key, self.raw.sock)
+        else:
+            self.raw.close()  # unexpected data after the body, don't reuse the connection
+        self.raw = None
+
+    def readinto(self, buf):
+        """
+        Read the next part of the body into buf (e.g. a preallocated bytearray).
+        Raises ValueError if the body exceeds the maximal body size, unless the response truncates
+        the body (the connection is closed, the rest of the body is not read).
+        :return: the number of bytes read, 0 at the end of the body
+        """
+        if self.raw is None:
+            return 0
+        raw = self.raw
+        start = time.ticks_ms()
+        try:
+            return self._readinto(buf)
+        finally:
+            _add_time(self.timing, "body", start)
+            self.timing["bytes_received"] = raw.received
+
+    def _readinto(self, buf):
+        try:
+            if self._chunked and self._remaining == 0:
+                if self._received > 0:
+                    self.raw.readline()  # CRLF after the chunk data
+                l = self.raw.readline()
+                if not l:
+                    raise OSError("connection closed")
+                self._remaining = int(l.split(b";", 1)[0].strip(), 16)
+                if self._remaining == 0:
+                    # last chunk, skip the trailer
+                    while True:
+                        l = self.raw.readline()
+                        if not l or l == b"\r\n":
+                            break
+                    self._finish()
+                    return 0
+
+            n = len(buf) if self._remaining is None else min(len(buf), self._remaining)
+            if n == 0:
+                self._finish()
+                return 0
+            if self._max_size:
+                if self._truncate and self._received >= self._max_size:
+                    self.truncated = True
+                    self.close()
+                    return 0
+                n = min(n, self._max_size - self._received + (0 if self._truncate else 1))
+            n = self.raw.readinto(memoryview(buf), n)
+            if n == 0:
+                if self._remaining is not None:
+                    raise OSError("connection closed")
+                self._finish()
+                return 0
+
+            self._received += n
+            if self._max_size and self._received > self._max_size:
+                raise ValueError("response body exceeds {} bytes".format(self._max_size))
+            if self._remaining is not None:
+                self._remaining -= n
+                if self._remaining == 0 and not self._chunked:
+                    self._finish()
+            return n
+        except OSError as e:
+            self.close()
+            raise _phase_error(e, self.timeout, BodyTimeout, "receiving the response body")
+        except Exception:
+            self.close()
+            raise
+
+    def iter_content(self, chunk_size=256):
+        """
+        Iterate over the body in parts of at most chunk_size bytes, without reading it completely.
+        """
+        buf = bytearray(chunk_size)
+        while True:
+            n = self.readinto(buf)
+            if n == 0:
+                return
+            yield bytes(memoryview(buf)[:n])
+
     @property
     def content(self):
         if self._cached is None:
-            try:
-                self._cached = self.raw.read()
-            finally:
-                self.raw.close()
-                self.raw = None
+            if self._remaining is not None and not self._chunked:
+                # known length: read directly into a buffer of the body size
+                size = self._remaining
+                if self._truncate and self._max_size and size > self._max_size:
+                    size = self._max_size
+                buf = bytearray(size)
+                mv = memoryview(buf)
+                idx = 0
+                while idx < len(buf):
+                    idx += self.readinto(mv[idx:])
+                if self.raw is not None:
+                    if self._remaining:
+                        self.truncated = True
+                        self.close()
+                    else:
+                        self._finish()
+            else:
+                buf = bytearray()
+                part = bytearray(256)
+                while True:
+                    n = self.readinto(part)
+                    if n == 0:
+                        break
+                    buf.extend(memoryview(part)[:n])
+            self._cached = bytes(buf)
         return self._cached
 
     @property
@@ -33,8 +466,99 @@ class Response:
         return ujson.loads(self.content)
 
 
-def request(method, url, data=None, json=None, headers={}, stream=None):
-    # print("request POST " + url)
+def _connect(proto, host, port, timeout=None, timing=None):
+    start = time.ticks_ms()
+    try:
+        addr, cached = _resolve(host, port, _timeout(timeout, "dns"))
+    finally:
+        _add_time(timing, "dns", start)
+    try:
+        return _open(proto, host, port, addr, timeout, timing)
+    except OSError:
+        if not cached:
+            raise
+    # the cached address may be outdated, look it up again
+    _dns_cache_update(host, None)
+    start = time.ticks_ms()
+    try:
+        addr, _ = _resolve(host, port, _timeout(timeout, "dns"))
+    finally:
+        _add_time(timing, "dns", start)
+    return _open(proto, host, port, addr, timeout, timing)
+
+
+def _connect_socket(s, addr, timeout):
+    """Connect the socket, with a non-blocking connect if there is a timeout."""
+    if timeout is None:
+        s.connect(addr)
+        return
+
+    import uselect
+    s.setblocking(False)
+    try:
+        s.connect(addr)
+    except OSError as e:
+        if e.args[0] not in (errno.EINPROGRESS, errno.EALREADY):
+            raise
+    poller = uselect.poll()
+    poller.register(s, uselect.POLLOUT)
+    events = poller.poll(int(timeout * 1000))
+    if not events:
+        raise ConnectTimeout(errno.ETIMEDOUT, "connect to {} timed out".format(addr[0]))
+    if events[0][1] & (uselect.POLLERR | uselect.POLLHUP):
+        raise OSError(errno.ECONNREFUSED, "connect to {} failed".format(addr[0]))
+    s.setblocking(True)
+
+
+def _open(proto, host, port, addr, timeout=None, timing=None):
+    s = usocket.socket()
+    start = time.ticks_ms()
+    try:
+        _connect_socket(s, addr, _timeout(timeout, "connect"))
+    except OSError:
+        s.close()
+        raise
+    finally:
+        _add_time(timing, "connect", start)
+    if proto != "https:":
+        return s
+    return _handshake(s, host, port, addr, timeout, timing)
+
+
+def _handshake(s, host, port, addr, timeout=None, timing=None):
+    """Wrap a connected socket with TLS, resuming the last session with the host if there is one."""
+    import ussl
+    session = _sessions.pop((host, port), None)
+    handshake_timeout = _timeout(timeout, "handshake")
+    s.settimeout(handshake_timeout)
+    start = time.ticks_ms()
+    try:
+        if session is not None:
+            s = ussl.wrap_socket(s, server_hostname=host, saved_session=session)
+        else:
+            s = ussl.wrap_socket(s, server_hostname=host)
+    except OSError as e:
+        s.close()
+        _add_time(timing, "handshake", start)
+        if handshake_timeout is not None and _is_timeout(e):
+            raise HandshakeTimeout(errno.ETIMEDOUT, "TLS handshake with {} timed out".format(host))
+        if session is not None:
+            # resumption failed, fall back to a full handshake (the session was removed)
+            return _open("https:", host, port, addr, timeout, timing)
+        raise
+    _add_time(timing, "handshake", start)
+
+    # save the session for the next connection (only supported by the pycom firmware)
+    if hasattr(ussl, "save_session"):
+        try:
+            _sessions[(host, port)] = ussl.save_session(s)
+        except OSError:
+            pass
+    return s
+
+
+def _split_url(url):
+    """Split a URL into protocol, host, port and path."""
     try:
         proto, dummy, host, path = url.split("/", 3)
     except ValueError:
@@ -43,7 +567,6 @@ def request(method, url, data=None, json=None, headers={}, stream=None):
     if proto == "http:":
         port = 80
     elif proto == "https:":
-        import ussl
         port = 443
     else:
         raise ValueError("Unsupported protocol: " + proto)
@@ -51,67 +574,224 @@ def request(method, url, data=None, json=None, headers={}, stream=None):
     if ":" in host:
         host, port = host.split(":", 1)
         port = int(port)
+    return proto, host, port, path
 
-    usocket.dnsserver(1, '8.8.4.4')
-    usocket.dnsserver(0, '8.8.8.8')
-    # print(usocket.dnsserver())
 
-    ai = usocket.getaddrinfo(host, port)
-    addr = ai[0][-1]
-    # print(addr)
+def _header(method, host, path, headers, keep_alive, json, length, chunked):
+    """
+    Assemble the request line and headers in the header buffer.
+    :return: the length of the header
+    """
+    idx = _put(0, method)
+    idx = _put(idx, " /")
+    idx = _put(idx, path)
+    idx = _put(idx, " HTTP/1.1\r\n" if keep_alive or chunked else " HTTP/1.0\r\n")
+    if not "Host" in headers:
+        idx = _put(idx, "Host: ")
+        idx = _put(idx, host)
+        idx = _put(idx, "\r\n")
+    if keep_alive:
+        idx = _put(idx, "Connection: keep-alive\r\n")
+    elif chunked:
+        idx = _put(idx, "Connection: close\r\n")
+    # Iterate over keys to avoid tuple alloc
+    for k in headers:
+        idx = _put(idx, k)
+        idx = _put(idx, ": ")
+        idx = _put(idx, headers[k])
+        idx = _put(idx, "\r\n")
+    if json:
+        idx = _put(idx, "Content-Type: application/json\r\n")
+    if chunked:
+        idx = _put(idx, "Transfer-Encoding: chunked\r\n")
+    elif length is not None:
+        idx = _put(idx, "Content-Length: ")
+        idx = _put(idx, str(length))
+        idx = _put(idx, "\r\n")
+    return _put(idx, "\r\n")
 
-    s = usocket.socket()
-    if proto == "https:":
-        s = ussl.wrap_socket(s, server_hostname=host)
-    try:
-        s.connect(addr)
-        s.write(b"%s /%s HTTP/1.0\r\n" % (method, path))
-        if not "Host" in headers:
-            s.write(b"Host: %s\r\n" % host)
-        # Iterate over keys to avoid tuple alloc
-        for k in headers:
-            s.write(k)
-            s.write(b": ")
-            s.write(headers[k])
-            s.write(b"\r\n")
-        if json is not None:
-            assert data is None
-            import ujson
-            data = ujson.dumps(json)
-            s.write(b"Content-Type: application/json\r\n")
-        if data:
-            s.write(b"Content-Length: %d\r\n" % len(data))
-        s.write(b"\r\n")
-        if data:
-            s.write(data)
-
-        l = s.readline()
-        # print(l)
-        l = l.split(None, 2)
-        status = int(l[1])
-        reason = ""
-        if len(l) > 2:
-            reason = l[2].rstrip()
-        while True:
-            l = s.readline()
-            if not l or l == b"\r\n":
-                break
-            #print(l)
-            if l.startswith(b"Transfer-Encoding:"):
-                if b"chunked" in l:
-                    raise ValueError("Unsupported " + l)
-            elif l.startswith(b"Location:") and not 200 <= status <= 299:
-                raise NotImplementedError("Redirects not yet supported")
-    except OSError:
-        s.close()
-        raise
 
-    resp = Response(s)
+def _response(r, l, method, key, keep_alive, max_size, truncate=False):
+    """
+    Parse the status line l and read the headers of a response.
+    :return: the Response, to read the body from r
+    """
+    l = l.split(None, 2)
+    status = int(l[1])
+    reason = ""
+    if len(l) > 2:
+        reason = l[2].rstrip()
+    length = None
+    chunked = False
+    reusable = keep_alive
+    while True:
+        l = r.readline()
+        if not l or l == b"\r\n":
+            break
+        #print(l)
+        h = l.lower()
+        if h.startswith(b"transfer-encoding:"):
+            if b"chunked" in h:
+                chunked = True
+        elif h.startswith(b"location:") and not 200 <= status <= 299:
+            raise NotImplementedError("Redirects not yet supported")
+        elif h.startswith(b"content-length:"):
+            length = int(l[15:])
+        elif h.startswith(b"connection:") and b"close" in h:
+            reusable = False
+
+    if method == "HEAD" or status == 204 or status == 304:
+        length = 0
+        chunked = False
+    elif chunked:
+        length = None
+    max_size = MAX_BODY_SIZE if max_size is None else max_size
+    if max_size and length is not None and length > max_size and not truncate:
+        r.close()
+        raise ValueError("response body exceeds {} bytes".format(max_size))
+    if not reusable or (length is None and not chunked):
+        resp = Response(r, length=length, chunked=chunked, max_size=max_size, truncate=truncate)
+    else:
+        resp = Response(r, pool_key=key, length=length, chunked=chunked, max_size=max_size, truncate=truncate)
     resp.status_code = status
     resp.reason = reason
     return resp
 
 
+def request(method, url, data=None, json=None, headers={}, stream=None, keep_alive=False, max_size=None,
+            data_length=None, timeout=None, truncate=False):
+    """
+    timeout is either the timeout in seconds for every phase of the request or a dict with the
+    timeouts of the phases "dns", "connect", "handshake", "first_byte" (until the status line is
+    received) and "body" (sending the request, receiving headers and body, per socket operation).
+    Phases without timeout block. Timeouts raise DNSTimeout, ConnectTimeout, HandshakeTimeout,
+    FirstByteTimeout or BodyTimeout, all subclasses of Timeout (OSError). DNS lookups can't be
+    interrupted, a failed lookup that took longer than the timeout raises DNSTimeout.
+
+    data can be bytes, a file-like object (with readinto() or read(), e.g. a file opened in "rb" mode)
+    or an iterable of bytes (e.g. a generator). File-like and iterable bodies are sent in blocks of
+    _BLOCK_SIZE bytes, so they don't have to fit into RAM. They are sent with a Content-Length of
+    data_length, or of the remaining file size if the object supports seek() and tell(), otherwise
+    with chunked transfer-encoding (HTTP/1.1).
+
+    Responses with "Transfer-Encoding: chunked" are decoded. The body can be read completely with
+    Response.content or in parts with Response.iter_content() or Response.readinto(). Bodies larger
+    than max_size (default MAX_BODY_SIZE, 0 for unlimited) raise a ValueError when they are read, or with
+    truncate=True, are cut at max_size (Response.truncated is set, the connection is closed), so the
+    status code of e.g. a large error page of a proxy is still available.
+
+    With keep_alive=True the request is sent with HTTP/1.1 and "Connection: keep-alive". If the
+    server keeps the connection open, the socket is put back into a pool after the response body
+    was read and reused by the next keep-alive request to the same host (no new TCP connection and
+    TLS handshake). If a pooled connection turns out to be closed by the server, the request is
+    retried once with a new connection.
+
+    Response.timing holds the durations of the phases of the request in ms: "dns", "connect",
+    "handshake" (TLS), "first_byte" (from sending the request until the status line is received)
+    and "body" (receiving the headers and the body, updated while the body is read), as well as
+    "bytes_sent", "bytes_received" and "reused" (if a pooled connection was used). Retries on a
+    new connection are included.
+    """
+    # print("request POST " + url)
+    proto, host, port, path = _split_url(url)
+
+    if json is not None:
+        assert data is None
+        import ujson
+        data = ujson.dumps(json)
+
+    if isinstance(data, str):
+        data = data.encode()
+
+    # file-like and iterable bodies are streamed, with chunked transfer-encoding if the length is unknown
+    body = None
+    chunked_body = False
+    if data is not None and not isinstance(data, (bytes, bytearray, memoryview)):
+        body = data
+        data = None
+        if data_length is None and hasattr(body, "read"):
+            data_length = _stream_length(body)
+        chunked_body = data_length is None
+    rewind = body.tell() if body is not None and hasattr(body, "seek") and hasattr(body, "tell") else None
+
+    if data:
+        length = len(data)
+    elif body is not None:
+        length = data_length
+    else:
+        length = None
+    idx = _header(method, host, path, headers, keep_alive, json is not None, length, chunked_body)
+    # small bodies are sent in the same write as the headers
+    if data and idx + len(data) <= len(_header_buf):
+        idx = _put(idx, data)
+        data = None
+    header = memoryview(_header_buf)[:idx]
+
+    body_timeout = _timeout(timeout, "body")
+    first_byte_timeout = _timeout(timeout, "first_byte")
+    key = (proto, host, port)
+    timing = _new_timing()
+    for attempt in range(2):
+        s = _pool.pop(key, None) if keep_alive else None
+        reused = s is not None
+        if s is None:
+            s = _connect(proto, host, port, timeout, timing)
+        timing["reused"] = reused
+        r = _Reader(s)
+        body_started = False
+        start = time.ticks_ms()
+        try:
+            try:
+                s.settimeout(body_timeout)
+                s.write(header)
+                timing["bytes_sent"] += len(header)
+                if data:
+                    s.write(data)
+                    timing["bytes_sent"] += len(data)
+                elif body is not None:
+                    body_started = True
+                    timing["bytes_sent"] += _write_stream(s, body, data_length)
+            except OSError as e:
+                raise _phase_error(e, body_timeout, BodyTimeout, "sending the request")
+
+            try:
+                s.settimeout(first_byte_timeout)
+                l = r.readline()
+            except OSError as e:
+                raise _phase_error(e, first_byte_timeout, FirstByteTimeout, "waiting for the response")
+            finally:
+                _add_time(timing, "first_byte", start)
+            # print(l)
+            if not l:
+                raise OSError("connection closed")
+        except OSError:
+            s.close()
+            if reused and (not body_started or rewind is not None):
+                # the server closed the idle connection, retry with a new one
+                if body_started:
+                    body.seek(rewind)
+                continue
+            raise
+        break
+
+    start = time.ticks_ms()
+    try:
+        s.settimeout(body_timeout)
+        resp = _response(r, l, method, key, keep_alive, max_size, truncate)
+    except OSError as e:
+        s.close()
+        raise _phase_error(e, body_timeout, BodyTimeout, "receiving the response")
+    except Exception:
+        # e.g. ValueError for a malformed status line or header
+        s.close()
+        raise
+    resp.timeout = body_timeout
+    _add_time(timing, "body", start)
+    timing["bytes_received"] = r.received
+    resp.timing = timing
+    return resp
+
+
 def head(url, **kw):
     return request("HEAD", url, **kw)
 
@@ -0,0 +1,316 @@
+"""
+HTTP client on uasyncio, to have several requests in flight at the same time.
+
+The requests share the connection pool, DNS cache, TLS sessions and timeouts of urequests
+and return a urequests.Response with the body already received. The TCP connect, sending
+the request and receiving the response are done on non-blocking sockets, so the round trips
+of concurrent requests overlap. The DNS lookup and the TLS handshake block the event loop,
+as getaddrinfo and ussl.wrap_socket can't be run asynchronously (the DNS cache and the TLS
+session resumption keep them short). The sockets are polled every POLL_MS ms instead of
+using the I/O scheduling of uasyncio, which differs between its versions.
+"""
+import time
+import uasyncio
+import usocket
+import urequests
+
+try:
+    import uerrno as errno
+except ImportError:
+    import errno
+
+POLL_MS = 20  # interval in ms in which sockets that are not ready are polled again
+
+
+async def _wait(start, timeout):
+    """Wait for the next poll, raise OSError(ETIMEDOUT) if the timeout since start expired."""
+    if timeout is not None and time.ticks_diff(time.ticks_ms(), start) >= timeout * 1000:
+        raise OSError(errno.ETIMEDOUT, "timed out")
+    await uasyncio.sleep_ms(POLL_MS)
+
+
+async def _write(s, data, timeout):
+    """Write all data to a non-blocking socket, timeout is the time without progress."""
+    mv = memoryview(data)
+    idx = 0
+    start = time.ticks_ms()
+    while idx < len(mv):
+        try:
+            n = s.write(mv[idx:])
+        except OSError as e:
+            if e.args[0] != errno.EAGAIN:
+                raise
+            n = None
+        if n:
+            idx += n
+            start = time.ticks_ms()
+        else:
+            await _wait(start, timeout)
+
+
+class _Reader(urequests._Reader):
+    """
+    Buffered reader on a non-blocking socket. The data is received asynchronously into the buffer
+    with the fill methods and then parsed from the buffer by urequests, without blocking.
+    """
+
+    def _recv(self):
+        # all data is received with _arecv()
+        return 0
+
+    async def _arecv(self, timeout):
+        """Receive data into the buffer, return the number of bytes received, 0 if the connection was closed."""
+        start = time.ticks_ms()
+        while True:
+            try:
+                data = self.sock.recv(urequests._RECV_SIZE)
+            except OSError as e:
+                if e.args[0] != errno.EAGAIN:
+                    raise
+                data = None
+            if data is not None:
+                if data:
+                    self.received += len(data)
+                    self._buf = self._buf + data if self._buf else data
+                return len(data)
+            await _wait(start, timeout)
+
+    async def fill(self, marker, timeout):
+        """Receive until marker is in the buffer or the connection was closed."""
+        while self._buf.find(marker) < 0:
+            if not await self._arecv(timeout):
+                return
+
+    async def fill_size(self, size, timeout):
+        """Receive until size bytes are in the buffer or the connection was closed."""
+        while len(self._buf) < size:
+            if not await self._arecv(timeout):
+                return
+
+    async def fill_chunked(self, limit, timeout):
+        """Receive until the buffer contains a complete chunked body, limit bytes or the connection was closed."""
+        while _chunked_end(self._buf) is None and len(self._buf) <= limit:
+            if not await self._arecv(timeout):
+                return
+
+    async def fill_all(self, limit, timeout):
+        """Receive until the connection was closed or limit bytes are in the buffer."""
+        while len(self._buf) <= limit:
+            if not await self._arecv(timeout):
+                return
+
+
+def _chunked_end(buf):
+    """Get the end of a chunked body at the start of buf, None if it is not complete."""
+    pos = 0
+    while True:
+        idx = buf.find(b"\n", pos)
+        if idx < 0:
+            return None
+        size = int(buf[pos:idx].split(b";", 1)[0].strip(), 16)
+        pos = idx + 1
+        if size == 0:
+            # last chunk, the body ends with the empty line after the trailer
+            while True:
+                idx = buf.find(b"\n", pos)
+                if idx < 0:
+                    return None
+                empty = idx - pos <= 1
+                pos = idx + 1
+                if empty:
+                    return pos
+        pos += size + 2
+        if pos > len(buf):
+            return None
+
+
+async def _connect_socket(s, addr, timeout):
+    import uselect
+    s.setblocking(False)
+    try:
+        s.connect(addr)
+    except OSError as e:
+        if e.args[0] not in (errno.EINPROGRESS, errno.EALREADY):
+            raise
+    poller = uselect.poll()
+    poller.register(s, uselect.POLLOUT)
+    start = time.ticks_ms()
+    while True:
+        events = poller.poll(0)
+        if events:
+            break
+        if timeout is not None and time.ticks_diff(time.ticks_ms(), start) >= timeout * 1000:
+            raise urequests.ConnectTimeout(errno.ETIMEDOUT, "connect to {} timed out".format(addr[0]))
+        await uasyncio.sleep_ms(POLL_MS)
+    if events[0][1] & (uselect.POLLERR | uselect.POLLHUP):
+        raise OSError(errno.ECONNREFUSED, "connect to {} failed".format(addr[0]))
+
+
+async def _open(proto, host, port, addr, timeout, timing):
+    s = usocket.socket()
+    start = time.ticks_ms()
+    try:
+        await _connect_socket(s, addr, urequests._timeout(timeout, "connect"))
+    except OSError:
+        s.close()
+        raise
+    finally:
+        urequests._add_time(timing, "connect", start)
+    if proto != "https:":
+        return s
+    s.setblocking(True)
+    return urequests._handshake(s, host, port, addr, timeout, timing)
+
+
+async def _connect(proto, host, port, timeout, timing):
+    start = time.ticks_ms()
+    try:
+        addr, cached = urequests._resolve(host, port, urequests._timeout(timeout, "dns"))
+    finally:
+        urequests._add_time(timing, "dns", start)
+    try:
+        return await _open(proto, host, port, addr, timeout, timing)
+    except OSError:
+        if not cached:
+            raise
+    # the cached address may be outdated, look it up again
+    urequests._dns_cache_update(host, None)
+    start = time.ticks_ms()
+    try:
+        addr, _ = urequests._resolve(host, port, urequests._timeout(timeout, "dns"))
+    finally:
+        urequests._add_time(timing, "dns", start)
+    return await _open(proto, host, port, addr, timeout, timing)
+
+
+def request(method, url, data=None, json=None, headers={}, keep_alive=False, max_size=None, timeout=None,
+            truncate=False):
+    """
+    Prepare a request, to be awaited in a uasyncio task. The parameters are the ones of
+    urequests.request(), the body has to be bytes or str. The request line and headers are
+    assembled right away, so the headers can be changed for the next request before this
+    one is sent.
+    :return: an awaitable, which returns the urequests.Response with the body already received
+    """
+    proto, host, port, path = urequests._split_url(url)
+
+    if json is not None:
+        assert data is None
+        import ujson
+        data = ujson.dumps(json)
+
+    if isinstance(data, str):
+        data = data.encode()
+
+    idx = urequests._header(method, host, path, headers, keep_alive, json is not None,
+                            len(data) if data else None, False)
+    message = bytes(memoryview(urequests._header_buf)[:idx])
+    if data:
+        message += data
+    return _request(method, proto, host, port, message, keep_alive, max_size, timeout, truncate)
+
+
+async def _request(method, proto, host, port, message, keep_alive, max_size, timeout, truncate):
+    body_timeout = urequests._timeout(timeout, "body")
+    first_byte_timeout = urequests._timeout(timeout, "first_byte")
+    key = (proto, host, port)
+    timing = urequests._new_timing()
+    for attempt in range(2):
+        s = urequests._pool.pop(key, None) if keep_alive else None
+        reused = s is not None
+        if s is None:
+            s = await _connect(proto, host, port, timeout, timing)
+        timing["reused"] = reused
+        s.setblocking(False)
+        r = _Reader(s)
+        start = time.ticks_ms()
+        try:
+            try:
+                await _write(s, message, body_timeout)
+                timing["bytes_sent"] += len(message)
+            except OSError as e:
+                raise urequests._phase_error(e, body_timeout, urequests.BodyTimeout, "sending the request")
+
+            try:
+                await r.fill(b"\n", first_byte_timeout)
+            except OSError as e:
+                raise urequests._phase_error(e, first_byte_timeout, urequests.FirstByteTimeout,
+                                             "waiting for the response")
+            finally:
+                urequests._add_time(timing, "first_byte", start)
+            if not r.pending():
+                raise OSError("connection closed")
+        except OSError:
+            s.close()
+            if reused:
+                # the server closed the idle connection, retry with a new one
+                continue
+            raise
+        break
+
+    start = time.ticks_ms()
+    limit = urequests.MAX_BODY_SIZE if max_size is None else max_size
+    limit = limit + urequests._RECV_SIZE if limit else 1 << 30
+    try:
+        await r.fill(b"\r\n\r\n", body_timeout)
+        resp = urequests._response(r, r.readline(), method, key, keep_alive, max_size, truncate)
+        # receive the body, it is then read from the buffer by the response
+        if resp._chunked:
+            await r.fill_chunked(limit, body_timeout)
+        elif resp._remaining is None:
+            await r.fill_all(limit, body_timeout)
+        else:
+            await r.fill_size(min(resp._remaining, limit), body_timeout)
+    except OSError as e:
+        s.close()
+        raise urequests._phase_error(e, body_timeout, urequests.BodyTimeout, "receiving the response")
+    except Exception:
+        # e.g. ValueError for a malformed response or an oversized body
+        s.close()
+        raise
+    finally:
+        urequests._add_time(timing, "body", start)
+
+    s.setblocking(True)  # back to blocking mode for the pool
+    s.settimeout(body_timeout)
+    resp.timeout = body_timeout
+    resp.timing = timing
+    try:
+        resp.content  # read the body from the buffer and release the connection
+    except Exception:
+        s.close()
+        raise
+    return resp
+
+
+async def _gather(coros, results, wdt):
+    pending = [len(coros)]
+
+    async def run(i, coro):
+        try:
+            results[i] = await coro
+        except Exception as e:
+            results[i] = e
+        pending[0] -= 1
+
+    loop = uasyncio.get_event_loop()
+    for i, coro in enumerate(coros):
+        loop.create_task(run(i, coro))
+    while pending[0]:
+        if wdt is not None:
+            wdt.feed()
+        await uasyncio.sleep_ms(POLL_MS)
+
+
+def run_all(coros: list, wdt=None) -> list:
+    """
+    Run coroutines (e.g. requests) concurrently until all are finished. Feeds the watchdog in
+    the meantime, as long as the event loop is not blocked. The requests should have timeouts,
+    as the watchdog does not catch hanging requests anymore.
+    :param coros: the coroutines
+    :param wdt: the watchdog to feed, None if there is none
+    :return: the results of the coroutines in the same order, the exception for failed ones
+    """
+    results = [None] * len(coros)
+    uasyncio.get_event_loop().run_until_complete(_gather(coros, results, wdt))
+    return results
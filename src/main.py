@@ -17,11 +17,19 @@ from connection import get_connection, NB_IoT
 from error_handling import *
 from helpers import *
 from modem import get_imsi
+import at_stats
+import merkle
 from network import LTE
 from os import listdir
 from realtimeclock import *
 
 import ubirch
+import urequests
+
+try:
+    from ubirch.ubirch_api_async import AsyncAPI  # requires uasyncio, which is not part of every firmware
+except ImportError:
+    AsyncAPI = None
 
 # Pycom specifics
 from pyboard import get_pyboard
@@ -34,6 +42,27 @@ COLOR_CONFIG_FAIL = LED_YELLOW_BRIGHT
 COLOR_MODEM_FAIL = LED_PINK_BRIGHT
 COLOR_UNKNOWN_FAIL = LED_WHITE_BRIGHT
 
+
+def go_to_deepsleep():
+    """
+    Persist the AT command statistics and go to deepsleep until the next cycle.
+    """
+    # persist the AT command statistics for the next cycle
+    if cfg['at_stats']:
+        print(at_stats.dump())
+        at_stats.save("at_stats.json")
+    at_stats.stop_recording()
+    nvs_set("at_record", 1 if cfg['at_record'] else None)
+
+    # go to deepsleep
+    sleep_time = interval - int(time.time() - start_time)
+    if sleep_time < 0:
+        sleep_time = 0
+    print(">> going into deepsleep for {} seconds".format(sleep_time))
+    set_led(LED_OFF)
+    machine.deepsleep(1000 * sleep_time)  # sleep, execution will resume from main.py entry point
+
+
 #############
 #   SETUP   #
 #############
@@ -56,6 +85,10 @@ max_file_size_kb = 10240 if SD_CARD_MOUNTED else 20
 error_handler = ErrorHandler(file_logging_enabled=True, max_file_size_kb=max_file_size_kb,
                              sd_card=SD_CARD_MOUNTED)
 try:
+    # record the AT conversation of this cycle (enabled by the config of the previous cycle,
+    # as the config is only loaded after the modem was set up)
+    if nvs_get("at_record"): at_stats.start_recording("at_transcript.jsonl")
+
     # initialize modem
     lte = LTE()
 
@@ -91,6 +124,16 @@ try:
         sensors = get_pyboard(cfg['board'])  # initialise the sensors on the pyboard
         connection = get_connection(lte, cfg)  # initialize connection object depending on config
         api = ubirch.API(cfg)  # set up API for backend communication
+        # send the data message and the UPP at the same time, if possible (the requests need a timeout,
+        # as the watchdog is fed while they are in flight)
+        async_api = None
+        if cfg['http_async'] and AsyncAPI is not None and cfg['http_timeout']:
+            async_api = AsyncAPI(cfg, timing=api.timing)
+        urequests.enable_dns_cache("dns_cache.json", cfg['dns_cache_ttl'])  # cache backend addresses on flash
+
+        # accumulate the AT command statistics of this cycle with the ones of previous cycles
+        if cfg['at_stats']: at_stats.load("at_stats.json")
+        if cfg['at_record'] and not at_stats.recording(): at_stats.start_recording("at_transcript.jsonl")
     except Exception as e:
         print("\tERROR loading configuration")
         error_handler.log(e, COLOR_CONFIG_FAIL)
@@ -111,6 +154,24 @@ try:
             connection.setattachtimeout(cfg["nbiot_extended_attach_timeout"])
             connection.setconnecttimeout(cfg["nbiot_extended_connect_timeout"])
 
+    # buffered reporting: the sensors are measured in every cycle, the measurements are stored on flash and
+    # only sealed and sent every 'transmit_every' cycles (or if the store is full), so the modem only
+    # connects in these cycles (after a power cycle or error, the measurement is sent right away)
+    measurements = Backlog(("/sd/" if SD_CARD_MOUNTED else "") + "measurements.bin", cfg['backlog_size_kb'] * 1024)
+    measured = False
+    if board_time_valid():  # otherwise the time is synchronized before measuring
+        set_led(LED_BLUE)
+        print("++ getting measurements")
+        record_size = store_measurement(measurements, sensors.get_data(), cfg['data_format'])
+        measured = True
+        if COMING_FROM_DEEPSLEEP and len(measurements) < cfg['transmit_every'] and measurements.free() >= record_size:
+            print("\tstored measurement {} of {}".format(len(measurements), cfg['transmit_every']))
+            set_led(LED_YELLOW)
+            print("++ preparing hardware for deepsleep")
+            print("\tdeinit LTE")
+            lte.deinit(detach=False)
+            go_to_deepsleep()
+
     # get PIN from flash, or bootstrap from backend and then save PIN to flash
     pin_file = imsi + ".bin"
     pin = get_pin_from_flash(pin_file, imsi)
@@ -131,14 +192,19 @@ try:
     # (this is only necessary if we are connected via LTE)
     if isinstance(connection, NB_IoT):
         print("\tdisconnecting")
+        api.close()  # the pooled keep-alive connections (bootstrap, CSR) don't survive the disconnect
         connection.disconnect()
 
     set_led(LED_ORANGE)
 
-    # initialise ubirch SIM protocol
+    # initialise ubirch SIM protocol (resume the SIM channel that was kept open during deepsleep, if there is one)
     print("++ initializing ubirch SIM protocol")
+    sim_channel = None
+    if COMING_FROM_DEEPSLEEP and cfg['sim_keep_channel']:
+        sim_channel = nvs_get("sim_channel")
     try:
-        sim = ubirch.SimProtocol(lte=lte, at_debug=lvl_debug)
+        sim = ubirch.SimProtocol(lte=lte, at_debug=lvl_debug, channel=sim_channel, at_length_file="at_length.txt",
+                                 identity_cache_file="identity_cache.json", sim_id=imsi)
     except Exception as e:
         error_handler.log(e, COLOR_SIM_FAIL, reset=True)
 
@@ -159,7 +225,7 @@ try:
         else:
             machine.reset()
 
-    # get UUID from SIM
+    # get UUID from SIM (cached on flash after the first time)
     key_name = "ukey"
     uuid = sim.get_uuid(key_name)
     print("UUID: " + str(uuid))
@@ -197,6 +263,7 @@ try:
 
     if isinstance(connection, NB_IoT):
         print("\tdisconnecting")
+        api.close()  # the pooled keep-alive connections (bootstrap, CSR) don't survive the disconnect
         connection.disconnect()
 
     ############
@@ -204,25 +271,54 @@ try:
     ############
     set_led(LED_BLUE)
 
-    # get data from sensors
-    print("++ getting measurements")
-    data = sensors.get_data()
-
-    # pack data message containing measurements as well as device UUID and timestamp to ensure unique hash
-    message = pack_data_json(uuid, data)
-    print("\tdata message [json]: {}\n".format(message.decode()))
+    # get data from sensors, if it was not done before the board time was synchronized
+    if not measured:
+        print("++ getting measurements")
+        store_measurement(measurements, sensors.get_data(), cfg['data_format'])
+
+    # pack data messages containing the stored measurements as well as device UUID and the time of the
+    # measurement to ensure unique hash
+    last_measurement, messages = pack_measurements(uuid, measurements, cfg['data_format'])
+    for message in messages:
+        if cfg['data_format'] == "msgpack":
+            print("\tdata message [msgpack]: {}\n".format(hexlify(message).decode()))
+        else:
+            print("\tdata message [json]: {}\n".format(message.decode()))
 
-    # seal the data message (data message will be hashed and inserted into UPP as payload by SIM card)
+    # seal the data messages in one AT session (data messages will be hashed and the hashes inserted into UPPs as
+    # payload by SIM card, hashing is done on the board so only the 32 byte digests have to be transferred to the SIM)
+    # or, with 'merkle_batch', seal only the root of a merkle tree over the data messages with one UPP, the data
+    # messages are sent with their inclusion proofs
+    merkle_batch = cfg['merkle_batch'] and len(messages) > 1
     try:
         print("++ creating UPP")
-        upp = sim.message_chained(key_name, message, hash_before_sign=True)
-        print("\tUPP: {}\n".format(hexlify(upp).decode()))
-        # print data message hash from generated UPP (useful for manual verification)
-        message_hash = get_upp_payload(upp)
-        print("\tdata message hash: {}".format(b2a_base64(message_hash).decode()))
+        if merkle_batch:
+            root, proofs = merkle.build(messages)
+            print("\tmerkle root of {} data messages: {}".format(len(messages), b2a_base64(root).decode()))
+            upps = [sim.message_chained(key_name, root)]
+        else:
+            upps = sim.message_chained_batch(key_name, messages, hash_before_sign=True, hash_on_host=True)
+        for upp in upps:
+            print("\tUPP: {}\n".format(hexlify(upp).decode()))
+            # print data message hash from generated UPP (useful for manual verification)
+            message_hash = get_upp_payload(upp)
+            print("\tdata message hash: {}".format(b2a_base64(message_hash).decode()))
     except Exception as e:
         error_handler.log(e, COLOR_SIM_FAIL, reset=True)
 
+    # store data messages and UPPs in the backlog until the backend accepted them, so they are sent
+    # in one of the next cycles if sending fails (the UPPs are chained, a lost UPP breaks the chain)
+    backlog = Backlog(("/sd/" if SD_CARD_MOUNTED else "") + "backlog.bin", cfg['backlog_size_kb'] * 1024)
+    if merkle_batch:
+        for i, message in enumerate(messages):
+            backlog.append(KIND_DATA_PROOF, merkle.encode_proof(i, len(messages), proofs[i]) + message)
+        backlog.append(KIND_UPP, upps[0])
+    else:
+        for message, upp in zip(messages, upps):
+            backlog.append(KIND_DATA, message)
+            backlog.append(KIND_UPP, upp)
+    measurements.ack(last_measurement)
+
     ###############
     #   SENDING   #
     ###############
@@ -235,31 +331,22 @@ try:
     except Exception as e:
         error_handler.log(e, COLOR_INET_FAIL, reset=True)
 
-    # send data to ubirch data service and UPP to ubirch auth service
-    # TODO: add retrying to send/handling of already created UPP in case of final failure
-
+    # send data to ubirch data service and UPP to ubirch auth service, together with the messages
+    # from the backlog that could not be sent in previous cycles
     try:
-        # send data message to data service, with reconnects/modem resets if necessary
-        print("++ sending data")
-        try:
-            status_code, content = send_backend_data(sim, lte, connection, api.send_data, uuid, message)
-        except Exception as e:
-            error_handler.log(e, COLOR_MODEM_FAIL, reset=True)
-
-        # communication worked in general, now check server response
-        if not 200 <= status_code < 300:
-            raise Exception("backend (data) returned error: ({}) {}".format(status_code, str(content)))
-
-        # send UPP to the ubirch authentication service to be anchored to the blockchain
-        print("++ sending UPP")
+        print("++ sending data and UPP")
         try:
-            status_code, content = send_backend_data(sim, lte, connection, api.send_upp, uuid, upp)
+            if cfg['http_batch']:
+                error = send_backlog(sim, lte, connection, wdt, backlog, uuid, api, async_api,
+                                     batch_size=cfg['http_batch'], batch=True)
+            else:
+                error = send_backlog(sim, lte, connection, wdt, backlog, uuid, api, async_api)
         except Exception as e:
             error_handler.log(e, COLOR_MODEM_FAIL, reset=True)
 
-        # communication worked in general, now check server response
-        if not 200 <= status_code < 300:
-            raise Exception("backend (UPP) returned error: ({}) {}".format(status_code, str(content)))
+        # communication worked in general, now check server responses
+        if error is not None:
+            raise Exception(error)
 
     except Exception as e:
         error_handler.log(e, COLOR_BACKEND_FAIL)
@@ -279,24 +366,22 @@ try:
     # prepare hardware for sleep (needed for low current draw and
     # freeing of resources for after the reset, as the modem stays on)
     print("++ preparing hardware for deepsleep")
+    print(api.dump_timing())
     print("\tclose connection")
+    api.close()
     connection.disconnect()
 
+    # the SIM channel can be kept open, as the modem stays on during deepsleep
     print("\tdeinit SIM")
-    sim.deinit()
+    sim.deinit(close_channel=not cfg['sim_keep_channel'])
+    nvs_set("sim_channel", sim.channel if cfg['sim_keep_channel'] else None)
 
     # not detaching causes smaller/no re-attach time on next reset but but
     # somewhat higher sleep current needs to be balanced based on your specific interval
     print("\tdeinit LTE")
     lte.deinit(detach=False)
 
-    # go to deepsleep
-    sleep_time = interval - int(time.time() - start_time)
-    if sleep_time < 0:
-        sleep_time = 0
-    print(">> going into deepsleep for {} seconds".format(sleep_time))
-    set_led(LED_OFF)
-    machine.deepsleep(1000 * sleep_time)  # sleep, execution will resume from main.py entry point
+    go_to_deepsleep()
 
 except Exception as e:
     error_handler.log(e, COLOR_UNKNOWN_FAIL, reset=True)
@@ -0,0 +1,263 @@
+"""
+| Replay of recorded AT transcripts.
+|
+| ATReplay implements the subset of the pycom LTE interface used by modem.py and ubirch_sim.py
+| and answers the AT commands with the responses of a transcript recorded on the device (config
+| option "at_record", see at_stats.start_recording). The recorded durations are accounted on a
+| virtual clock, so runs are deterministic and show the latencies of the real modem.
+|
+| Modes:
+|   - strict: the commands have to be sent in exactly the recorded order, any deviation raises
+|             an exception (regression test of the AT layer)
+|   - lookup: every command is answered with the next recorded response of the same command,
+|             AT+CSIM commands with different data fall back to the responses recorded for the
+|             same APDU header (for flows with varying data, e.g. signing of new measurements)
+|
+| Usage:
+|   record a transcript of a cycle against the SIM emulator:
+|     python3 tools/at_replay.py record transcript.jsonl [--latency 0.1]
+|   replay a transcript (e.g. "at_transcript.jsonl" from the flash of the device):
+|     python3 tools/at_replay.py replay transcript.jsonl [--mode strict] [--pin 1234] [--reset]
+|
+| Copyright 2019 ubirch GmbH
+|
+| Licensed under the Apache License, Version 2.0 (the "License");
+| you may not use this file except in compliance with the License.
+| You may obtain a copy of the License at
+|
+|        http://www.apache.org/licenses/LICENSE-2.0
+|
+| Unless required by applicable law or agreed to in writing, software
+| distributed under the License is distributed on an "AS IS" BASIS,
+| WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+| See the License for the specific language governing permissions and
+| limitations under the License.
+"""
+
+import argparse
+import json
+import os
+
+import host
+from sim_emulator import SimEmulator
+
+import at_stats
+import modem
+from ubirch import SimProtocol, ubirch_sim
+from uuid import UUID
+
+STRICT = "strict"
+LOOKUP = "lookup"
+
+
+def load_transcript(file: str) -> [dict]:
+    """Load a transcript with one {"cmd", "response", "ms"} object per line."""
+    with open(file, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _header_key(cmd: str) -> str:
+    """Key for the fallback lookup: the APDU header of AT+CSIM commands, the verb of others."""
+    if cmd.startswith('AT+CSIM='):
+        return cmd[:cmd.find('"') + 9]
+    return cmd.split("=", 1)[0]
+
+
+class ATReplay:
+    """
+    Fake LTE modem answering AT commands from a recorded transcript.
+    """
+
+    def __init__(self, transcript: [dict], mode: str = LOOKUP, debug: bool = False):
+        """
+        :param transcript: the recorded commands, see load_transcript()
+        :param mode: STRICT or LOOKUP, see module description
+        :param debug: print the AT command exchange
+        """
+        if mode not in (STRICT, LOOKUP):
+            raise Exception("unknown replay mode: {}".format(mode))
+        self.transcript = transcript
+        self.mode = mode
+        self.debug = debug
+        self.position = 0  # index of the next command in strict mode
+        self.clock = 0.0  # virtual time in seconds
+        self.at_commands = 0
+        self.connected = False
+        self.suspended = False
+
+        # queues of responses per command and per APDU header for the lookup mode
+        self._by_cmd = {}
+        self._by_header = {}
+        for entry in transcript:
+            self._by_cmd.setdefault(entry["cmd"], []).append(entry)
+            self._by_header.setdefault(_header_key(entry["cmd"]), []).append(entry)
+
+    ###############
+    #  LTE  API   #
+    ###############
+
+    def send_at_cmd(self, cmd: str) -> str:
+        if self.mode == STRICT:
+            entry = self._next_strict(cmd)
+        else:
+            entry = self._lookup(cmd)
+
+        self.clock += entry["ms"] / 1000.0
+        self.at_commands += 1
+        if self.debug:
+            print("++ " + cmd)
+            print("-- " + entry["response"].strip())
+        return entry["response"]
+
+    def isconnected(self) -> bool:
+        return self.connected and not self.suspended
+
+    def isattached(self) -> bool:
+        return True
+
+    def attach(self, *args, **kwargs):
+        pass
+
+    def connect(self, *args, **kwargs):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def pppsuspend(self):
+        self.suspended = True
+
+    def pppresume(self):
+        self.suspended = False
+
+    def reset(self):
+        self.connected = False
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def deinit(self, *args, **kwargs):
+        pass
+
+    ###############
+    #   helpers   #
+    ###############
+
+    def sleep(self, seconds: float):
+        """Advance the virtual clock."""
+        self.clock += seconds
+
+    def finished(self) -> bool:
+        """In strict mode: if all recorded commands were replayed."""
+        return self.position == len(self.transcript)
+
+    def _next_strict(self, cmd: str) -> dict:
+        if self.position >= len(self.transcript):
+            raise Exception("transcript mismatch at command {}: transcript ended, got {}".format(self.position, cmd))
+        entry = self.transcript[self.position]
+        if entry["cmd"] != cmd:
+            raise Exception("transcript mismatch at command {}: expected {}, got {}".format(
+                self.position, entry["cmd"], cmd))
+        self.position += 1
+        return entry
+
+    def _lookup(self, cmd: str) -> dict:
+        for queues, key in ((self._by_cmd, cmd), (self._by_header, _header_key(cmd))):
+            queue = queues.get(key)
+            if queue:
+                # the last recorded response is repeated, once the earlier ones are used up
+                entry = queue.pop(0) if len(queue) > 1 else queue[0]
+                return entry
+        raise Exception("no recorded response for command: {}".format(cmd))
+
+
+class _VirtualTime:
+    """Replaces the time module of the library modules, so sleeps advance the virtual clock."""
+
+    def __init__(self, lte, module):
+        self.lte = lte
+        self.module = module
+
+    def sleep(self, seconds: float):
+        self.lte.sleep(seconds)
+
+    def ticks_ms(self) -> int:
+        return int(self.lte.clock * 1000)
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+
+def run_cycle(lte, pin: str, key_name: str, message: bytes, reset: bool = False, channel: int = None):
+    """
+    Run the modem and SIM operations of a main.py cycle and print the AT commands and
+    the (virtual) time of every phase.
+    """
+    modem.time = _VirtualTime(lte, modem.time)
+    ubirch_sim.time = _VirtualTime(lte, ubirch_sim.time)
+    at_stats.time = _VirtualTime(lte, at_stats.time)  # record the virtual durations
+
+    print("{:<24s} {:>6s} {:>9s}".format("phase", "AT", "time [s]"))
+
+    def measure(name: str, operation):
+        at_before = _at_commands(lte)
+        clock_before = lte.clock
+        result = operation()
+        print("{:<24s} {:>6d} {:>9.3f}".format(name, _at_commands(lte) - at_before, lte.clock - clock_before))
+        return result
+
+    if reset:
+        measure("reset_modem", lambda: modem.reset_modem(lte))
+    measure("get_imsi", lambda: modem.get_imsi(lte))
+    sim = measure("SimProtocol init", lambda: SimProtocol(lte=lte, channel=channel))
+    measure("sim_auth", lambda: sim.sim_auth(pin))
+    measure("get_uuid", lambda: sim.get_uuid(key_name))
+    measure("message_chained", lambda: sim.message_chained(key_name, message, hash_before_sign=True,
+                                                           hash_on_host=True))
+    measure("deinit", lambda: sim.deinit())
+    print("{:<24s} {:>6d} {:>9.3f}".format("total", _at_commands(lte), lte.clock))
+
+
+def _at_commands(lte) -> int:
+    return lte.stats["at_commands"] if isinstance(lte, SimEmulator) else lte.at_commands
+
+
+def main():
+    parser = argparse.ArgumentParser(description="record and replay AT transcripts")
+    parser.add_argument("command", choices=["record", "replay"],
+                        help="record a transcript against the SIM emulator or replay a transcript")
+    parser.add_argument("transcript", help="the transcript file")
+    parser.add_argument("--mode", choices=[STRICT, LOOKUP], default=LOOKUP, help="replay mode")
+    parser.add_argument("--latency", type=float, default=0.1, help="emulator latency per AT command in seconds")
+    parser.add_argument("--pin", default="1234", help="PIN of the SIM")
+    parser.add_argument("--key", default="ukey", help="name of the key entry")
+    parser.add_argument("--channel", type=int, default=None, help="channel to resume the SIM session on")
+    parser.add_argument("--message-size", type=int, default=300, help="size of the data message in bytes")
+    parser.add_argument("--reset", action="store_true", help="run the modem reset")
+    parser.add_argument("--debug", action="store_true", help="print the AT command exchange")
+    args = parser.parse_args()
+
+    message = bytes(args.message_size)  # the same message in every run, for strict replays
+    if args.command == "record":
+        lte = SimEmulator(pin=args.pin, latency=args.latency, debug=args.debug)
+        sim = SimProtocol(lte=lte)
+        sim.sim_auth(args.pin)
+        sim.generate_key(args.key, UUID(os.urandom(16)))
+        sim.deinit()
+        lte.reset_stats()
+        lte.reset()  # the cycle starts with a fresh SIM session
+        at_stats.start_recording(args.transcript)
+        try:
+            run_cycle(lte, args.pin, args.key, message, reset=args.reset, channel=args.channel)
+        finally:
+            at_stats.stop_recording()
+    else:
+        lte = ATReplay(load_transcript(args.transcript), mode=args.mode, debug=args.debug)
+        run_cycle(lte, args.pin, args.key, message, reset=args.reset, channel=args.channel)
+        if args.mode == STRICT and not lte.finished():
+            raise Exception("transcript mismatch: {} recorded commands were not replayed".format(
+                len(lte.transcript) - lte.position))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+"""
+| Local stand-in for the ubirch backend, to test the sending of the testkit without the real services.
+|
+| Accepts data messages and UPPs one by one and with the batch endpoints (see ubirch.API.send_data_batch()
+| and ubirch.API.send_upp_batch()), answers bootstrap requests and CSRs. A UPP that was received before is
+| answered with 409, like a duplicate on the authentication service. A chained UPP has to follow the
+| last UPP of its UUID (its previous signature), otherwise it is answered with 400, the first UPP of a
+| UUID starts the chain. The data messages are checked against the payloads of the received UPPs,
+| directly (hash of the message) or with their merkle inclusion proof (root of the batch). The endpoints
+| (on one port) are
+|
+|   POST /niomon/           UPP                 POST /niomon/batch            concatenated UPPs
+|   POST /data/v1/json      JSON data message   POST /data/v1/json/batch      JSON array of data messages
+|   POST /data/v1/msgPack   msgpack message     POST /data/v1/msgPack/batch   JSON array of data messages
+|   GET  /bootstrap         {"pin": <pin>}      POST /identity                CSR
+|
+| Usage:
+|   python3 tools/backend_server.py [--port 8080] [--no-batch] [--delay 0.2]
+|
+| Copyright 2019 ubirch GmbH
+|
+| Licensed under the Apache License, Version 2.0 (the "License");
+| you may not use this file except in compliance with the License.
+| You may obtain a copy of the License at
+|
+|        http://www.apache.org/licenses/LICENSE-2.0
+|
+| Unless required by applicable law or agreed to in writing, software
+| distributed under the License is distributed on an "AS IS" BASIS,
+| WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+| See the License for the specific language governing permissions and
+| limitations under the License.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import host
+
+import canonical_msgpack
+import merkle
+
+UPP_SIGNATURE_SIZE = 64
+UPP_UUID_OFFSET = 4  # after the array header, the version and the bin 8 header
+UPP_PREVIOUS_OFFSET = 22  # previous signature of a chained UPP, after the UUID and the bin 8 header
+
+
+class Backend:
+    """State of the stand-in backend: the received UPPs and data messages."""
+
+    def __init__(self, batch: bool = True, delay: float = 0, pin: str = "1234"):
+        self.batch = batch
+        self.delay = delay
+        self.pin = pin
+        self.lock = threading.Lock()
+        self.signatures = set()  # signatures of the received UPPs, to detect duplicates
+        self.payloads = set()  # payloads (hashes) of the received UPPs
+        self.chains = {}  # signature of the last chained UPP by UUID
+        self.stats = {"requests": 0, "upps": 0, "duplicates": 0, "out_of_order": 0, "data": 0, "sealed": 0}
+
+    def upp(self, upp: bytes) -> (int, bytes):
+        """Receive a UPP, returns the status code and body of the response."""
+        try:
+            payload = upp_payload(upp)
+        except ValueError as e:
+            return 400, str(e).encode()
+        with self.lock:
+            signature = upp[-UPP_SIGNATURE_SIZE:]
+            if signature in self.signatures:
+                self.stats["duplicates"] += 1
+                return 409, b"UPP already received"
+            if upp[:2] == b"\x96\x23":
+                uuid = upp[UPP_UUID_OFFSET:UPP_UUID_OFFSET + 16]
+                previous = self.chains.get(uuid)
+                if previous is not None and previous != upp[UPP_PREVIOUS_OFFSET:UPP_PREVIOUS_OFFSET + 64]:
+                    self.stats["out_of_order"] += 1
+                    return 400, b"UPP out of chain order"
+                self.chains[uuid] = signature
+            self.signatures.add(signature)
+            self.payloads.add(payload)
+            self.stats["upps"] += 1
+        print("UPP    {}".format(base64.b64encode(payload).decode()))
+        return 200, b""
+
+    def data(self, message: bytes, proof: bytes = None, msgpack: bool = False) -> (int, bytes):
+        """Receive a JSON or msgpack data message with its optional merkle inclusion proof."""
+        try:
+            content = canonical_msgpack.unpackb(message) if msgpack else json.loads(message)
+        except ValueError:
+            return 400, b"invalid msgpack" if msgpack else b"invalid JSON"
+        if proof is None:
+            sealed = hashlib.sha256(message).digest()
+        else:
+            try:
+                index, size, path, _ = merkle.decode_proof(proof)
+            except ValueError as e:
+                return 400, str(e).encode()
+            sealed = merkle.root_from_path(message, index, size, path)
+            if sealed is None:
+                return 400, b"invalid merkle proof"
+        with self.lock:
+            self.stats["data"] += 1
+            known = sealed in self.payloads
+            if known:
+                self.stats["sealed"] += 1
+        print("data   {} {}{}".format(base64.b64encode(sealed).decode(), "(sealed) " if known else "",
+                                      content if msgpack else message.decode()))
+        return 200, b""
+
+
+def upp_payload(upp: bytes) -> bytes:
+    """Get the payload of a signed or chained UPP (as helpers.get_upp_payload())."""
+    if upp[:2] == b"\x95\x22":
+        start = 23
+    elif upp[:2] == b"\x96\x23":
+        start = 89
+    else:
+        raise ValueError("not a UPP")
+    if len(upp) < start or upp[start - 2] != 0xC4:
+        raise ValueError("unexpected payload type")
+    return upp[start:start + upp[start - 1]]
+
+
+def split_upps(data: bytes) -> [bytes]:
+    """Split concatenated UPPs, every UPP ends with a 64 byte signature (bin 8)."""
+    upps = []
+    pos = 0
+    while pos < len(data):
+        if data[pos:pos + 2] == b"\x95\x22":
+            start = pos + 23
+        elif data[pos:pos + 2] == b"\x96\x23":
+            start = pos + 89
+        else:
+            raise ValueError("not a UPP at offset {}".format(pos))
+        if len(data) < start:
+            raise ValueError("truncated UPP at offset {}".format(pos))
+        end = start + data[start - 1] + 2 + UPP_SIGNATURE_SIZE  # payload, 0xC4 0x40, signature
+        upps.append(data[pos:end])
+        pos = end
+    return upps
+
+
+def _results(results: [(int, bytes)]) -> bytes:
+    return json.dumps([{"status": status, "body": base64.b64encode(body).decode()}
+                       for status, body in results]).encode()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    backend = None
+
+    def _respond(self, status: int, body: bytes, content_type: str = "text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _begin(self):
+        self.backend.stats["requests"] += 1
+        if self.backend.delay:
+            time.sleep(self.backend.delay)
+
+    def do_GET(self):
+        self._begin()
+        if self.path.startswith("/bootstrap"):
+            self._respond(200, json.dumps({"pin": self.backend.pin}).encode(), "application/json")
+        else:
+            self._respond(404, b"not found")
+
+    def do_POST(self):
+        self._begin()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        backend = self.backend
+        path = self.path.rstrip("/")
+
+        if path.endswith("/batch") and not backend.batch:
+            self._respond(404, b"not found")
+        elif path == "/niomon":
+            self._respond(*backend.upp(body))
+        elif path == "/niomon/batch":
+            try:
+                upps = split_upps(body)
+            except ValueError as e:
+                self._respond(400, str(e).encode())
+                return
+            self._respond(200, _results([backend.upp(upp) for upp in upps]), "application/json")
+        elif path in ("/data/v1/json", "/data/v1/msgPack"):
+            proof = self.headers.get("X-Ubirch-Merkle-Proof")
+            self._respond(*backend.data(body, None if proof is None else base64.b64decode(proof),
+                                        path.endswith("/msgPack")))
+        elif path in ("/data/v1/json/batch", "/data/v1/msgPack/batch"):
+            msgpack = path.startswith("/data/v1/msgPack")
+            try:
+                items = json.loads(body)
+                results = [backend.data(base64.b64decode(item["message"]) if msgpack else item["message"].encode(),
+                                        base64.b64decode(item["proof"]) if "proof" in item else None, msgpack)
+                           for item in items]
+            except (ValueError, KeyError, TypeError) as e:
+                self._respond(400, str(e).encode())
+                return
+            self._respond(200, _results(results), "application/json")
+        elif path == "/identity":
+            self._respond(200, b"")
+        else:
+            self._respond(404, b"not found")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host_name: str = "127.0.0.1", port: int = 0, backend: Backend = None) -> ThreadingHTTPServer:
+    """
+    Start the stand-in backend in a background thread.
+    :return: the server, server.server_address has the actual port, server.shutdown() stops it
+    """
+    handler = type("Handler", (_Handler,), {"backend": backend or Backend()})
+    server = ThreadingHTTPServer((host_name, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="local stand-in for the ubirch backend")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--no-batch", action="store_true", help="answer the batch endpoints with 404")
+    parser.add_argument("--delay", type=float, default=0, help="delay of every response in seconds")
+    parser.add_argument("--pin", default="1234", help="PIN returned by the bootstrap endpoint")
+    args = parser.parse_args()
+
+    backend = Backend(batch=not args.no_batch, delay=args.delay, pin=args.pin)
+    server = serve(args.host, args.port, backend)
+    url = "http://<address of this machine>:{}".format(server.server_address[1])
+    print("backend listening on port {}, config for the testkit:".format(server.server_address[1]))
+    print(json.dumps({"niomon": url + "/niomon/", "data": url + "/data/v1", "bootstrap": url + "/bootstrap",
+                      "identity": url + "/identity"}, indent=4))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    print(backend.stats)
+
+
+if __name__ == '__main__':
+    main()
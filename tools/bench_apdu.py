@@ -0,0 +1,151 @@
+"""
+| Microbenchmark of the APDU encoding of the SimProtocol.
+|
+| Compares the binary APDU layer (preallocated buffers, hex encoded once into the AT command)
+| with the former hex string based implementation, which is kept here as reference. Both
+| build the AT+CSIM commands of a sign operation (sign init and chunked sign final) and send
+| them to a modem that answers every command immediately. Prints the time per operation and
+| the peak of transient memory (CPython tracemalloc) and checks that both produce the same commands.
+|
+| Usage:
+|   python3 tools/bench_apdu.py [--message-size 300] [--iterations 2000]
+|
+| Copyright 2019 ubirch GmbH
+|
+| Licensed under the Apache License, Version 2.0 (the "License");
+| you may not use this file except in compliance with the License.
+| You may obtain a copy of the License at
+|
+|        http://www.apache.org/licenses/LICENSE-2.0
+|
+| Unless required by applicable law or agreed to in writing, software
+| distributed under the License is distributed on an "AS IS" BASIS,
+| WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+| See the License for the specific language governing permissions and
+| limitations under the License.
+"""
+
+import argparse
+import binascii
+import time
+import tracemalloc
+
+import host
+
+from ubirch import ubirch_sim
+
+
+class _ImmediateModem:
+    """Answers every AT+CSIM command with success and records the commands."""
+
+    def __init__(self):
+        self.commands = []
+
+    def send_at_cmd(self, cmd: str) -> str:
+        self.commands.append(cmd)
+        return "\r\n+CSIM: 4,9000\r\n\r\nOK\r\n"
+
+    def isconnected(self) -> bool:
+        return False
+
+
+#####################################
+# former string based implementation
+#####################################
+
+LEGACY_SIGN_INIT = '80B5{:02X}00{:02X}{}'
+LEGACY_SIGN_FINAL = '80B6{:02X}00{:02X}{}'
+
+
+def _legacy_encode_tag(tags: [(int, bytes or str)]) -> str:
+    r = ""
+    for (tag, data) in tags:
+        if isinstance(data, bytes):
+            data = binascii.hexlify(data).decode()
+        data_len = int(len(data) / 2)
+        if data_len > 0xff:
+            data_len = (0x82 << 16) | data_len
+        r += "{0:02X}{1:02X}{2}".format(tag, data_len, data)
+    return r
+
+
+def _legacy_execute(lte, channel: int, cmd: str) -> (bytes, str):
+    if cmd[0] in ["0", "8", "A", "9"]:
+        channel_char = "{!s:.1}".format(channel)
+        cmd = cmd[0] + channel_char + cmd[2:]
+    at_cmd = 'AT+CSIM={},"{}"'.format(len(cmd), cmd.upper())
+    result = [k for k in lte.send_at_cmd(at_cmd).split('\r\n') if len(k.strip()) > 0]
+    response = result[0][7:].split(',')[1]
+    data = b''
+    code = response[-4:]
+    if len(response) > 4:
+        data = binascii.unhexlify(response[0:-4])
+    return data, code
+
+
+def _legacy_sign(lte, channel: int, max_at_length: int, entry_id: str, value: bytes, protocol_version: int):
+    args = _legacy_encode_tag([(0xC4, ('_' + entry_id).encode()), (0xD0, bytes([0x21]))])
+    _legacy_execute(lte, channel, LEGACY_SIGN_INIT.format(protocol_version, int(len(args) / 2), args))
+    args = binascii.hexlify(value).decode()
+    cmd = LEGACY_SIGN_FINAL
+    chunk_size = max_at_length - len(cmd[:-2].format(0, 0))
+    chunk_size -= chunk_size % 2
+    chunks = [args[i:i + chunk_size] for i in range(0, len(args), chunk_size)]
+    for chunk in chunks[:-1]:
+        _legacy_execute(lte, channel, cmd.format(0, int(len(chunk) / 2), chunk))
+    return _legacy_execute(lte, channel, cmd.format(0x80, int(len(chunks[-1]) / 2), chunks[-1]))
+
+
+#####################################
+# binary APDU layer
+#####################################
+
+def _new_sign(sim: ubirch_sim.SimProtocol, entry_id: str, value: bytes, protocol_version: int):
+    sim._sign_init(entry_id, protocol_version)
+    return sim._send_cmd_in_chunks(ubirch_sim.STK_APP_SIGN_FINAL, value)
+
+
+def _measure(name: str, operation, iterations: int):
+    operation()  # warm up
+    tracemalloc.start()
+    operation()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        operation()
+    duration = (time.perf_counter() - start) / iterations
+    print("{:<24s} {:>12.1f} {:>16d}".format(name, duration * 1000000, peak))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the APDU encoding of the SimProtocol")
+    parser.add_argument("--message-size", type=int, default=300, help="size of the message to sign in bytes")
+    parser.add_argument("--iterations", type=int, default=2000, help="number of iterations")
+    args = parser.parse_args()
+
+    value = bytes(i & 0xff for i in range(args.message_size))
+    legacy_lte = _ImmediateModem()
+    new_lte = _ImmediateModem()
+    sim = ubirch_sim.SimProtocol(lte=new_lte, channel=1)  # resumes the session on channel 1
+    new_lte.commands.clear()
+
+    # both implementations have to produce the same AT commands
+    _legacy_sign(legacy_lte, 1, sim.max_at_length, "ukey", value, 0x23)
+    _new_sign(sim, "ukey", value, 0x23)
+    if legacy_lte.commands != new_lte.commands:
+        raise Exception("AT commands differ:\n{}\n{}".format(legacy_lte.commands, new_lte.commands))
+    print("{} AT commands per sign operation\n".format(len(new_lte.commands)))
+
+    legacy_lte.commands = new_lte.commands = None  # don't record while measuring
+    legacy_lte.send_at_cmd = new_lte.send_at_cmd = lambda cmd: "\r\n+CSIM: 4,9000\r\n\r\nOK\r\n"
+
+    print("{:<24s} {:>12s} {:>16s}".format("implementation", "time [us]", "peak memory [B]"))
+    _measure("hex strings (former)",
+             lambda: _legacy_sign(legacy_lte, 1, sim.max_at_length, "ukey", value, 0x23), args.iterations)
+    _measure("binary APDU buffers", lambda: _new_sign(sim, "ukey", value, 0x23), args.iterations)
+
+
+if __name__ == '__main__':
+    main()
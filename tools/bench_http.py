@@ -0,0 +1,170 @@
+"""
+| Benchmark of the socket operations of urequests against a local HTTP server.
+|
+| Sends POST requests like ubirch.API does and counts the socket writes (every write over TLS
+| becomes at least one TLS record and, as the modem sends them right away, one TCP segment),
+| the socket read calls and the new connections (TCP connect and TLS handshake) per request.
+| The former implementation (one write per header part, headers read with readline()) is kept
+| here as reference.
+|
+| Usage:
+|   python3 tools/bench_http.py [--requests 10] [--body-size 300]
+|
+| Copyright 2019 ubirch GmbH
+|
+| Licensed under the Apache License, Version 2.0 (the "License");
+| you may not use this file except in compliance with the License.
+| You may obtain a copy of the License at
+|
+|        http://www.apache.org/licenses/LICENSE-2.0
+|
+| Unless required by applicable law or agreed to in writing, software
+| distributed under the License is distributed on an "AS IS" BASIS,
+| WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+| See the License for the specific language governing permissions and
+| limitations under the License.
+"""
+
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import host
+
+import urequests
+import usocket
+
+HEADERS = {
+    'X-Ubirch-Credential': 'cGFzc3dvcmQ=',
+    'X-Ubirch-Auth-Type': 'ubirch',
+    'X-Ubirch-Hardware-Id': '00000000-0000-0000-0000-000000000000'
+}
+
+STATS = {"connects": 0, "writes": 0, "reads": 0, "bytes_sent": 0, "bytes_received": 0}
+
+
+class _CountingSocket(host.USocket):
+    """Counts the operations of the socket."""
+
+    def connect(self, address):
+        STATS["connects"] += 1
+        super().connect(address)
+
+    def write(self, data) -> int:
+        STATS["writes"] += 1
+        STATS["bytes_sent"] += len(data)
+        return super().write(data)
+
+    def recv(self, size: int) -> bytes:
+        STATS["reads"] += 1
+        data = self.sock.recv(size)
+        STATS["bytes_received"] += len(data)
+        return data
+
+    def read(self, size: int = -1) -> bytes:
+        STATS["reads"] += 1
+        data = super().read(size)
+        STATS["bytes_received"] += len(data)
+        return data
+
+    def readline(self) -> bytes:
+        # micropython reads lines byte by byte
+        line = bytearray()
+        while not line.endswith(b"\n"):
+            STATS["reads"] += 1
+            c = self.sock.recv(1)
+            if not c:
+                break
+            STATS["bytes_received"] += 1
+            line += c
+        return bytes(line)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        response = b'{"received": %d}' % len(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        if self.request_version == "HTTP/1.0":
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+#####################################
+# former implementation
+#####################################
+
+def _legacy_post(url: str, data: bytes, headers: dict) -> (int, bytes):
+    proto, dummy, host_port, path = url.split("/", 3)
+    host_name, port = host_port.split(":", 1)
+    addr = usocket.getaddrinfo(host_name, int(port))[0][-1]
+    s = usocket.socket()
+    s.connect(addr)
+    s.write(("%s /%s HTTP/1.0\r\n" % ("POST", path)).encode())
+    s.write(("Host: %s\r\n" % host_port).encode())
+    for k in headers:
+        s.write(k)
+        s.write(b": ")
+        s.write(headers[k])
+        s.write(b"\r\n")
+    s.write(("Content-Length: %d\r\n" % len(data)).encode())
+    s.write(b"\r\n")
+    s.write(data)
+
+    status = int(s.readline().split(None, 2)[1])
+    while True:
+        line = s.readline()
+        if not line or line == b"\r\n":
+            break
+    content = s.read()
+    s.close()
+    return status, content
+
+
+def _measure(name: str, requests: int, operation):
+    for key in STATS:
+        STATS[key] = 0
+    for i in range(requests):
+        status, content = operation()
+        if status != 200:
+            raise Exception("request failed: {} {}".format(status, content))
+    print("{:<28s} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.1f} {:>10.1f}".format(
+        name, STATS["connects"] / requests, STATS["writes"] / requests, STATS["reads"] / requests,
+        STATS["bytes_sent"] / requests, STATS["bytes_received"] / requests))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the socket operations of urequests")
+    parser.add_argument("--requests", type=int, default=10, help="number of requests per variant")
+    parser.add_argument("--body-size", type=int, default=300, help="size of the request body in bytes")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/v1/json".format(server.server_address[1])
+    usocket.socket = _CountingSocket
+    body = bytes(args.body_size)
+
+    def post(keep_alive: bool):
+        r = urequests.post(url=url, data=body, headers=HEADERS, keep_alive=keep_alive)
+        return r.status_code, r.content
+
+    print("{:<28s} {:>9s} {:>9s} {:>9s} {:>10s} {:>10s}".format(
+        "per request", "connects", "writes", "reads", "sent [B]", "recv [B]"))
+    _measure("former implementation", args.requests, lambda: _legacy_post(url, body, HEADERS))
+    _measure("urequests", args.requests, lambda: post(False))
+    _measure("urequests keep-alive", args.requests, lambda: post(True))
+    urequests.close_all()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+| Benchmark of the canonical JSON rendering of the data messages (canonical_json), compared to the
+| former implementation of helpers.serialize_json (string concatenation), which is kept here as
+| reference. Checks that both render the messages byte-identical and measures the time and the
+| memory per message: with micropython, the memory allocated by a rendering (which fragments the
+| heap), with CPython the peak of the memory in use. Runs with CPython and with the micropython
+| unix port, from the root of the repository.
+|
+| Usage:
+|   python3 tools/bench_json.py [--iterations 1000]
+|   micropython tools/bench_json.py [--iterations 1000]
+|
+| Copyright 2019 ubirch GmbH
+|
+| Licensed under the Apache License, Version 2.0 (the "License");
+| you may not use this file except in compliance with the License.
+| You may obtain a copy of the License at
+|
+|        http://www.apache.org/licenses/LICENSE-2.0
+|
+| Unless required by applicable law or agreed to in writing, software
+| distributed under the License is distributed on an "AS IS" BASIS,
+| WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+| See the License for the specific language governing permissions and
+| limitations under the License.
+"""
+
+import gc
+import sys
+import time
+
+MICROPYTHON = sys.implementation.name == "micropython"
+
+if MICROPYTHON:
+    sys.path.insert(0, "src/lib")
+else:
+    import tracemalloc
+    import host
+
+import canonical_json
+
+# data of a pysense board (see README), with a nested map and a longer message
+MESSAGES = [
+    {
+        'data': {'AccPitch': -19.6, 'AccRoll': -7.1, 'AccX': 0.12, 'AccY': 0.34, 'AccZ': 0.96, 'H': 47.09,
+                 'L_blue': 14, 'L_red': 15, 'P': 95842.49, 'T': 23.88, 'V': 4.7},
+        'msg_type': 1,
+        'timestamp': 1595449261,
+        'uuid': "05122541-1321-4020-9225-00000fb9a5d4"
+    },
+    {
+        'data': {'location': {'lat': 52.52, 'lon': 13.4, 'fix': None}, 'state': "ok"},
+        'msg_type': 1,
+        'timestamp': 1595449261,
+        'uuid': "05122541-1321-4020-9225-00000fb9a5d4"
+    },
+    {
+        'data': {"sensor_{:02d}".format(i): i * 1.5 for i in range(40)},
+        'msg_type': 1,
+        'timestamp': 1595449261,
+        'uuid': "05122541-1321-4020-9225-00000fb9a5d4"
+    },
+]
+
+
+#####################################
+# former implementation
+#####################################
+
+def _legacy_serialize_json(msg: dict) -> bytes:
+    serialized = "{"
+    for key in sorted(msg):
+        serialized += "\"{}\":".format(key)
+        value = msg[key]
+        value_type = type(value)
+        if value_type is str:
+            serialized += "\"{:s}\"".format(value)
+        elif value_type is int:
+            serialized += "{:d}".format(value)
+        elif isinstance(value, float):
+            serialized += "\"{:.2f}\"".format(value)
+        elif value_type is dict:
+            serialized += _legacy_serialize_json(value).decode()
+        elif value is None:
+            serialized += "null"
+        else:
+            raise Exception("unsupported data type {} for serialization in json message".format(value_type))
+        serialized += ","
+    serialized = serialized.rstrip(",") + "}"  # replace last comma with closing braces
+    return serialized.encode()
+
+
+def _ticks_us() -> int:
+    return time.ticks_us() if MICROPYTHON else int(time.perf_counter() * 1000000)
+
+
+def _measure(name: str, iterations: int, serialize, msg: dict):
+    """Print the time per rendering of the message and the memory it allocates."""
+    serialize(msg)  # warm up (e.g. the output buffer)
+    gc.collect()
+    start = _ticks_us()
+    for _ in range(iterations):
+        serialize(msg)
+    duration = _ticks_us() - start
+
+    gc.collect()
+    if MICROPYTHON:
+        # all allocations of a rendering (the garbage the heap is fragmented with)
+        gc.disable()
+        allocated = gc.mem_alloc()
+        serialize(msg)
+        allocated = gc.mem_alloc() - allocated
+        gc.enable()
+    else:
+        # peak of the memory in use during a rendering (CPython frees intermediate strings right away)
+        tracemalloc.start()
+        serialize(msg)
+        allocated = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    print("{:<24s} {:>10.1f} {:>12d}".format(name, duration / iterations, allocated))
+
+
+def main():
+    iterations = 1000
+    if "--iterations" in sys.argv:
+        iterations = int(sys.argv[sys.argv.index("--iterations") + 1])
+
+    for i, msg in enumerate(MESSAGES):
+        legacy = _legacy_serialize_json(msg)
+        rendered = canonical_json.dumps(msg)
+        if rendered != legacy:
+            raise Exception("rendering of message {} differs:\n{}\n{}".format(i, legacy, rendered))
+
+        print("message {} ({} bytes), {} iterations".format(i, len(rendered), iterations))
+        print("{:<24s} {:>10s} {:>12s}".format("", "time [us]", "memory [B]"))
+        _measure("former implementation", iterations, _legacy_serialize_json, msg)
+        _measure("canonical_json", iterations, canonical_json.dumps, msg)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+| Host environment for the testkit library code.
+|
+| Importing this module makes the modules in "src/lib" importable with CPython on a
+| Linux box, by mapping the micropython specific modules they use to their CPython
+| counterparts. The pycom firmware modules (network, pycom, machine) only get minimal
+| placeholders, actual functionality is provided by backends like the SIM emulator.
+| usocket and ussl are provided on top of the CPython socket and ssl modules, uasyncio on
+| top of asyncio.
+|
+| Copyright 2019 ubirch GmbH
+|
+| Licensed under the Apache License, Version 2.0 (the "License");
+| you may not use this file except in compliance with the License.
+| You may obtain a copy of the License at
+|
+|        http://www.apache.org/licenses/LICENSE-2.0
+|
+| Unless required by applicable law or agreed to in writing, software
+| distributed under the License is distributed on an "AS IS" BASIS,
+| WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+| See the License for the specific language governing permissions and
+| limitations under the License.
+"""
+
+import asyncio
+import binascii
+import collections  # load the CPython collections module before src/lib (with its own collections) is in the path
+import collections.abc
+import errno
+import hashlib
+import json
+import os
+import re
+import select
+import socket
+import ssl
+import sys
+import time
+import types
+
+SRC_LIB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "lib")
+
+
+class LTE:
+    """Placeholder for the pycom LTE class, only used for type hints by the library."""
+    pass
+
+
+def _timeout_errors(func):
+    # micropython raises OSError(ETIMEDOUT) on socket timeouts
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except socket.timeout:
+            raise OSError(errno.ETIMEDOUT, "timed out")
+    return wrapper
+
+
+class USocket:
+    """
+    micropython socket (stream interface) on top of a CPython socket. readline() reads byte by
+    byte and read(n) until n bytes or EOF, like the micropython implementations.
+    """
+
+    def __init__(self, *args):
+        self.sock = socket.socket(*args)
+
+    @_timeout_errors
+    def connect(self, address):
+        self.sock.connect(address)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def setblocking(self, flag: bool):
+        self.sock.setblocking(flag)
+
+    @_timeout_errors
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode()
+        if self.sock.gettimeout() == 0:
+            # non-blocking: write as much as possible, None if nothing could be written
+            try:
+                return self.sock.send(data)
+            except BlockingIOError:
+                return None
+        self.sock.sendall(data)
+        return len(data)
+
+    @_timeout_errors
+    def send(self, data) -> int:
+        return self.sock.send(data)
+
+    @_timeout_errors
+    def recv(self, size: int) -> bytes:
+        return self.sock.recv(size)
+
+    @_timeout_errors
+    def read(self, size: int = -1) -> bytes:
+        data = bytearray()
+        while size < 0 or len(data) < size:
+            chunk = self.sock.recv(4096 if size < 0 else min(4096, size - len(data)))
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+    @_timeout_errors
+    def readinto(self, buf, size: int = None) -> int:
+        data = self.read(len(buf) if size is None else size)
+        buf[:len(data)] = data
+        return len(data)
+
+    @_timeout_errors
+    def readline(self) -> bytes:
+        line = bytearray()
+        while not line.endswith(b"\n"):
+            c = self.sock.recv(1)
+            if not c:
+                break
+            line += c
+        return bytes(line)
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+
+@_timeout_errors
+def _wrap_socket(sock: USocket, server_hostname: str = None, **kwargs) -> USocket:
+    # the handshake is done when a connected socket is wrapped, or on connect
+    context = ssl.create_default_context()
+    sock.sock = context.wrap_socket(sock.sock, server_hostname=server_hostname)
+    return sock
+
+
+def _hexlify(data, sep=None) -> bytes:
+    # micropython accepts str as buffer
+    if isinstance(data, str):
+        data = data.encode()
+    return binascii.hexlify(data, sep) if sep is not None else binascii.hexlify(data)
+
+
+def _ticks_us() -> int:
+    return int(time.perf_counter() * 1000000)
+
+
+def _ticks_ms() -> int:
+    return int(time.perf_counter() * 1000)
+
+
+def _ticks_diff(end: int, start: int) -> int:
+    return end - start
+
+
+def _sleep_ms(ms: int):
+    return asyncio.sleep(ms / 1000)
+
+
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    # the event loop of the main thread, created on first use like the uasyncio one
+    try:
+        return asyncio.get_event_loop_policy().get_event_loop()
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
+
+
+def install():
+    """
+    Make the library code importable. Safe to call multiple times.
+    """
+    if SRC_LIB not in sys.path:
+        sys.path.insert(0, SRC_LIB)
+
+    if "ubinascii" not in sys.modules:
+        ubinascii = types.ModuleType("ubinascii")
+        ubinascii.__dict__.update(binascii.__dict__)
+        ubinascii.hexlify = _hexlify
+        sys.modules["ubinascii"] = ubinascii
+    sys.modules.setdefault("uhashlib", hashlib)
+    sys.modules.setdefault("ujson", json)
+    sys.modules.setdefault("ure", re)
+    if "usocket" not in sys.modules:
+        usocket = types.ModuleType("usocket")
+        usocket.socket = USocket
+        usocket.getaddrinfo = socket.getaddrinfo
+        usocket.dnsserver = lambda *args: None
+        sys.modules["usocket"] = usocket
+    if "ussl" not in sys.modules:
+        ussl = types.ModuleType("ussl")
+        ussl.wrap_socket = _wrap_socket
+        sys.modules["ussl"] = ussl
+    sys.modules.setdefault("uselect", select)
+    if "uasyncio" not in sys.modules:
+        uasyncio = types.ModuleType("uasyncio")
+        uasyncio.__dict__.update(asyncio.__dict__)
+        uasyncio.sleep_ms = _sleep_ms
+        uasyncio.get_event_loop = _get_event_loop
+        sys.modules["uasyncio"] = uasyncio
+
+    if "network" not in sys.modules:
+        network = types.ModuleType("network")
+        network.LTE = LTE
+        sys.modules["network"] = network
+
+    # micropython time functions
+    if not hasattr(time, "ticks_us"):
+        time.ticks_us = _ticks_us
+        time.ticks_ms = _ticks_ms
+        time.ticks_diff = _ticks_diff
+
+
+install()
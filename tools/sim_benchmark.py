@@ -0,0 +1,94 @@
+"""
+| Benchmark of the SimProtocol operations of a measurement cycle against the SIM emulator.
+|
+| Prints the number of AT commands and APDUs, the transferred bytes, the number of PPP
+| suspends and the (virtual) time per operation, based on the configured per command latency.
+| The time includes the sleeps of the SimProtocol, which are accounted on the virtual clock.
+|
+| Usage:
+|   python3 tools/sim_benchmark.py [--latency 0.1] [--message-size 300] [--batch 10]
+|
+| Copyright 2019 ubirch GmbH
+|
+| Licensed under the Apache License, Version 2.0 (the "License");
+| you may not use this file except in compliance with the License.
+| You may obtain a copy of the License at
+|
+|        http://www.apache.org/licenses/LICENSE-2.0
+|
+| Unless required by applicable law or agreed to in writing, software
+| distributed under the License is distributed on an "AS IS" BASIS,
+| WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+| See the License for the specific language governing permissions and
+| limitations under the License.
+"""
+
+import argparse
+import os
+
+import host
+from sim_emulator import SimEmulator
+
+from ubirch import SimProtocol, ubirch_sim
+from uuid import UUID
+
+PIN = "1234"
+KEY_NAME = "ukey"
+
+
+class _VirtualTime:
+    """Replaces the time module of the SimProtocol, so sleeps advance the emulator clock."""
+
+    def __init__(self, emulator: SimEmulator):
+        self.emulator = emulator
+
+    def sleep(self, seconds: float):
+        self.emulator.sleep(seconds)
+
+
+def _measure(lte: SimEmulator, name: str, operation):
+    lte.reset_stats()
+    result = operation()
+    stats = lte.stats
+    print("{:<32s} {:>6d} {:>6d} {:>9d} {:>9d} {:>6d} {:>9.3f}".format(
+        name, stats["at_commands"], stats["apdus"], stats["apdu_bytes_sent"], stats["apdu_bytes_received"],
+        stats["ppp_suspends"], lte.clock))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark SimProtocol operations against the SIM emulator")
+    parser.add_argument("--latency", type=float, default=0.1, help="latency per AT command in seconds")
+    parser.add_argument("--message-size", type=int, default=300, help="size of the data messages in bytes")
+    parser.add_argument("--batch", type=int, default=10, help="number of messages to seal in a batch")
+    parser.add_argument("--modem-at-length", type=int, default=520,
+                        help="maximal AT+CSIM APDU length accepted by the emulated modem")
+    args = parser.parse_args()
+
+    lte = SimEmulator(pin=PIN, latency=args.latency, max_at_length=args.modem_at_length)
+    lte.connect()  # the modem has to be suspended for every AT session, as on the device
+    ubirch_sim.time = _VirtualTime(lte)
+    message = os.urandom(args.message_size)
+    messages = [os.urandom(args.message_size) for _ in range(args.batch)]
+
+    print("{:<32s} {:>6s} {:>6s} {:>9s} {:>9s} {:>6s} {:>9s}".format(
+        "operation", "AT", "APDUs", "APDU out", "APDU in", "PPP", "time [s]"))
+    sim = _measure(lte, "init", lambda: SimProtocol(lte=lte))
+    _measure(lte, "sim_auth", lambda: sim.sim_auth(PIN))
+    _measure(lte, "generate_key", lambda: sim.generate_key(KEY_NAME, UUID(os.urandom(16))))
+    _measure(lte, "get_uuid", lambda: sim.get_uuid(KEY_NAME))
+    _measure(lte, "get_key", lambda: sim.get_key(KEY_NAME))
+    _measure(lte, "generate_csr", lambda: sim.generate_csr(KEY_NAME, "DE", "ubirch GmbH"))
+    _measure(lte, "message_chained (SIM hash)",
+             lambda: sim.message_chained(KEY_NAME, message, hash_before_sign=True))
+    _measure(lte, "message_chained (host hash)",
+             lambda: sim.message_chained(KEY_NAME, message, hash_before_sign=True, hash_on_host=True))
+    _measure(lte, "message_chained x{}".format(args.batch),
+             lambda: [sim.message_chained(KEY_NAME, m, hash_before_sign=True, hash_on_host=True) for m in messages])
+    _measure(lte, "message_chained_batch x{}".format(args.batch),
+             lambda: sim.message_chained_batch(KEY_NAME, messages, hash_before_sign=True, hash_on_host=True))
+    _measure(lte, "deinit", lambda: sim.deinit())
+
+
+if __name__ == '__main__':
+    main()
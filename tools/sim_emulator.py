@@ -0,0 +1,606 @@
+"""
+| Host-side emulator of the G+D SIM Card Application (TLSAuthApp) behind a fake LTE modem.
+|
+| SimEmulator implements the subset of the pycom LTE interface (send_at_cmd, pppsuspend, ...)
+| and of the SIM application that is used by ubirch_sim.py and modem.py, so the SimProtocol
+| can be run, benchmarked and regression tested on a Linux box:
+|   - logical channels (open/close), application selection and PIN authentication
+|   - secure storage entries, key generation, public key storage and retrieval
+|   - signed and chained UPPs (ECDSA P-256 in software), signature verification
+|   - certificate signing requests (PKCS#10) and certificate retrieval
+|   - secure random
+| Every AT command can be charged with a configurable latency, which is either slept or only
+| accounted on a virtual clock. Statistics about the APDU exchange are collected in `stats`.
+|
+| Usage:
+|   import host
+|   from sim_emulator import SimEmulator
+|   from ubirch import SimProtocol
+|
+|   lte = SimEmulator(pin="1234", latency={"AT+CSIM": 0.1})
+|   sim = SimProtocol(lte=lte)
+|
+| [1] CustomerManual_TLSAuthApp_v1.3.1.pdf
+|
+| Copyright 2019 ubirch GmbH
+|
+| Licensed under the Apache License, Version 2.0 (the "License");
+| you may not use this file except in compliance with the License.
+| You may obtain a copy of the License at
+|
+|        http://www.apache.org/licenses/LICENSE-2.0
+|
+| Unless required by applicable law or agreed to in writing, software
+| distributed under the License is distributed on an "AS IS" BASIS,
+| WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+| See the License for the specific language governing permissions and
+| limitations under the License.
+"""
+
+import binascii
+import hashlib
+import os
+import time
+
+APP_DF = binascii.unhexlify('D2760001180002FF34108389C0028B02')
+
+SW_OK = b'\x90\x00'
+SW_MORE_DATA = b'\x63\x10'
+SW_WRONG_LENGTH = b'\x67\x00'
+SW_SECURITY_STATUS = b'\x69\x82'
+SW_CONDITIONS_OF_USE = b'\x69\x85'
+SW_VERIFY_FAILED = b'\x69\x88'
+SW_CHANNEL_NOT_SUPPORTED = b'\x68\x81'
+SW_WRONG_DATA = b'\x6A\x80'
+SW_NO_CHANNEL = b'\x6A\x81'
+SW_APP_NOT_FOUND = b'\x6A\x82'
+SW_NOT_FOUND = b'\x6A\x88'
+SW_INS_NOT_SUPPORTED = b'\x6D\x00'
+
+# NIST P-256
+P256_P = 0xFFFFFFFF00000001000000000000000000000000FFFFFFFFFFFFFFFFFFFFFFFF
+P256_A = P256_P - 3
+P256_B = 0x5AC635D8AA3A93E7B3EBBD55769886BC651D06B0CC53B0F63BCE3C3E27D2604B
+P256_N = 0xFFFFFFFF00000000FFFFFFFFFFFFFFFFBCE6FAADA7179E84F3B9CAC2FC632551
+P256_G = (0x6B17D1F2E12C4247F8BCE6E563A440F277037D812DEB33A0F4A13945D898C296,
+          0x4FE342E2FE1A7F9B8EE7EB4A7C0F9E162BCE33576B315ECECBB6406837BF51F5)
+
+
+def _point_add(p1, p2):
+    if p1 is None:
+        return p2
+    if p2 is None:
+        return p1
+    if p1[0] == p2[0]:
+        if (p1[1] + p2[1]) % P256_P == 0:
+            return None
+        lam = (3 * p1[0] * p1[0] + P256_A) * pow(2 * p1[1], -1, P256_P)
+    else:
+        lam = (p2[1] - p1[1]) * pow(p2[0] - p1[0], -1, P256_P)
+    x = (lam * lam - p1[0] - p2[0]) % P256_P
+    return x, (lam * (p1[0] - x) - p1[1]) % P256_P
+
+
+def _point_mul(k: int, point):
+    result = None
+    while k:
+        if k & 1:
+            result = _point_add(result, point)
+        point = _point_add(point, point)
+        k >>= 1
+    return result
+
+
+def ecdsa_generate_key() -> (int, bytes):
+    """
+    Generate a P-256 key pair.
+    :return: the private key and the public key (64 bytes, x || y)
+    """
+    private_key = int.from_bytes(os.urandom(32), "big") % (P256_N - 1) + 1
+    x, y = _point_mul(private_key, P256_G)
+    return private_key, x.to_bytes(32, "big") + y.to_bytes(32, "big")
+
+
+def ecdsa_sign(private_key: int, message: bytes) -> bytes:
+    """
+    Sign the SHA256 hash of a message.
+    :return: the signature (64 bytes, r || s)
+    """
+    e = int.from_bytes(hashlib.sha256(message).digest(), "big")
+    while True:
+        k = int.from_bytes(os.urandom(32), "big") % (P256_N - 1) + 1
+        r = _point_mul(k, P256_G)[0] % P256_N
+        s = pow(k, -1, P256_N) * (e + r * private_key) % P256_N
+        if r != 0 and s != 0:
+            return r.to_bytes(32, "big") + s.to_bytes(32, "big")
+
+
+def ecdsa_verify(public_key: bytes, message: bytes, signature: bytes) -> bool:
+    """
+    Verify a signature (r || s) over the SHA256 hash of a message.
+    """
+    r = int.from_bytes(signature[:32], "big")
+    s = int.from_bytes(signature[32:64], "big")
+    if not (0 < r < P256_N and 0 < s < P256_N):
+        return False
+    point = (int.from_bytes(public_key[:32], "big"), int.from_bytes(public_key[32:64], "big"))
+    e = int.from_bytes(hashlib.sha256(message).digest(), "big")
+    w = pow(s, -1, P256_N)
+    result = _point_add(_point_mul(e * w % P256_N, P256_G), _point_mul(r * w % P256_N, point))
+    return result is not None and result[0] % P256_N == r
+
+
+def _der(tag: int, content: bytes) -> bytes:
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    length_bytes = length.to_bytes((length.bit_length() + 7) // 8, "big")
+    return bytes([tag, 0x80 | len(length_bytes)]) + length_bytes + content
+
+
+def _der_int(value: bytes) -> bytes:
+    value = value.lstrip(b'\x00') or b'\x00'
+    if value[0] & 0x80:
+        value = b'\x00' + value
+    return _der(0x02, value)
+
+
+def _der_name_attr(oid: bytes, value: bytes) -> bytes:
+    return _der(0x31, _der(0x30, _der(0x06, oid) + _der(0x0C, value)))
+
+
+OID_COUNTRY = b'\x55\x04\x06'
+OID_ORGANIZATION = b'\x55\x04\x0A'
+OID_COMMON_NAME = b'\x55\x04\x03'
+OID_EC_PUBLIC_KEY = b'\x2A\x86\x48\xCE\x3D\x02\x01'
+OID_PRIME256V1 = b'\x2A\x86\x48\xCE\x3D\x03\x01\x07'
+OID_ECDSA_SHA256 = b'\x2A\x86\x48\xCE\x3D\x04\x03\x02'
+
+
+def _encode_tlv(tags: [(int, bytes)]) -> bytes:
+    encoded = b''
+    for tag, data in tags:
+        if len(data) > 0x7F:
+            encoded += bytes([tag, 0x82, len(data) >> 8, len(data) & 0xFF]) + data
+        else:
+            encoded += bytes([tag, len(data)]) + data
+    return encoded
+
+
+def _decode_tlv(encoded: bytes) -> [(int, bytes)]:
+    decoded = []
+    idx = 0
+    while idx + 1 < len(encoded):
+        tag = encoded[idx]
+        length = encoded[idx + 1]
+        idx += 2
+        if length == 0x82:
+            length = encoded[idx] << 8 | encoded[idx + 1]
+            idx += 2
+        decoded.append((tag, encoded[idx:idx + length]))
+        idx += length
+    return decoded
+
+
+def _msgpack_bin(data: bytes) -> bytes:
+    if len(data) <= 0xFF:
+        return bytes([0xC4, len(data)]) + data
+    return bytes([0xC5, len(data) >> 8, len(data) & 0xFF]) + data
+
+
+class _Entry:
+    """A secure storage entry."""
+
+    def __init__(self, title: bytes, permission: bytes = b'\x03', entry_type: bytes = b'\x0B\x01\x00'):
+        self.title = title
+        self.permission = permission
+        self.type = entry_type
+        self.private_key = None  # int
+        self.public_key = None  # 64 bytes
+        self.certificate = None  # DER
+        self.previous_signature = bytes(64)  # signature of the last chained UPP
+
+
+class _Channel:
+    """State of a logical channel to the SIM."""
+
+    def __init__(self):
+        self.app_selected = False
+        self.selected_entry = None  # entry ID
+        self.pending = b''  # response data for GET RESPONSE / more data commands
+        self.chained = b''  # data of a chained command (P1 bit 0x80 not set yet)
+        self.sign_context = None  # (entry ID, protocol version) after sign init
+        self.verify_context = None
+
+
+class SimEmulator:
+    """
+    Emulates a pycom LTE modem with a SIM card running the TLSAuthApp.
+    """
+
+    def __init__(self, pin: str = "1234", imsi: str = "901280000000001", latency: float or dict = 0.0,
+                 real_time: bool = False, max_at_length: int = 520, response_part_size: int = 128,
+                 reusable_sign_init: bool = False, debug: bool = False):
+        """
+        :param pin: the PIN of the SIM application
+        :param imsi: the IMSI of the SIM
+        :param latency: seconds charged for every AT command, either a number or a dict mapping
+                        command verbs (e.g. "AT+CSIM") to numbers, with "*" as the default
+        :param real_time: if True, latencies are slept, otherwise they are only added to the virtual clock
+        :param max_at_length: the maximal APDU length (hex encoded) the emulated modem accepts in AT+CSIM
+        :param response_part_size: the number of bytes of long responses (CSR, certificate) per APDU
+        :param reusable_sign_init: whether a sign init stays valid for further messages after sign final
+        :param debug: print the AT command exchange
+        """
+        self.pin = pin
+        self.imsi = imsi
+        self.latency = latency
+        self.real_time = real_time
+        self.max_at_length = max_at_length
+        self.response_part_size = response_part_size
+        self.reusable_sign_init = reusable_sign_init
+        self.debug = debug
+
+        self.entries = {}  # entry ID (bytes) -> _Entry
+        self.channels = {0: _Channel()}
+        self.authenticated = False
+        self.connected = False
+        self.suspended = False
+        self.clock = 0.0  # virtual time in seconds
+        self.stats = {}
+        self.reset_stats()
+
+    ###############
+    #  LTE  API   #
+    ###############
+
+    def send_at_cmd(self, cmd: str) -> str:
+        verb = cmd.split("=", 1)[0].split("?", 1)[0]
+        self.sleep(self._latency(verb))
+
+        if cmd.startswith('AT+CSIM='):
+            response = self._csim(cmd)
+        elif cmd == "AT+CIMI":
+            response = "\r\n{}\r\n\r\nOK\r\n".format(self.imsi)
+        elif cmd == "AT+CFUN?":
+            response = "\r\n+CFUN: 1\r\n\r\nOK\r\n"
+        elif cmd == "AT+CEREG?":
+            response = "\r\n+CEREG: 0,1\r\n\r\nOK\r\n"
+        else:
+            response = "\r\nOK\r\n"
+
+        self.stats["at_commands"] += 1
+        self.stats["at_bytes_sent"] += len(cmd)
+        self.stats["at_bytes_received"] += len(response)
+        if self.debug:
+            print("++ " + cmd)
+            print("-- " + response.strip())
+        return response
+
+    def isconnected(self) -> bool:
+        return self.connected and not self.suspended
+
+    def isattached(self) -> bool:
+        return True
+
+    def attach(self, *args, **kwargs):
+        pass
+
+    def connect(self, *args, **kwargs):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def pppsuspend(self):
+        self.suspended = True
+        self.stats["ppp_suspends"] += 1
+
+    def pppresume(self):
+        self.suspended = False
+
+    def reset(self):
+        self.channels = {0: _Channel()}
+        self.authenticated = False
+        self.connected = False
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def deinit(self, *args, **kwargs):
+        pass
+
+    ###############
+    #   helpers   #
+    ###############
+
+    def sleep(self, seconds: float):
+        """Advance the virtual clock (and sleep if running in real time)."""
+        self.clock += seconds
+        if self.real_time and seconds > 0:
+            time.sleep(seconds)
+
+    def reset_stats(self):
+        self.stats = {
+            "at_commands": 0,
+            "at_bytes_sent": 0,
+            "at_bytes_received": 0,
+            "apdus": 0,
+            "apdu_bytes_sent": 0,
+            "apdu_bytes_received": 0,
+            "ppp_suspends": 0,
+            "instructions": {},
+        }
+        self.clock = 0.0
+
+    def store_certificate(self, entry_id: str, certificate: bytes):
+        """Store a certificate entry, as the backend would do after the CSR was signed."""
+        entry = _Entry(title=entry_id.encode())
+        entry.certificate = certificate
+        self.entries[entry_id.encode()] = entry
+
+    def _latency(self, verb: str) -> float:
+        if isinstance(self.latency, dict):
+            return self.latency.get(verb, self.latency.get("*", 0.0))
+        return self.latency
+
+    ###############
+    #    CSIM     #
+    ###############
+
+    def _csim(self, cmd: str) -> str:
+        if cmd == 'AT+CSIM=?':
+            return "\r\nOK\r\n"
+
+        try:
+            length, apdu = cmd[8:].split(",", 1)
+            apdu = apdu.strip('"')
+            if int(length) != len(apdu) or len(apdu) > self.max_at_length:
+                return "\r\nERROR\r\n"
+            apdu = binascii.unhexlify(apdu)
+        except ValueError:
+            return "\r\nERROR\r\n"
+
+        response = self._process(apdu)
+
+        self.stats["apdus"] += 1
+        self.stats["apdu_bytes_sent"] += len(apdu)
+        self.stats["apdu_bytes_received"] += len(response)
+        ins = "{:02X}".format(apdu[1])
+        self.stats["instructions"][ins] = self.stats["instructions"].get(ins, 0) + 1
+
+        response = binascii.hexlify(response).decode().upper()
+        return "\r\n+CSIM: {},{}\r\n\r\nOK\r\n".format(len(response), response)
+
+    def _process(self, apdu: bytes) -> bytes:
+        cla, ins, p1, p2 = apdu[0], apdu[1], apdu[2], apdu[3]
+        data = apdu[5:5 + apdu[4]] if len(apdu) > 5 else b''
+        le = apdu[4] if len(apdu) == 5 else None
+
+        number = cla & 0x03
+        if number not in self.channels:
+            return SW_CHANNEL_NOT_SUPPORTED
+        channel = self.channels[number]
+
+        if cla & 0xF0 == 0x00:
+            if ins == 0x70:
+                return self._manage_channel(p1, p2)
+            if ins == 0xA4:
+                channel.app_selected = data == APP_DF
+                return SW_OK if channel.app_selected else SW_APP_NOT_FOUND
+            if ins == 0xC0:
+                return self._get_response(channel, le)
+
+        if not channel.app_selected:
+            return SW_INS_NOT_SUPPORTED
+
+        if cla & 0xF0 == 0x00 and ins == 0x20:
+            self.authenticated = data == self.pin.encode()
+            return SW_OK if self.authenticated else b'\x63\xC2'
+
+        if cla & 0xF0 != 0x80:
+            return SW_INS_NOT_SUPPORTED
+
+        if ins == 0xB9:  # random, the length is given in P2
+            return os.urandom(p2) + SW_OK
+
+        # chained commands: collect data until the last chunk (P1 bit 0x80) was received
+        if ins in (0xB6, 0xB8, 0xD8, 0xBA) and not (ins == 0xBA and p1 == 0x81):
+            channel.chained += data
+            if not p1 & 0x80:
+                return SW_OK
+            data, channel.chained = channel.chained, b''
+
+        handler = {
+            0xA5: self._select_entry,
+            0xE5: self._delete_all,
+            0xB2: self._generate_key,
+            0xD8: self._store_key,
+            0xCB: self._get_key,
+            0xB5: self._sign_init,
+            0xB6: self._sign_final,
+            0xB7: self._verify_init,
+            0xB8: self._verify_final,
+            0xBA: self._generate_csr,
+            0xCC: self._get_certificate,
+        }.get(ins)
+        if handler is None:
+            return SW_INS_NOT_SUPPORTED
+        return handler(channel, p1, data)
+
+    def _respond(self, channel: _Channel, data: bytes, part_size: int = 0x100) -> bytes:
+        """Make data available for GET RESPONSE."""
+        channel.pending = data
+        return bytes([0x61, min(len(data), part_size) & 0xFF])
+
+    def _next_part(self, channel: _Channel, length: int) -> bytes:
+        """Return the next part of pending data, with the 'more data' status if there is more."""
+        part, channel.pending = channel.pending[:length], channel.pending[length:]
+        return part + (SW_MORE_DATA if channel.pending else SW_OK)
+
+    ###############
+    #  commands   #
+    ###############
+
+    def _manage_channel(self, p1: int, p2: int) -> bytes:
+        if p1 == 0x00:
+            for number in range(1, 4):
+                if number not in self.channels:
+                    self.channels[number] = _Channel()
+                    return bytes([number]) + SW_OK
+            return SW_NO_CHANNEL
+        if p1 == 0x80 and p2 in self.channels and p2 != 0:
+            del self.channels[p2]
+            return SW_OK
+        return SW_WRONG_DATA
+
+    def _get_response(self, channel: _Channel, le: int) -> bytes:
+        if not channel.pending:
+            return SW_CONDITIONS_OF_USE
+        return self._next_part(channel, le or 256)
+
+    def _select_entry(self, channel: _Channel, p1: int, data: bytes) -> bytes:
+        entry = self.entries.get(data)
+        if entry is None:
+            channel.selected_entry = None
+            return SW_NOT_FOUND
+        channel.selected_entry = data
+        return self._respond(channel, _encode_tlv([(0xC4, data), (0xC0, entry.title), (0xC1, entry.permission),
+                                                   (0xC2, entry.type)]))
+
+    def _delete_all(self, channel: _Channel, p1: int, data: bytes) -> bytes:
+        if not self.authenticated:
+            return SW_SECURITY_STATUS
+        self.entries = {}
+        return SW_OK
+
+    def _generate_key(self, channel: _Channel, p1: int, data: bytes) -> bytes:
+        if not self.authenticated:
+            return SW_SECURITY_STATUS
+        tags = _decode_tlv(data)
+        ids = [value for tag, value in tags if tag == 0xC4]
+        titles = [value for tag, value in tags if tag == 0xC0]
+        if len(ids) != 2 or len(titles) != 2:
+            return SW_WRONG_DATA
+
+        private_key, public_key = ecdsa_generate_key()
+        public_entry = _Entry(titles[0])
+        public_entry.public_key = public_key
+        private_entry = _Entry(titles[1])
+        private_entry.private_key = private_key
+        private_entry.public_key = public_key
+        self.entries[ids[0]] = public_entry
+        self.entries[ids[1]] = private_entry
+        return SW_OK
+
+    def _store_key(self, channel: _Channel, p1: int, data: bytes) -> bytes:
+        if not self.authenticated:
+            return SW_SECURITY_STATUS
+        tags = dict(_decode_tlv(data))
+        key = tags.get(0xC3, b'')
+        if 0xC4 not in tags or len(key) != 65 or key[0] != 0x04:
+            return SW_WRONG_DATA
+        entry = _Entry(tags.get(0xC0, b''), tags.get(0xC1, b'\x03'), tags.get(0xC2, b'\x0B\x01\x00'))
+        entry.public_key = key[1:]
+        self.entries[tags[0xC4]] = entry
+        return SW_OK
+
+    def _get_key(self, channel: _Channel, p1: int, data: bytes) -> bytes:
+        entry = self.entries.get(channel.selected_entry)
+        if entry is None or entry.public_key is None:
+            return SW_CONDITIONS_OF_USE
+        return self._respond(channel, _encode_tlv([(0xC3, b'\x04' + entry.public_key)]))
+
+    def _sign_init(self, channel: _Channel, p1: int, data: bytes) -> bytes:
+        if not self.authenticated:
+            return SW_SECURITY_STATUS
+        entry_id = dict(_decode_tlv(data)).get(0xC4)
+        entry = self.entries.get(entry_id)
+        if entry is None:
+            return SW_NOT_FOUND
+        if entry.private_key is None:
+            return SW_CONDITIONS_OF_USE
+        channel.sign_context = (entry_id, p1)
+        return SW_OK
+
+    def _sign_final(self, channel: _Channel, p1: int, data: bytes) -> bytes:
+        if channel.sign_context is None:
+            return SW_CONDITIONS_OF_USE
+        entry_id, protocol_version = channel.sign_context
+        if not self.reusable_sign_init:
+            channel.sign_context = None
+        entry = self.entries[entry_id]
+
+        payload = hashlib.sha256(data).digest() if protocol_version & 0x40 else data
+        version = protocol_version & 0x3F
+        if version == 0x22:
+            upp = b'\x95\x22' + _msgpack_bin(entry.title) + b'\x00' + _msgpack_bin(payload)
+        elif version == 0x23:
+            upp = b'\x96\x23' + _msgpack_bin(entry.title) + _msgpack_bin(entry.previous_signature) \
+                  + b'\x00' + _msgpack_bin(payload)
+        elif version == 0x00:
+            return self._respond(channel, ecdsa_sign(entry.private_key, payload))
+        else:
+            return SW_WRONG_DATA
+
+        signature = ecdsa_sign(entry.private_key, upp)
+        if version == 0x23:
+            entry.previous_signature = signature
+        return self._respond(channel, upp + _msgpack_bin(signature))
+
+    def _verify_init(self, channel: _Channel, p1: int, data: bytes) -> bytes:
+        entry = self.entries.get(dict(_decode_tlv(data)).get(0xC4))
+        if entry is None:
+            return SW_NOT_FOUND
+        channel.verify_context = (entry, p1)
+        return SW_OK
+
+    def _verify_final(self, channel: _Channel, p1: int, data: bytes) -> bytes:
+        if channel.verify_context is None:
+            return SW_CONDITIONS_OF_USE
+        entry, _ = channel.verify_context
+        channel.verify_context = None
+        if len(data) < 66 or data[-66:-64] != b'\xC4\x40':
+            return SW_WRONG_DATA
+        if ecdsa_verify(entry.public_key, data[:-66], data[-64:]):
+            return SW_OK
+        return SW_VERIFY_FAILED
+
+    def _generate_csr(self, channel: _Channel, p1: int, data: bytes) -> bytes:
+        if p1 == 0x81:  # get next part of the CSR
+            if not channel.pending:
+                return SW_CONDITIONS_OF_USE
+            return self._next_part(channel, self.response_part_size)
+
+        if not self.authenticated:
+            return SW_SECURITY_STATUS
+        tags = _decode_tlv(data)
+        ids = [value for tag, value in tags if tag == 0xC4]
+        if len(ids) != 2 or ids[1] not in self.entries:
+            return SW_NOT_FOUND
+        entry = self.entries[ids[1]]
+        attributes = dict(_decode_tlv(dict(_decode_tlv(dict(tags)[0xE5]))[0xE7]))
+
+        subject = _der(0x30, _der_name_attr(OID_COUNTRY, attributes.get(0xD4, b''))
+                       + _der_name_attr(OID_ORGANIZATION, attributes.get(0xD7, b''))
+                       + _der_name_attr(OID_COMMON_NAME, attributes.get(0xD9, b'')))
+        public_key_info = _der(0x30, _der(0x30, _der(0x06, OID_EC_PUBLIC_KEY) + _der(0x06, OID_PRIME256V1))
+                               + _der(0x03, b'\x00\x04' + entry.public_key))
+        request_info = _der(0x30, _der_int(b'\x00') + subject + public_key_info + _der(0xA0, b''))
+        signature = ecdsa_sign(entry.private_key, request_info)
+        der_signature = _der(0x30, _der_int(signature[:32]) + _der_int(signature[32:]))
+        csr = _der(0x30, request_info + _der(0x30, _der(0x06, OID_ECDSA_SHA256))
+                   + _der(0x03, b'\x00' + der_signature))
+        return self._respond(channel, csr, self.response_part_size)
+
+    def _get_certificate(self, channel: _Channel, p1: int, data: bytes) -> bytes:
+        if p1 == 0x01:  # get next part of the certificate
+            if not channel.pending:
+                return SW_CONDITIONS_OF_USE
+            return self._next_part(channel, self.response_part_size)
+
+        entry = self.entries.get(channel.selected_entry)
+        if entry is None or entry.certificate is None:
+            return SW_CONDITIONS_OF_USE
+        channel.pending = _encode_tlv([(0xC3, entry.certificate)])
+        return self._next_part(channel, self.response_part_size)